@@ -0,0 +1,136 @@
+import argparse
+import tempfile
+import sys
+import os
+
+import numpy as np
+import pandas as pd
+
+# The repository modules are imported from its root
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+from benchmarks.synthetic import FakeHistorical, symbols
+
+'''
+Resume check of the request planner (request_planner.get_range_planned) against FakeHistorical.
+A planned request whose first chunk download fails must raise and leave the finished chunks and the plan behind;
+calling again with the same request must fetch only the failed chunk and return every record of the range once.
+A request estimated above max_cost must be refused before any data is requested.
+
+    python -m benchmarks.check_planned_resume
+    python -m benchmarks.check_planned_resume --symbols 5 --max-records 20000
+
+Exits with status 1 when any of these does not hold.
+'''
+
+class _FailingTimeseries:
+    # Raises on the first get_range call, whichever chunk it is for, then serves FakeHistorical's data
+    def __init__(self, timeseries):
+        self.timeseries = timeseries
+        self.failed = None
+
+    @property
+    def calls(self):
+        return self.timeseries.calls
+
+    def get_range(self, dataset, symbols, start, end, schema='trades', path=None, **kwargs):
+        if self.failed is None:
+            self.failed = (start, end)
+            raise ConnectionError(f'Simulated failure of the {start} to {end} chunk')
+        return self.timeseries.get_range(dataset, symbols, start, end, schema, path, **kwargs)
+
+def _records(stores):
+    # Instrument ids and timestamps of every record, read one store at a time
+    from databento_fetch import iter_dbn_frames
+    keys = []
+    for store in stores:
+        for df in iter_dbn_frames(store):
+            keys.append(np.column_stack([df['instrument_id'].to_numpy(np.int64), df.index.asi8]))
+    return np.concatenate(keys) if keys else np.empty((0, 2), dtype=np.int64)
+
+def check_resume(tickers, start, end, schema, max_records):
+    """
+    Runs a planned request that fails once, then resumes it.
+    Returns:
+        list: Failed checks, empty when the planner resumed correctly.
+    """
+    from request_planner import get_range_planned, plan_path
+    client = FakeHistorical()
+    client.timeseries = _FailingTimeseries(client.timeseries)
+    expected = client.metadata.get_record_count('XNAS.ITCH', start, end, tickers, schema)
+    failures = []
+    with tempfile.TemporaryDirectory() as root:
+        os.environ['databento_plan_root'] = root
+        plan = plan_path(tickers, pd.Timestamp(start), pd.Timestamp(end), schema, root=root)
+        try:
+            get_range_planned(tickers, start, end, schema, client=client, max_records=max_records)
+            failures.append('the first call did not raise')
+        except ConnectionError:
+            pass
+        first_calls = len(client.timeseries.calls)
+        chunk_files = list(plan.parent.glob('*.dbn.zst'))
+        print(f'first call: {first_calls + 1} chunk requests, 1 failed, {len(chunk_files)} chunk files kept')
+        if not plan.exists():
+            failures.append('the plan was not kept after the failure')
+        if len(chunk_files) != first_calls:
+            failures.append(f'{len(chunk_files)} chunk files kept for {first_calls} fetched chunks')
+
+        stores = get_range_planned(tickers, start, end, schema, client=client, max_records=max_records)
+        resumed = client.timeseries.calls[first_calls:]
+        print(f'second call: {len(resumed)} chunk request(s)')
+        if [(call['start'], call['end']) for call in resumed] != [client.timeseries.failed]:
+            failures.append(f'the second call requested {[(c["start"], c["end"]) for c in resumed]}, '
+                            f'not only the failed chunk {client.timeseries.failed}')
+        keys = _records(stores)
+        unique = len(np.unique(keys, axis=0))
+        print(f'{len(keys):,} records returned, {unique:,} unique, {expected:,} expected')
+        if len(keys) != expected or unique != expected:
+            failures.append(f'{len(keys):,} records ({unique:,} unique) returned instead of {expected:,}')
+        if plan.exists() or any(plan.parent.glob('*.dbn.zst')):
+            failures.append('chunk files or the plan were left behind after the request completed')
+    return failures
+
+def check_max_cost(tickers, start, end, schema):
+    """
+    Asks for a request with max_cost at half its estimate.
+    Returns:
+        list: Failed checks, empty when the request was refused without fetching.
+    """
+    from request_planner import get_range_planned
+    client = FakeHistorical()
+    cost = client.metadata.get_cost('XNAS.ITCH', start, end, tickers, schema)
+    with tempfile.TemporaryDirectory() as root:
+        os.environ['databento_plan_root'] = root
+        try:
+            get_range_planned(tickers, start, end, schema, client=client, max_cost=cost / 2)
+            return [f'a ${cost:,.2f} request was not refused with max_cost ${cost / 2:,.2f}']
+        except ValueError as e:
+            print(f'max_cost: {e}')
+    if client.timeseries.calls:
+        return [f'{len(client.timeseries.calls)} chunk(s) requested although max_cost refused the request']
+    return []
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Check that planned Data Bento requests resume after a failure.')
+    parser.add_argument('--symbols', type=int, default=3, help='Synthetic symbols requested (default 3).')
+    parser.add_argument('--schema', default='ohlcv-1m', help='Schema requested (default ohlcv-1m).')
+    parser.add_argument('--start', default='2023-01-02')
+    parser.add_argument('--end', default='2023-03-01', help='Exclusive end date.')
+    parser.add_argument('--max-records', type=int, default=10_000, help='Records per chunk (default 10,000).')
+    args = parser.parse_args(argv)
+
+    # No DBN cache, the chunk files only live under the temporary plan root, and the symbology cache stays in memory
+    from symbology import SymbologyCache, set_cache
+    os.environ.pop('databento_dbn_cache', None)
+    set_cache(SymbologyCache(':memory:'))
+    tickers = symbols(args.symbols)
+    failures = check_resume(tickers, args.start, args.end, args.schema, args.max_records)
+    failures += check_max_cost(tickers, args.start, args.end, args.schema)
+    for failure in failures:
+        print(f'FAILED: {failure}')
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,96 @@
+import argparse
+import sys
+import os
+
+import numpy as np
+import pandas as pd
+import databento as db
+
+# The repository modules are imported from its root
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+from benchmarks.synthetic import make_dbn
+
+'''
+Bit-exactness check of the fixed-point price path (databento_price_type=fixed) against the current float one.
+Every DBN store is decoded both ways and encoded into LEAN rows by the same writer code. The rows must be equal
+except for prices the float path truncates one deci-cent low, which the fixed-point path writes exactly.
+
+    python -m benchmarks.check_price_paths                               # synthetic daily and minute bars
+    python -m benchmarks.check_price_paths databento/dbn/XNAS.ITCH/ohlcv-1d/*/*.dbn.zst
+
+Exits with status 1 on any other difference.
+'''
+
+SYNTHETIC = [
+    ('ohlcv-1d', ['SYM0000', 'SYM0001', 'SYM0002'], '2004-01-01', '2024-01-01'),
+    ('ohlcv-1m', ['SYM0000'], '2023-01-01', '2024-01-01'),
+]
+
+def _fields(payload):
+    # LEAN rows as an (n, 6) array of their time and integer fields
+    lines = payload.decode().splitlines()
+    return np.array([line.split(',') for line in lines], dtype=object)
+
+def compare_price_paths(store, time_format='date'):
+    """
+    Encodes a DBN store of OHLCV bars into LEAN rows from float and from fixed-point prices and compares them.
+    Returns:
+        dict: rows, equal_rows, low_by_one (float prices one deci-cent below the fixed-point ones) and other
+            (any other differing field, which fails the check).
+    """
+    from databento_fetch import to_df
+    from lean_writer import encode_lean_frame
+    float_rows = _fields(encode_lean_frame(to_df(store, price_type='float'), time_format))
+    fixed_rows = _fields(encode_lean_frame(to_df(store, price_type='fixed'), time_format))
+    if float_rows.shape != fixed_rows.shape:
+        return {'rows': len(fixed_rows), 'equal_rows': 0, 'low_by_one': 0, 'other': len(fixed_rows)}
+    differs = float_rows != fixed_rows
+    prices = differs[:, 1:5]
+    low = fixed_rows[:, 1:5][prices].astype(np.int64) - float_rows[:, 1:5][prices].astype(np.int64)
+    other = int(differs[:, [0, 5]].sum()) + int((low != 1).sum())
+    return {'rows': len(fixed_rows), 'equal_rows': int((~differs.any(axis=1)).sum()), 'low_by_one': int((low == 1).sum()),
+            'other': other}
+
+def compare_engines(store, time_format='date'):
+    """
+    Returns True when the Polars engine formats the fixed-point prices of a store like the pandas one, or None
+    without Polars.
+    """
+    try:
+        import polars as pl
+    except ImportError:
+        return None
+    from databento_fetch import to_df
+    from lean_writer import encode_lean_frame, lean_line_expr, to_polars
+    df = to_df(store, price_type='fixed')
+    lines = to_polars(df).select(lean_line_expr('ms' if time_format == 'ms' else 'date', fixed=True)).collect()
+    return lines.write_csv(include_header=False, quote_style='never').encode() == encode_lean_frame(df, time_format)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare LEAN rows from float and fixed-point prices.')
+    parser.add_argument('files', nargs='*', help='DBN files of OHLCV bars, default synthetic data.')
+    args = parser.parse_args(argv)
+
+    if args.files:
+        stores = [(path, db.DBNStore.from_file(path)) for path in args.files]
+    else:
+        stores = [(f'synthetic {schema} {len(tickers)} symbol(s) {start} to {end}',
+                   db.DBNStore.from_bytes(make_dbn(tickers, start, end, schema)))
+                  for schema, tickers, start, end in SYNTHETIC]
+
+    failed = False
+    for name, store in stores:
+        time_format = 'ms' if str(store.schema) in ('ohlcv-1m', 'ohlcv-1s') else 'date'
+        result = compare_price_paths(store, time_format)
+        engines = compare_engines(store, time_format)
+        print(f"{name}: {result['rows']:,} rows, {result['equal_rows']:,} equal, "
+              f"{result['low_by_one']:,} prices one deci-cent low in the float path, {result['other']:,} other differences"
+              + ('' if engines is None else f", polars {'matches' if engines else 'differs'}"))
+        failed = failed or result['other'] > 0 or engines is False
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
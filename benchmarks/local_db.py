@@ -0,0 +1,45 @@
+from contextlib import contextmanager
+import tempfile
+import os
+
+'''
+Local PostgreSQL stand-in for the benchmarks.
+The SQL paths use PostgreSQL-only features (COPY, ON CONFLICT, temporary tables), so the stand-in is a real
+PostgreSQL server run locally rather than another database:
+    - benchmark_pg_url environment variable: a throwaway database to use as is, or
+    - pgserver (pip install pgserver): an embedded server started in a temporary folder.
+'''
+
+@contextmanager
+def local_postgres(schema='databento_ohlcv'):
+    """
+    Yields a SQLAlchemy URL for a local PostgreSQL database with the given schema created,
+    or None when neither benchmark_pg_url nor pgserver is available.
+    """
+    url = os.getenv('benchmark_pg_url')
+    if url:
+        _create_schema(url, schema)
+        yield url
+        return
+
+    try:
+        import pgserver
+    except ImportError:
+        yield None
+        return
+
+    with tempfile.TemporaryDirectory(prefix='lean_bench_pg_') as folder:
+        server = pgserver.get_server(folder, cleanup_mode='stop')
+        try:
+            url = server.get_uri()
+            _create_schema(url, schema)
+            yield url
+        finally:
+            server.cleanup()
+
+def _create_schema(url, schema):
+    from sqlalchemy import create_engine, text
+    engine = create_engine(url)
+    with engine.begin() as conn:
+        conn.execute(text(f'CREATE SCHEMA IF NOT EXISTS "{schema}"'))
+    engine.dispose()
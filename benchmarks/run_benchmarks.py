@@ -0,0 +1,465 @@
+from contextlib import redirect_stdout
+import multiprocessing as mp
+import argparse
+import platform
+import tempfile
+import queue
+import json
+import time
+import sys
+import io
+import os
+
+import pandas as pd
+
+# Cases run in a temporary folder, the repository modules are imported from its root
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+from benchmarks.synthetic import FakeHistorical, symbols
+from benchmarks.local_db import local_postgres
+
+'''
+Offline benchmarks for the download, storage and LEAN conversion paths.
+Data Bento is replaced by benchmarks.synthetic.FakeHistorical and PostgreSQL by benchmarks.local_db.
+Every case runs in a fresh process inside a temporary folder; only the measured call is timed and its peak RSS
+is taken from the kernel's high-water mark, reset after setup where the platform allows it.
+
+    python -m benchmarks.run_benchmarks                               # run and print
+    python -m benchmarks.run_benchmarks --output benchmarks/baseline.json
+    python -m benchmarks.run_benchmarks --compare benchmarks/baseline.json
+
+--compare exits with status 1 when a case is slower (rows/sec) or larger (peak RSS) than the baseline
+by more than --tolerance.
+'''
+
+YEAR = ('2023-01-01', '2024-01-01')
+CASES = {}
+
+def case(name, needs_db=False):
+    def register(setup):
+        CASES[name] = (setup, needs_db)
+        return setup
+    return register
+
+def _store(schema, symbol_list, start, end, **fake_options):
+    # Decoded once during setup, outside the timed call
+    from databento_fetch import get_range_cached
+    return get_range_cached(symbol_list, pd.Timestamp(start), pd.Timestamp(end), schema=schema,
+                            client=FakeHistorical(**fake_options))
+
+def _sql_frame(schema='ohlcv-1m', symbol='SYM0000', start=YEAR[0], end=YEAR[1], price_type='float'):
+    from databento_sql import prepare_databento_df
+    df = prepare_databento_df(_store(schema, symbol, start, end).to_df(price_type=price_type))
+    df['ts_event'] = pd.to_datetime(df['ts_event'], utc=True)
+    return df
+
+# Each setup returns the measured callable, which returns the number of rows it handled
+
+@case('get_data_from_databento_daily')
+def _():
+    from databento_sql import get_data_from_databento
+    start, end = pd.Timestamp('2004-01-01'), pd.Timestamp('2024-01-01')
+    return lambda: len(get_data_from_databento('SYM0000', start, end))
+
+@case('get_data_from_databento_batch_1000_symbols')
+def _():
+    from databento_fetch import get_data_from_databento_batch
+    tickers = symbols(1000)
+    start, end = pd.Timestamp(YEAR[0]), pd.Timestamp(YEAR[1])
+    return lambda: sum(len(df) for df in get_data_from_databento_batch(tickers, start, end).values())
+
+@case('get_range_planned_trades')
+def _():
+    from request_planner import get_range_planned
+    start, end = pd.Timestamp('2023-01-02'), pd.Timestamp('2023-04-01')
+    # 650,000 trades fetched as chunks of at most 250,000 records, 4 at a time
+    def run():
+        stores = get_range_planned('SYM0000', start, end, schema='trades', max_records=250_000, max_workers=4)
+        return sum(len(store.to_df()) for store in stores)
+    return run
+
+@case('decode_minute')
+def _():
+    store = _store('ohlcv-1m', 'SYM0000', *YEAR)
+    return lambda: len(store.to_df())
+
+@case('decode_trades')
+def _():
+    store = _store('trades', 'SYM0000', '2023-01-02', '2023-02-01', trades_per_day=25_000)
+    return lambda: len(store.to_df())
+
+@case('write_lean_ticks_trades_quotes')
+def _():
+    from databento_fetch import iter_dbn_arrays
+    from lean_writer import write_lean_ticks
+    start, end = '2023-01-02', '2023-02-01'
+    trades = _store('trades', 'SYM0000', start, end, trades_per_day=25_000)
+    quotes = _store('mbp-1', 'SYM0000', start, end, trades_per_day=25_000)
+    rows = sum(len(batch) for store in (trades, quotes) for batch in iter_dbn_arrays(store))
+    def run():
+        write_lean_ticks(iter_dbn_arrays(trades), 'SYM0000', 'trade', force=True)
+        write_lean_ticks(iter_dbn_arrays(quotes), 'SYM0000', 'quote', force=True)
+        return rows
+    return run
+
+@case('raw_store_merge_dedup')
+def _():
+    from raw_store import write_raw, read_raw
+    df = _store('ohlcv-1m', 'SYM0000', *YEAR).to_df()
+    # The second download overlaps the second half of the first one
+    write_raw(df, 'SYM0000', 'ohlcv-1m', 'raw')
+    write_raw(df.iloc[len(df) // 2:], 'SYM0000', 'ohlcv-1m', 'raw')
+    return lambda: len(read_raw('SYM0000', 'ohlcv-1m', root='raw'))
+
+@case('upload_to_postgresql', needs_db=True)
+def _():
+    from databento_sql import upload_to_postgresql
+    df = _sql_frame()
+    def run():
+        upload_to_postgresql(df, 'BENCH_UPLOAD')
+        return len(df)
+    return run
+
+@case('upsert_to_postgresql', needs_db=True)
+def _():
+    from databento_sql import upload_to_postgresql, upsert_to_postgresql
+    df = _sql_frame()
+    # Half of the rows already exist, the merge updates them and inserts the rest
+    upload_to_postgresql(df.iloc[:len(df) // 2].copy(), 'BENCH_UPSERT')
+    def run():
+        upsert_to_postgresql(df, 'BENCH_UPSERT')
+        return len(df)
+    return run
+
+@case('get_data_from_postgresql', needs_db=True)
+def _():
+    from databento_sql import upload_to_postgresql, get_data_from_postgresql
+    upload_to_postgresql(_sql_frame(), 'BENCH_READ')
+    start, end = pd.Timestamp(YEAR[0], tz='UTC'), pd.Timestamp(YEAR[1], tz='UTC')
+    return lambda: len(get_data_from_postgresql('BENCH_READ', start, end))
+
+@case('get_data_from_postgresql_lean_columns', needs_db=True)
+def _():
+    from databento_sql import upload_to_postgresql, get_data_from_postgresql, LEAN_SOURCE_COLUMNS
+    upload_to_postgresql(_sql_frame(), 'BENCH_READ')
+    start, end = pd.Timestamp(YEAR[0], tz='UTC'), pd.Timestamp(YEAR[1], tz='UTC')
+    # The converter's columns are read through the binary COPY path
+    return lambda: len(get_data_from_postgresql('BENCH_READ', start, end, columns=LEAN_SOURCE_COLUMNS))
+
+@case('get_data_from_postgresql_lean_columns_fixed_point', needs_db=True)
+def _():
+    from databento_sql import upload_to_postgresql, get_data_from_postgresql, LEAN_SOURCE_COLUMNS
+    # BIGINT price columns, read back as int64 fixed-point
+    os.environ['databento_price_type'] = 'fixed'
+    upload_to_postgresql(_sql_frame(price_type='fixed'), 'BENCH_READ')
+    start, end = pd.Timestamp(YEAR[0], tz='UTC'), pd.Timestamp(YEAR[1], tz='UTC')
+    return lambda: len(get_data_from_postgresql('BENCH_READ', start, end, columns=LEAN_SOURCE_COLUMNS))
+
+@case('get_existing_dates_from_postgresql', needs_db=True)
+def _():
+    from databento_sql import upsert_to_postgresql, get_existing_dates_from_postgresql
+    upsert_to_postgresql(_sql_frame(), 'BENCH_DATES')
+    # Served from the symbol_coverage row, whatever the size of the ticker table
+    def run():
+        return sum(len(get_existing_dates_from_postgresql('BENCH_DATES')) for _ in range(100))
+    return run
+
+def _store_frame(schema='ohlcv-1d', symbol_list=symbols(100), start=YEAR[0], end=YEAR[1]):
+    from databento_sql import prepare_databento_df
+    return prepare_databento_df(_store(schema, symbol_list, start, end).to_df())
+
+@case('pg_store_upsert_bars_100_symbols', needs_db=True)
+def _():
+    import pg_store
+    df = _store_frame()
+    # Half of the rows already exist, the merge updates them and inserts the rest
+    pg_store.upsert_bars(df.iloc[:len(df) // 2], 'ohlcv-1d')
+    return lambda: pg_store.upsert_bars(df, 'ohlcv-1d')
+
+@case('pg_store_read_cross_section', needs_db=True)
+def _():
+    import pg_store
+    pg_store.upsert_bars(_store_frame(), 'ohlcv-1d')
+    days = pd.date_range('2023-06-01', periods=20, freq='B')
+    # One partition-pruned range read per day instead of 100 per-ticker queries
+    return lambda: sum(len(pg_store.read_cross_section(day)) for day in days)
+
+@case('convert_to_lean_format_daily_100_symbols')
+def _():
+    from databento_sql import convert_to_lean_format
+    frames = {ticker: df.reset_index() for ticker, df in
+              _store('ohlcv-1d', symbols(100), '2004-01-01', '2024-01-01').to_df().groupby('symbol')}
+    def run():
+        for ticker, df in frames.items():
+            convert_to_lean_format(df, ticker, 'daily')
+        return sum(len(df) for df in frames.values())
+    return run
+
+@case('convert_to_lean_format_minute')
+def _():
+    from databento_sql import convert_to_lean_format
+    df = _sql_frame()
+    def run():
+        convert_to_lean_format(df, 'SYM0000', 'minute')
+        return len(df)
+    return run
+
+@case('convert_to_lean_format_minute_fixed_point')
+def _():
+    from databento_sql import convert_to_lean_format
+    # Deci-cents by one integer division of the DBN prices, see benchmarks/check_price_paths.py for the output
+    df = _sql_frame(price_type='fixed')
+    def run():
+        convert_to_lean_format(df, 'SYM0000', 'minute')
+        return len(df)
+    return run
+
+@case('convert_to_lean_format_minute_polars')
+def _():
+    from databento_sql import convert_to_lean_format
+    df = _sql_frame()
+    def run():
+        convert_to_lean_format(df, 'SYM0000', 'minute', engine='polars')
+        return len(df)
+    return run
+
+def _stored_minute_case(engine):
+    from raw_store import write_raw
+    from databento_pipe import convert_stored_data
+    df = _store('ohlcv-1m', 'SYM0000', *YEAR).to_df()
+    # Overlapping downloads, so the merge has duplicates to drop
+    write_raw(df, 'SYM0000', 'ohlcv-1m', 'raw')
+    write_raw(df.iloc[len(df) // 2:], 'SYM0000', 'ohlcv-1m', 'raw')
+    def run():
+        convert_stored_data('SYM0000', YEAR[0], YEAR[1], 'minute', store_root='raw', engine=engine)
+        return len(df)
+    return run
+
+@case('convert_stored_data_minute')
+def _():
+    return _stored_minute_case('pandas')
+
+@case('convert_stored_data_minute_polars')
+def _():
+    return _stored_minute_case('polars')
+
+@case('convert_stored_data_hourly_daily_from_minute')
+def _():
+    from raw_store import write_raw
+    from databento_pipe import convert_stored_data
+    df = _store('ohlcv-1m', 'SYM0000', *YEAR).to_df()
+    write_raw(df, 'SYM0000', 'ohlcv-1m', 'raw')
+    # Both coarser resolutions aggregated from the one minute download
+    def run():
+        for frequency in ('hourly', 'daily'):
+            convert_stored_data('SYM0000', YEAR[0], YEAR[1], frequency, store_root='raw', source='minute')
+        return 2 * len(df)
+    return run
+
+@case('convert_stored_data_daily_append')
+def _():
+    from raw_store import write_raw
+    from databento_pipe import convert_stored_data
+    df = _store('ohlcv-1d', 'SYM0000', '2004-01-01', YEAR[1]).to_df()
+    cut = df.index < pd.Timestamp('2023-12-01', tz='UTC')
+    write_raw(df[cut], 'SYM0000', 'ohlcv-1d', 'raw')
+    convert_stored_data('SYM0000', '2004-01-01', '2023-11-30', 'daily', store_root='raw')
+    # A month of new bars on top of 20 years already converted
+    write_raw(df[~cut], 'SYM0000', 'ohlcv-1d', 'raw')
+    def run():
+        convert_stored_data('SYM0000', '2004-01-01', YEAR[1], 'daily', store_root='raw')
+        # Rows of the whole zip, so the rate compares with a full conversion
+        return len(df)
+    return run
+
+def _coarse_raw_store(cut=None):
+    from raw_store import write_raw
+    df = _store('ohlcv-1d', symbols(200), '2004-01-01', YEAR[1]).to_df()
+    before = df.index < pd.Timestamp(cut, tz='UTC') if cut else slice(None)
+    for ticker, bars in df[before].groupby('symbol'):
+        write_raw(bars, ticker, 'ohlcv-1d', 'raw')
+    return df
+
+@case('write_coarse_universe_200_symbols')
+def _():
+    from lean_coarse import write_coarse_universe
+    df = _coarse_raw_store()
+    # 20 years of per-symbol history transposed into one file per date
+    def run():
+        write_coarse_universe(store_root='raw', force=True)
+        return len(df)
+    return run
+
+@case('write_coarse_universe_daily_append')
+def _():
+    from raw_store import write_raw
+    from lean_coarse import write_coarse_universe
+    df = _coarse_raw_store('2023-12-29')
+    write_coarse_universe(store_root='raw')
+    # One new date for every symbol, only its month is regenerated
+    for ticker, bars in df[df.index >= pd.Timestamp('2023-12-29', tz='UTC')].groupby('symbol'):
+        write_raw(bars, ticker, 'ohlcv-1d', 'raw')
+    def run():
+        write_coarse_universe(store_root='raw')
+        # Rows of the whole universe, so the rate compares with a full build
+        return len(df)
+    return run
+
+@case('symbology_lookup_5000_tickers')
+def _():
+    from symbology import SymbologyCache
+    cache = SymbologyCache('symbology.sqlite')
+    tickers = symbols(5000)
+    # Three ticker changes per symbol, loaded into the in-memory index by a first lookup
+    cache.add('bench', 'permno', [(ticker, f'{2000 + 8 * j}-01-01', f'{2008 + 8 * j}-01-01', i * 10 + j)
+                                  for i, ticker in enumerate(tickers) for j in range(3)])
+    cache.lookup('bench', 'permno', tickers[0], '2001-01-01')
+    days = [f'{year}-06-30' for year in range(2000, 2024)]
+    def run():
+        for day in days:
+            cache.lookup_many('bench', 'permno', tickers, day)
+        return len(tickers) * len(days)
+    return run
+
+def _reset_peak_rss():
+    # Linux only: resets VmHWM so setup allocations are not counted
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+def _peak_rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def _run_case(name, db_url, results):
+    from databento_fetch import set_client
+    import pg_engine
+    set_client(FakeHistorical())
+    if db_url:
+        pg_engine.configure_engine(url=db_url)
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix='lean_bench_') as folder:
+        os.chdir(folder)
+        try:
+            with redirect_stdout(io.StringIO()):
+                run = CASES[name][0]()
+                peak_reset = _reset_peak_rss()
+                start = time.perf_counter()
+                rows = run()
+                seconds = time.perf_counter() - start
+            results.put({'rows': rows, 'seconds': seconds, 'peak_rss_mb': _peak_rss_mb(), 'peak_rss_after_setup': peak_reset})
+        except Exception as e:
+            results.put({'error': repr(e)})
+        finally:
+            os.chdir(cwd)
+
+def run_case(name, db_url=None, repeat=3):
+    """
+    Runs a case repeat times, each in a fresh process, and keeps the fastest run.
+    Returns:
+        dict: rows, seconds, rows_per_sec and peak_rss_mb, or error.
+    """
+    context = mp.get_context('spawn')
+    best = None
+    for _ in range(repeat):
+        results = context.Queue()
+        process = context.Process(target=_run_case, args=(name, db_url, results))
+        process.start()
+        process.join()
+        try:
+            result = results.get(timeout=5)
+        except queue.Empty:
+            # Killed before reporting, e.g. out of memory
+            return {'error': f'process exited with code {process.exitcode}'}
+        if 'error' in result:
+            return result
+        if best is None or result['seconds'] < best['seconds']:
+            best = result
+    best['rows_per_sec'] = best['rows'] / best['seconds'] if best['seconds'] else None
+    return best
+
+def compare(results, baseline, tolerance):
+    """
+    Returns the cases that regressed against the baseline results.
+    """
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None or 'error' in result or 'error' in base:
+            continue
+        if result['rows_per_sec'] < base['rows_per_sec'] * (1 - tolerance):
+            regressions.append(f"{name}: {result['rows_per_sec']:,.0f} rows/s vs baseline {base['rows_per_sec']:,.0f}")
+        if result['peak_rss_mb'] and base['peak_rss_mb'] and result['peak_rss_mb'] > base['peak_rss_mb'] * (1 + tolerance):
+            regressions.append(f"{name}: peak RSS {result['peak_rss_mb']:.0f} MB vs baseline {base['peak_rss_mb']:.0f} MB")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Offline benchmarks with synthetic data.')
+    parser.add_argument('--cases', help='Comma-separated case names, default all. --list shows them.')
+    parser.add_argument('--list', action='store_true', help='List the cases and exit.')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per case, the fastest is kept.')
+    parser.add_argument('--output', help='Write the results to this JSON file, e.g. benchmarks/baseline.json.')
+    parser.add_argument('--compare', help='Baseline JSON file to compare against.')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed regression as a fraction. Default 0.25.')
+    args = parser.parse_args(argv)
+
+    if args.list:
+        print('\n'.join(CASES))
+        return 0
+    names = args.cases.split(',') if args.cases else list(CASES)
+
+    results = {}
+    with local_postgres() as db_url:
+        for name in names:
+            if CASES[name][1] and db_url is None:
+                print(f'{name}: skipped, no local PostgreSQL (set benchmark_pg_url or pip install pgserver)')
+                continue
+            result = run_case(name, db_url, args.repeat)
+            results[name] = result
+            if 'error' in result:
+                print(f"{name}: failed: {result['error']}")
+            else:
+                print(f"{name}: {result['rows']:,} rows in {result['seconds']:.3f}s, "
+                      f"{result['rows_per_sec']:,.0f} rows/s, peak RSS {result['peak_rss_mb']:.0f} MB")
+
+    if args.output:
+        report = {
+            'environment': {'python': platform.python_version(), 'pandas': pd.__version__, 'platform': platform.platform(),
+                            'cpus': os.cpu_count()},
+            'results': results,
+        }
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'Results written to {args.output}')
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.tolerance)
+        for line in regressions:
+            print(f'Regression: {line}')
+        if regressions:
+            return 1
+        print(f'No regressions against {args.compare}')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,232 @@
+from types import SimpleNamespace
+import databento as db
+import databento_dbn as dbn
+import numpy as np
+import pandas as pd
+import zlib
+
+'''
+Synthetic market data and a fake Data Bento client for offline benchmarks.
+Records are generated with NumPy in the native DBN record layout, so millions of rows are produced
+in a fraction of the time the code under test needs, and the same seed always gives the same bytes.
+
+Sizes:
+    ohlcv-1d - one bar per weekday
+    ohlcv-1h - 7 bars per weekday (09:00 to 15:00 New York time)
+    ohlcv-1m - 390 bars per weekday (09:30 to 15:59 New York time)
+    trades   - trades_per_day ticks per weekday spread over the regular session
+    mbp-1    - trades_per_day top-of-book updates per weekday, about half of them changing the best bid or offer
+'''
+
+NS_PER_MINUTE = 60 * 1_000_000_000
+# Fixed-point scale of DBN prices (1e-9 dollars)
+PRICE_SCALE = 1_000_000_000
+
+_HEADER = [('length', 'u1'), ('rtype', 'u1'), ('publisher_id', '<u2'), ('instrument_id', '<u4'), ('ts_event', '<u8')]
+OHLCV_DTYPE = np.dtype(_HEADER + [('open', '<i8'), ('high', '<i8'), ('low', '<i8'), ('close', '<i8'), ('volume', '<u8')])
+TRADE_DTYPE = np.dtype(_HEADER + [('price', '<i8'), ('size', '<u4'), ('action', 'S1'), ('side', 'S1'), ('flags', 'u1'),
+                                  ('depth', 'u1'), ('ts_recv', '<u8'), ('ts_in_delta', '<i4'), ('sequence', '<u4')])
+MBP1_DTYPE = np.dtype(TRADE_DTYPE.descr + [('bid_px_00', '<i8'), ('ask_px_00', '<i8'), ('bid_sz_00', '<u4'),
+                                           ('ask_sz_00', '<u4'), ('bid_ct_00', '<u4'), ('ask_ct_00', '<u4')])
+
+SCHEMAS = {
+    'ohlcv-1d': (dbn.Schema.OHLCV_1D, int(dbn.RType.OHLCV_1D)),
+    'ohlcv-1h': (dbn.Schema.OHLCV_1H, int(dbn.RType.OHLCV_1H)),
+    'ohlcv-1m': (dbn.Schema.OHLCV_1M, int(dbn.RType.OHLCV_1M)),
+    'trades': (dbn.Schema.TRADES, int(dbn.RType.MBP_0)),
+    'mbp-1': (dbn.Schema.MBP_1, int(dbn.RType.MBP_1)),
+}
+PUBLISHER_ID = 2
+FIRST_INSTRUMENT_ID = 1000
+
+def bar_times(start_date, end_date, schema):
+    """
+    Returns the UTC ts_event nanoseconds of the bars of one symbol, weekdays in [start_date, end_date).
+    """
+    days = pd.bdate_range(start_date, pd.Timestamp(end_date) - pd.Timedelta(days=1))
+    if schema == 'ohlcv-1d':
+        return days.tz_localize('UTC').as_unit('ns').asi8.astype(np.uint64)
+    if schema == 'ohlcv-1h':
+        offsets = pd.to_timedelta(np.arange(9, 16), unit='h')
+    else:
+        offsets = pd.Timedelta(hours=9, minutes=30) + pd.to_timedelta(np.arange(390), unit='min')
+    local = (days.values[:, None] + offsets.values[None, :]).ravel()
+    # Session times are New York wall-clock times, converted once per bar
+    return pd.DatetimeIndex(local).tz_localize('America/New_York').tz_convert('UTC').as_unit('ns').asi8.astype(np.uint64)
+
+def _rng(symbol, seed):
+    return np.random.default_rng([seed, zlib.crc32(symbol.encode())])
+
+def _walk(rng, n, start_price=100.0):
+    # Random walk in cents, never below one dollar
+    steps = rng.normal(0, 0.001, n)
+    return np.maximum(np.round(start_price * np.exp(np.cumsum(steps)), 2), 1.0)
+
+def make_ohlcv_records(symbol, instrument_id, start_date, end_date, schema='ohlcv-1d', seed=0):
+    """
+    Generates one symbol's OHLCV bars as a structured array in the DBN record layout.
+    """
+    ts = bar_times(start_date, end_date, schema)
+    rng = _rng(symbol, seed)
+    close = _walk(rng, len(ts))
+    open_ = np.concatenate([[close[0]], close[:-1]]) if len(ts) else close
+    spread = np.round(rng.uniform(0, 0.005, len(ts)) * close, 2)
+    records = np.zeros(len(ts), dtype=OHLCV_DTYPE)
+    records['length'] = OHLCV_DTYPE.itemsize // 4
+    records['rtype'] = SCHEMAS[schema][1]
+    records['publisher_id'] = PUBLISHER_ID
+    records['instrument_id'] = instrument_id
+    records['ts_event'] = ts
+    records['open'] = np.round(open_ * 100).astype(np.int64) * (PRICE_SCALE // 100)
+    records['close'] = np.round(close * 100).astype(np.int64) * (PRICE_SCALE // 100)
+    records['high'] = np.round((np.maximum(open_, close) + spread) * 100).astype(np.int64) * (PRICE_SCALE // 100)
+    records['low'] = np.round((np.minimum(open_, close) - spread) * 100).astype(np.int64) * (PRICE_SCALE // 100)
+    records['volume'] = rng.integers(100, 1_000_000, len(ts), dtype=np.uint64)
+    return records
+
+def make_trade_records(symbol, instrument_id, start_date, end_date, trades_per_day=10_000, seed=0):
+    """
+    Generates one symbol's trades as a structured array in the DBN record layout.
+    """
+    rng = _rng(symbol, seed)
+    days = pd.bdate_range(start_date, pd.Timestamp(end_date) - pd.Timedelta(days=1))
+    opens = pd.DatetimeIndex(days + pd.Timedelta(hours=9, minutes=30)).tz_localize('America/New_York').tz_convert('UTC').as_unit('ns')
+    session_ns = 390 * NS_PER_MINUTE
+    offsets = np.sort(rng.integers(0, session_ns, (len(days), trades_per_day)), axis=1)
+    ts = (opens.asi8[:, None] + offsets).ravel().astype(np.uint64)
+    records = np.zeros(len(ts), dtype=TRADE_DTYPE)
+    records['length'] = TRADE_DTYPE.itemsize // 4
+    records['rtype'] = SCHEMAS['trades'][1]
+    records['publisher_id'] = PUBLISHER_ID
+    records['instrument_id'] = instrument_id
+    records['ts_event'] = ts
+    records['ts_recv'] = ts + 1000
+    records['price'] = np.round(_walk(rng, len(ts)) * 100).astype(np.int64) * (PRICE_SCALE // 100)
+    records['size'] = rng.integers(1, 500, len(ts), dtype=np.uint32)
+    records['action'] = b'T'
+    records['side'] = rng.choice(np.array([b'A', b'B', b'N']), len(ts))
+    records['sequence'] = np.arange(len(ts), dtype=np.uint32)
+    return records
+
+def make_mbp1_records(symbol, instrument_id, start_date, end_date, updates_per_day=10_000, seed=0):
+    """
+    Generates one symbol's top-of-book updates as a structured array in the DBN record layout.
+    Every other update only changes the size at a deeper level, so it leaves the best bid and offer as they were.
+    """
+    trades = make_trade_records(symbol, instrument_id, start_date, end_date, updates_per_day, seed)
+    rng = _rng(symbol, seed + 1)
+    records = np.zeros(len(trades), dtype=MBP1_DTYPE)
+    for field in TRADE_DTYPE.names:
+        records[field] = trades[field]
+    records['length'] = MBP1_DTYPE.itemsize // 4
+    records['rtype'] = SCHEMAS['mbp-1'][1]
+    records['action'] = rng.choice(np.array([b'A', b'C', b'M']), len(records))
+    records['depth'] = np.where(np.arange(len(records)) % 2, 1, 0)
+    sizes = rng.integers(1, 50, (2, len(records)), dtype=np.uint32) * 100
+    # Deeper-level updates repeat the previous best bid and offer
+    top = np.maximum.accumulate(np.where(records['depth'] == 0, np.arange(len(records)), 0))
+    half_spread = PRICE_SCALE // 100
+    records['bid_px_00'] = records['price'][top] - half_spread
+    records['ask_px_00'] = records['price'][top] + half_spread
+    records['bid_sz_00'] = sizes[0][top]
+    records['ask_sz_00'] = sizes[1][top]
+    records['bid_ct_00'] = 1
+    records['ask_ct_00'] = 1
+    return records
+
+def make_dbn(symbols, start_date, end_date, schema='ohlcv-1d', seed=0, trades_per_day=10_000):
+    """
+    Generates an uncompressed DBN stream for the symbols over [start_date, end_date).
+    Returns:
+        bytes: Metadata followed by the records of every symbol in ts_event order.
+    """
+    symbols = [symbols] if isinstance(symbols, str) else list(symbols)
+    start_date, end_date = pd.Timestamp(start_date), pd.Timestamp(end_date)
+    parts, mappings = [], []
+    for i, symbol in enumerate(symbols):
+        instrument_id = FIRST_INSTRUMENT_ID + i
+        if schema == 'trades':
+            parts.append(make_trade_records(symbol, instrument_id, start_date, end_date, trades_per_day, seed))
+        elif schema == 'mbp-1':
+            parts.append(make_mbp1_records(symbol, instrument_id, start_date, end_date, trades_per_day, seed))
+        else:
+            parts.append(make_ohlcv_records(symbol, instrument_id, start_date, end_date, schema, seed))
+        mappings.append(SimpleNamespace(raw_symbol=symbol, intervals=[SimpleNamespace(
+            start_date=start_date.date(), end_date=end_date.date(), symbol=str(instrument_id))]))
+    records = np.concatenate(parts) if parts else np.zeros(0, dtype=OHLCV_DTYPE)
+    records = records[np.argsort(records['ts_event'], kind='stable')]
+
+    metadata = dbn.Metadata(
+        dataset='XNAS.ITCH', start=start_date.tz_localize('UTC').value, stype_in=dbn.SType.RAW_SYMBOL,
+        stype_out=dbn.SType.INSTRUMENT_ID, schema=SCHEMAS[schema][0], symbols=symbols, mappings=mappings,
+        end=end_date.tz_localize('UTC').value
+    )
+    return metadata.encode() + records.tobytes()
+
+class _FakeTimeseries:
+    def __init__(self, seed, trades_per_day):
+        self.seed = seed
+        self.trades_per_day = trades_per_day
+        self.calls = []
+
+    def get_range(self, dataset, symbols, start, end, schema='trades', path=None, **kwargs):
+        self.calls.append({'dataset': dataset, 'symbols': symbols, 'start': start, 'end': end, 'schema': schema})
+        data = make_dbn(symbols, start, end, schema, self.seed, self.trades_per_day)
+        if path is not None:
+            with open(path, 'wb') as f:
+                f.write(data)
+            return db.DBNStore.from_file(path)
+        return db.DBNStore.from_bytes(data)
+
+class _FakeSymbology:
+    def __init__(self):
+        self.calls = []
+
+    def resolve(self, dataset, symbols, stype_in, stype_out, start_date, end_date=None):
+        # Same instrument_ids as make_dbn gives a request for these symbols
+        symbols = [symbols] if isinstance(symbols, str) else list(symbols)
+        self.calls.append({'dataset': dataset, 'symbols': symbols, 'start_date': start_date, 'end_date': end_date})
+        result = {symbol: [{'d0': str(start_date), 'd1': str(end_date), 's': str(FIRST_INSTRUMENT_ID + i)}]
+                  for i, symbol in enumerate(symbols)}
+        return {'result': result, 'symbols': symbols, 'stype_in': stype_in, 'stype_out': stype_out,
+                'start_date': str(start_date), 'end_date': str(end_date), 'partial': [], 'not_found': []}
+
+class _FakeMetadata:
+    # Illustrative flat prices in dollars per GB of records
+    PRICE_PER_GB = {'trades': 40.0, 'mbp-1': 40.0}
+    DEFAULT_PRICE_PER_GB = 10.0
+    # Records per symbol and weekday, see the sizes in the module docstring
+    RECORDS_PER_DAY = {'ohlcv-1d': 1, 'ohlcv-1h': 7, 'ohlcv-1m': 390}
+
+    def __init__(self, trades_per_day):
+        self.trades_per_day = trades_per_day
+        self.calls = []
+
+    def get_record_count(self, dataset, start, end=None, symbols=None, schema='trades', **kwargs):
+        # Exactly the number of records make_dbn generates for the same request
+        self.calls.append({'method': 'get_record_count', 'symbols': symbols, 'start': start, 'end': end, 'schema': schema})
+        symbol_count = 1 if isinstance(symbols, str) else len(symbols)
+        weekdays = int(np.busday_count(pd.Timestamp(start).date(), pd.Timestamp(end).date()))
+        return symbol_count * weekdays * self.RECORDS_PER_DAY.get(schema, self.trades_per_day)
+
+    def get_cost(self, dataset, start, end=None, symbols=None, schema='trades', **kwargs):
+        records = self.get_record_count(dataset, start, end, symbols, schema)
+        self.calls[-1]['method'] = 'get_cost'
+        record_size = {'trades': TRADE_DTYPE, 'mbp-1': MBP1_DTYPE}.get(schema, OHLCV_DTYPE).itemsize
+        return records * record_size / 1e9 * self.PRICE_PER_GB.get(schema, self.DEFAULT_PRICE_PER_GB)
+
+class FakeHistorical:
+    """
+    Stand-in for db.Historical serving generated DBN data, see databento_fetch.set_client.
+    timeseries.calls, metadata.calls and symbology.calls record every request.
+    """
+    def __init__(self, seed=0, trades_per_day=10_000):
+        self.timeseries = _FakeTimeseries(seed, trades_per_day)
+        self.metadata = _FakeMetadata(trades_per_day)
+        self.symbology = _FakeSymbology()
+
+def symbols(count):
+    """
+    Returns count synthetic ticker symbols (SYM0000, SYM0001, ...).
+    """
+    return [f'SYM{i:04d}' for i in range(count)]
@@ -0,0 +1,217 @@
+import pandas as pd
+import numpy as np
+from pandas.tseries.holiday import (
+    AbstractHolidayCalendar, Holiday, GoodFriday, USMartinLutherKingJr, USPresidentsDay,
+    USMemorialDay, USLaborDay, USThanksgivingDay, nearest_workday,
+)
+from pathlib import Path
+import json
+import os
+
+try:
+    import pandas_market_calendars as mcal
+except ImportError:
+    mcal = None
+
+'''
+Gap-aware coverage manifest for vendor downloads.
+For every symbol and schema a small JSON sidecar records the date intervals that have already been
+requested from Data Bento: {folder}/{ticker}_{schema}.coverage.json -> [["2023-01-03", "2023-12-29"], ...]
+The missing sub-ranges of a request are worked out against the NYSE trading calendar, so weekends and
+holidays never count as holes and only the exact missing ranges are fetched.
+
+Requested dates are only marked covered up to the trading date data last came back for (see session_date), or up to the last settled date
+(databento_settle_days before today in New York, default 1) when that is later, so a top-up asking for a session
+Data Bento has not published yet requests it again next time instead of recording an empty day as fetched.
+
+pandas_market_calendars is used for the calendar when installed, otherwise the NYSE full-day holidays
+are built from pandas' holiday rules.
+'''
+
+# Days after a session by which Data Bento has published it, so an empty answer for it is final
+SETTLE_DAYS = int(os.getenv('databento_settle_days', 1))
+
+class NYSEHolidayCalendar(AbstractHolidayCalendar):
+    """
+    NYSE full-day market holidays (fallback when pandas_market_calendars is not installed).
+    """
+    rules = [
+        Holiday('New Years Day', month=1, day=1, observance=nearest_workday),
+        USMartinLutherKingJr,
+        USPresidentsDay,
+        GoodFriday,
+        USMemorialDay,
+        Holiday('Juneteenth', month=6, day=19, start_date='2022-01-01', observance=nearest_workday),
+        Holiday('Independence Day', month=7, day=4, observance=nearest_workday),
+        USLaborDay,
+        USThanksgivingDay,
+        Holiday('Christmas Day', month=12, day=25, observance=nearest_workday),
+    ]
+
+def trading_days(start_date, end_date):
+    """
+    Returns the NYSE trading days between two dates, inclusive.
+    Args:
+        start_date (datetime-like): First date.
+        end_date (datetime-like): Last date.
+    Returns:
+        pd.DatetimeIndex: tz-naive trading dates.
+    """
+    start = pd.Timestamp(start_date).tz_localize(None).normalize()
+    end = pd.Timestamp(end_date).tz_localize(None).normalize()
+    if mcal is not None:
+        return pd.DatetimeIndex(mcal.get_calendar('XNYS').valid_days(start, end)).tz_localize(None)
+
+    holidays = NYSEHolidayCalendar().holidays(start, end)
+    # New Year's Day falling on a Saturday is not observed on the prior Friday
+    holidays = holidays[~((holidays.month == 12) & (holidays.day == 31))]
+    return pd.bdate_range(start, end, freq='C', holidays=holidays)
+
+def _runs(days, mask):
+    # Groups consecutive trading days where mask is True into (first, last) pairs
+    runs = []
+    start = None
+    for i, flag in enumerate(mask):
+        if flag and start is None:
+            start = i
+        elif not flag and start is not None:
+            runs.append((days[start], days[i - 1]))
+            start = None
+    if start is not None:
+        runs.append((days[start], days[len(mask) - 1]))
+    return runs
+
+def _is_covered(days, intervals):
+    covered = np.zeros(len(days), dtype=bool)
+    for start, end in intervals:
+        covered |= (days >= start) & (days <= end)
+    return covered
+
+def merge_intervals(intervals):
+    """
+    Merges overlapping intervals and intervals separated only by non-trading days.
+    Args:
+        intervals (list): (start, end) pairs of dates, inclusive.
+    Returns:
+        list: Sorted, non-overlapping (start, end) pd.Timestamp pairs.
+    """
+    merged = []
+    for start, end in sorted((pd.Timestamp(s), pd.Timestamp(e)) for s, e in intervals):
+        if merged and (start <= merged[-1][1] + pd.Timedelta(days=1)
+                       or len(trading_days(merged[-1][1] + pd.Timedelta(days=1), start - pd.Timedelta(days=1))) == 0):
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+def intervals_from_dates(dates):
+    """
+    Builds coverage intervals from the dates present in existing data, bridging weekends and holidays.
+    Used to seed a manifest for data downloaded before manifests existed.
+    Args:
+        dates (pd.DatetimeIndex): Dates with data.
+    Returns:
+        list: (start, end) pd.Timestamp pairs.
+    """
+    if dates is None or len(dates) == 0:
+        return []
+    present = pd.DatetimeIndex(dates).tz_localize(None).normalize().unique()
+    days = trading_days(present.min(), present.max())
+    return merge_intervals(_runs(days, days.isin(present)))
+
+def missing_ranges(intervals, start_date, end_date):
+    """
+    Works out the trading-day ranges of a request that are not covered yet.
+    Args:
+        intervals (list): Covered (start, end) date pairs.
+        start_date (datetime-like): First requested date.
+        end_date (datetime-like): Last requested date, inclusive.
+    Returns:
+        list: (start, end) pd.Timestamp pairs, inclusive, each starting and ending on a trading day.
+    """
+    days = trading_days(start_date, end_date)
+    return _runs(days, ~_is_covered(days, intervals))
+
+def coverage_path(ticker, schema, folder):
+    return Path(folder) / f'{ticker}_{schema}.coverage.json'
+
+def load_coverage(ticker, schema, folder):
+    """
+    Reads the covered intervals for a symbol and schema.
+    Returns:
+        list: (start, end) pd.Timestamp pairs, or None if no manifest exists yet.
+    """
+    path = coverage_path(ticker, schema, folder)
+    if not path.exists():
+        return None
+    with open(path) as f:
+        return [(pd.Timestamp(start), pd.Timestamp(end)) for start, end in json.load(f)]
+
+def save_coverage(ticker, schema, folder, intervals):
+    """
+    Writes the covered intervals for a symbol and schema, merged and sorted.
+    """
+    path = coverage_path(ticker, schema, folder)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump([[s.strftime('%Y-%m-%d'), e.strftime('%Y-%m-%d')] for s, e in merge_intervals(intervals)], f)
+
+def settled_date(today=None):
+    """
+    Returns the last date whose data is published by now: today in New York minus SETTLE_DAYS.
+    """
+    today = pd.Timestamp.now(tz='America/New_York') if today is None else pd.Timestamp(today)
+    today = today.tz_localize(None) if today.tzinfo is None else today.tz_convert('America/New_York').tz_localize(None)
+    return today.normalize() - pd.Timedelta(days=SETTLE_DAYS)
+
+def last_event(df, last=None):
+    """
+    Returns the later of last and the last ts_event (index or column) of a DataFrame, as a UTC timestamp.
+    """
+    if df is None or len(df) == 0:
+        return last
+    ts = df.index if df.index.name == 'ts_event' else df['ts_event']
+    latest = pd.Timestamp(pd.to_datetime(ts, utc=True).max())
+    return latest if last is None else max(latest, last)
+
+def session_date(ts_event, schema='ohlcv-1d'):
+    """
+    Returns the trading date a ts_event belongs to, tz-naive. Daily bars are stamped at UTC midnight of their session;
+    every other record falls on its New York date, so an extended-hours bar after 20:00 ET stays on its session.
+    """
+    ts = pd.Timestamp(ts_event)
+    ts = ts.tz_localize('UTC') if ts.tzinfo is None else ts
+    return ts.tz_convert('UTC' if schema == 'ohlcv-1d' else 'America/New_York').tz_localize(None).normalize()
+
+def received_ranges(ranges, last_received=None, settled=None, schema='ohlcv-1d'):
+    """
+    Clips requested ranges to the dates that may be marked covered: up to the trading date (see session_date) of the
+    last record received, or up to the settled date when that is later. Later dates may not be published yet.
+    Args:
+        ranges (list): (start, end) date pairs that were requested.
+        last_received (datetime-like, optional): Last ts_event received, None when nothing came back.
+        settled (datetime-like, optional): Last settled date. Defaults to settled_date().
+        schema (str): Data Bento schema of the records. Defaults to 'ohlcv-1d'.
+    Returns:
+        list: (start, end) pd.Timestamp pairs.
+    """
+    limit = pd.Timestamp(settled) if settled is not None else settled_date()
+    if last_received is not None:
+        limit = max(limit, session_date(last_received, schema))
+    return [(pd.Timestamp(start), min(pd.Timestamp(end), limit)) for start, end in ranges if pd.Timestamp(start) <= limit]
+
+def mark_covered(ticker, schema, folder, ranges, intervals=None, last_received=None):
+    """
+    Adds fetched ranges to a symbol's manifest and saves it, clipped by received_ranges so dates that may not be
+    published yet are left missing.
+    Args:
+        ranges (list): (start, end) date pairs that were fetched.
+        intervals (list, optional): Current intervals, read from the manifest when not given.
+        last_received (datetime-like, optional): Last ts_event received for the ranges, None when nothing came back.
+    """
+    ranges = received_ranges(ranges, last_received, schema=schema)
+    if not ranges:
+        return
+    if intervals is None:
+        intervals = load_coverage(ticker, schema, folder) or []
+    save_coverage(ticker, schema, folder, list(intervals) + list(ranges))
@@ -1,272 +1,200 @@
-import databento as db
 import pandas as pd
-import numpy as np
-from datetime import datetime, timedelta
+from datetime import timedelta
+from typing import Optional
+import hashlib
+import re
 import os
-from sqlalchemy import create_engine, inspect
-from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy.types import BigInteger, DateTime, Float
-import zipfile
-from sqlalchemy.types import TIMESTAMP
-import pytz
+import yaml
+from dagster import (
+    asset, op, job, sensor, AssetDep, AssetExecutionContext, AutomationCondition, BackfillPolicy, Config, Definitions,
+    DynamicOut, DynamicOutput, DynamicPartitionsDefinition, MaterializeResult, MultiPartitionKey,
+    MultiPartitionsDefinition, MultiToSingleDimensionPartitionMapping, RunRequest, SensorEvaluationContext,
+    SkipReason, TimeWindowPartitionsDefinition, define_asset_job
+)
+from databento_fetch import dbn_cache_path
+from request_planner import get_range_planned, plan_path
+from coverage_manifest import intervals_from_dates, load_coverage, missing_ranges
+from databento_sql import (COVERAGE_FOLDER, get_coverage, fetch_missing_data, store_fetched_data, convert_stored_data)
+from resolution import source_schema
 
-from dagster import op, job
-
-''' 
+'''
 Dagster version of databento_sql.py
-WIP 29SEP24
+The pipeline is modelled as software-defined assets partitioned by trading date and ticker:
+    databento_dbn   - native DBN responses kept in the DBN cache          (date x ticker)
+    postgres_ohlcv  - rows upserted into databento_ohlcv.{ticker}         (date x ticker)
+    lean_export     - the ticker's LEAN zip, rebuilt when its rows change (ticker)
+Tickers are dynamic partitions, added by refresh_tickers_job or the Dagster UI. stale_partitions_sensor requests runs
+only for the (date, ticker) partitions missing from the coverage manifests, one run per contiguous date range.
+refresh_tickers_job fans out over a ticker list with DynamicOutput so tickers run in parallel on the executor,
+it is driven by run_config.yaml.
 '''
 
-@op
-def get_data_from_databento(ticker, start_date, end_date) -> pd.DataFrame:
-    """
-    Fetches OHLCV data for a given ticker from Data Bento for the specified date range.
-    """
-    client = db.Historical(os.getenv('databento_api_key'))
-    dataset = client.timeseries.get_range(
-        dataset="XNAS.ITCH",
-        symbols=ticker,
-        start=start_date.strftime('%Y-%m-%d'),
-        end=end_date.strftime('%Y-%m-%d'),
-        schema='ohlcv-1d'
-    )
-    df = dataset.to_df()
-
-    # Identify uint64 columns. If a number is a decimal then convert to float64.
-    uint64_cols = df.select_dtypes(include=['uint64']).columns.tolist()
-    if uint64_cols:
-        print(f"Converting uint64 columns to int64: {uint64_cols}")
-        # Ensure values are within int64 range
-        for col in uint64_cols:
-            if df[col].max() > np.iinfo('int64').max:
-                print(f"Warning: Values in column {col} exceed int64 range. Converting to float.")
-                df[col] = df[col].astype('float64')
-            else:
-                df[col] = df[col].astype('int64')
+# Folder the databento_dbn asset keeps its responses in
+DBN_CACHE_ROOT = os.getenv('databento_dbn_cache', 'databento/dbn')
+PARTITION_START = os.getenv('dagster_partition_start', '2023-01-02')
 
-    # Ensure ts_event is not the index
-    if df.index.name == 'ts_event':
-        df.reset_index(inplace=True)
+TICKER_PARTITIONS = DynamicPartitionsDefinition(name='tickers')
+# One partition per weekday in exchange time, exchange holidays are skipped inside the assets
+DATE_PARTITIONS = TimeWindowPartitionsDefinition(cron_schedule='0 0 * * 1-5', start=PARTITION_START, fmt='%Y-%m-%d',
+                                                 timezone='America/New_York')
+DATE_TICKER_PARTITIONS = MultiPartitionsDefinition({'date': DATE_PARTITIONS, 'ticker': TICKER_PARTITIONS})
 
-    return df
-
-def upload_to_postgresql(df, ticker, schema='databento_ohlcv'):
+def partition_ranges(partition_keys):
     """
-    Uploads a DataFrame to a PostgreSQL database using SQLAlchemy.
-    Ensures that ts_event is included as a standard column.
+    Groups (date, ticker) partition keys into contiguous trading-day ranges per ticker,
+    so a backfill over many partitions makes one Data Bento request per range.
+    Returns:
+        dict: ticker -> list of (start, end) pd.Timestamp pairs, inclusive. Holidays give no range.
     """
-    # Ensure ts_event is a column and not the index
-    if 'ts_event' not in df.columns:
-        df.reset_index(inplace=True)
-
-    # Fetch credentials from environment variables
-    pguser = os.getenv('pguser')
-    pgpass = os.getenv('pgpass')
-    pghost = os.getenv('pghost')
-
-    # Database connection URL using environment variables
-    db_url = f'postgresql://{pguser}:{pgpass}@{pghost}/FinancialData'
-    engine = create_engine(db_url)
-
-    try:
-        # Define data types for SQL columns
-        dtype = {
-            'ts_event': TIMESTAMP(timezone=True),
-            'open': Float(),
-            'high': Float(),
-            'low': Float(),
-            'close': Float(),
-            'volume': BigInteger(),
-            # Add other columns if necessary
-        }
-
-        # Write the DataFrame to the PostgreSQL table
-        df.to_sql(ticker, engine, schema=schema, if_exists='replace', index=False, dtype=dtype)
-        print(f"Data for {ticker} uploaded successfully to {schema}.{ticker}.")
-    except SQLAlchemyError as e:
-        print(f"Error uploading data for {ticker} to PostgreSQL: {e}")
-    finally:
-        engine.dispose()
-
-def get_existing_dates_from_postgresql(ticker, schema='databento_ohlcv'):
+    dates = {}
+    for key in partition_keys:
+        dims = key.keys_by_dimension
+        dates.setdefault(dims['ticker'], []).append(pd.Timestamp(dims['date']))
+    return {ticker: intervals_from_dates(pd.DatetimeIndex(days)) for ticker, days in dates.items()}
+
+def _request_end(end):
+    # Data Bento's end date is exclusive, so each range is requested through the following day
+    return end + timedelta(days=1)
+
+@asset(partitions_def=DATE_TICKER_PARTITIONS, backfill_policy=BackfillPolicy.single_run(), group_name='databento')
+def databento_dbn(context: AssetExecutionContext) -> MaterializeResult:
     """
-    Retrieves the existing dates for a given ticker from PostgreSQL database.
+    Native DBN responses for the partitions, fetched again when materialised.
     """
-    # Fetch credentials from environment variables
-    pguser = os.getenv('pguser')
-    pgpass = os.getenv('pgpass')
-    pghost = os.getenv('pghost')
-
-    # Database connection URL using environment variables
-    db_url = f'postgresql://{pguser}:{pgpass}@{pghost}/FinancialData'
-    engine = create_engine(db_url)
-
-    try:
-        # Check if table exists
-        inspector = inspect(engine)
-        tables = inspector.get_table_names(schema=schema)
-        if ticker in tables:
-            # Table exists, retrieve existing dates
-            query = f'SELECT DISTINCT ts_event::date FROM "{schema}"."{ticker}"'
-            df_existing = pd.read_sql(query, con=engine)
-            df_existing['ts_event'] = pd.to_datetime(df_existing['ts_event'],utc=True)
-            dates = pd.DatetimeIndex(df_existing['ts_event'].sort_values())
-            return dates
-        else:
-            return None
-    except Exception as e:
-        print(f"Error retrieving existing dates for {ticker}: {e}")
-        return None
-    finally:
-        engine.dispose()
-
-def get_data_from_postgresql(ticker, start_date=None, end_date=None, schema='databento_ohlcv'):
+    files = []
+    for ticker, ranges in partition_ranges(context.partition_keys).items():
+        for start, end in ranges:
+            # Long backfills are cost-checked and fetched as bounded chunk files, with their plan next to them
+            stores = get_range_planned(ticker, start, _request_end(end), schema='ohlcv-1d', cache_root=DBN_CACHE_ROOT,
+                                       refresh=True)
+            path = plan_path(ticker, start, _request_end(end), 'ohlcv-1d', root=DBN_CACHE_ROOT)
+            if stores:
+                # Nothing is written for a ticker without an instrument_id over the range
+                files.append(str(path if path.exists() else
+                                 dbn_cache_path(ticker, start, _request_end(end), 'ohlcv-1d', cache_root=DBN_CACHE_ROOT)))
+            context.log.debug(f'{ticker} {start.date()} to {end.date()}: {len(stores)} DBN file(s)')
+    context.log.info(f'{len(files)} DBN request(s) written to {DBN_CACHE_ROOT}')
+    return MaterializeResult(metadata={'files': files})
+
+@asset(partitions_def=DATE_TICKER_PARTITIONS, backfill_policy=BackfillPolicy.single_run(), group_name='databento',
+       deps=[databento_dbn])
+def postgres_ohlcv(context: AssetExecutionContext) -> MaterializeResult:
     """
-    Retrieves data for a given ticker from PostgreSQL database, optionally within a date range.
+    Upserts the partitions' DBN responses into databento_ohlcv.{ticker} and marks them covered.
     """
-    # Fetch credentials from environment variables
-    pguser = os.getenv('pguser')
-    pgpass = os.getenv('pgpass')
-    pghost = os.getenv('pghost')
-
-    # Database connection URL using environment variables
-    db_url = f'postgresql://{pguser}:{pgpass}@{pghost}/FinancialData'
-    engine = create_engine(db_url)
-
-    try:
-        # Build the query
-        query = f'SELECT * FROM "{schema}"."{ticker}"'
-        if start_date is not None and end_date is not None:
-            query += f" WHERE ts_event BETWEEN '{start_date.strftime('%Y-%m-%d')}' AND '{end_date.strftime('%Y-%m-%d')}'"
-        df = pd.read_sql(query, con=engine)
-        
-        # Ensure ts_event is parsed as timezone-aware datetime
-        df['ts_event'] = pd.to_datetime(df['ts_event'], utc=True)
-        
-        return df
-    except Exception as e:
-        print(f"Error retrieving data for {ticker} from PostgreSQL: {e}")
-        return None
-    finally:
-        engine.dispose()
-
-def convert_to_lean_format(df, ticker, frequency='daily'):
-    # Convert 'ts_event' to America/New_York timezone and required date format
-    df['date'] = df['ts_event'].dt.tz_convert('America/New_York').dt.strftime('%Y%m%d %H:%M')
-
-    # Select required columns without copying
-    df = df[['date', 'open', 'high', 'low', 'close', 'volume']]
-
-    # Use .loc for assignment to avoid the warning
-    df.loc[:, ['open', 'high', 'low', 'close']] = (df[['open', 'high', 'low', 'close']] * 10000).astype(int)
-
-    # Data type sorting for directory saving for csv
-    if frequency == 'daily':
-        output_dir = 'data/equity/usa/daily/'
-        output_file = f"{output_dir}{ticker.lower()}.csv"
-    elif frequency == 'hourly':
-        output_dir = 'data/equity/usa/hourly/'
-        output_file = f"{output_dir}{ticker.lower()}.csv"
-    else:
-        output_dir = 'data/equity/usa/minute/'
-        output_file = f"{output_dir}{ticker.lower()}.csv"
-
-    # Ensure the output directory exists
-    os.makedirs(output_dir, exist_ok=True)
-
-    df.to_csv(output_file, index=False, header=False)
-
-    # Zip the CSV file
-    zip_file = os.path.join(output_dir, f'{ticker.lower()}.zip')
-    with zipfile.ZipFile(zip_file, 'w') as zf:
-        zf.write(output_file, arcname=f'{ticker.lower()}.csv')
-
-    # Optionally, remove the csv file after zipping (if you want the zip to be the only output)
-    # os.remove(output_file)
-
-    print(f"{output_file} has been successfully zipped into {zip_file}.")
-
-def download_and_append_data(ticker, start_date, end_date, frequency='daily'):
+    ranges = partition_ranges(context.partition_keys)
+    for ticker, ticker_ranges in ranges.items():
+        # Replayed from the files databento_dbn wrote, the same ranges are derived from the same partitions
+        stores = [store for start, end in ticker_ranges
+                  for store in get_range_planned(ticker, start, _request_end(end), schema='ohlcv-1d', cache_root=DBN_CACHE_ROOT)]
+        store_fetched_data(ticker, (ticker_ranges, get_coverage(ticker), stores))
+    return MaterializeResult(metadata={'tickers': len(ranges)})
+
+class LeanExportConfig(Config):
+    frequency: str = 'daily'
+    # 'pandas' or 'polars', unset uses the lean_engine environment variable
+    engine: Optional[str] = None
+
+@asset(partitions_def=TICKER_PARTITIONS, group_name='databento', automation_condition=AutomationCondition.eager(),
+       deps=[AssetDep(postgres_ohlcv, partition_mapping=MultiToSingleDimensionPartitionMapping(partition_dimension_name='ticker'))])
+def lean_export(context: AssetExecutionContext, config: LeanExportConfig) -> MaterializeResult:
     """
-    Downloads and appends stock data from Data Bento API if necessary, then converts the data to LEAN format.
+    Converts everything stored for the ticker to LEAN format.
     """
-    # Convert start_date and end_date to datetime objects
-    start_date = pd.to_datetime(start_date)
-    end_date = pd.to_datetime(end_date)
-    
-    # Localize the datetime to NY time (exchange time zone)
-    start_date = start_date.tz_localize('America/New_York').astimezone(pytz.utc)
-    end_date = end_date.tz_localize('America/New_York').astimezone(pytz.utc)
-
-    # Fetch existing dates from PostgreSQL
-    dates = get_existing_dates_from_postgresql(ticker)
-    
-    # Ensure dates are in UTC
-    if dates is not None:
-        dates = dates.tz_convert('UTC')
-    
-    # If dates is None or date range is not covered
-    if dates is None or start_date.date() < dates[0].date() or end_date.date() > dates[-1].date():
-        print(f'Fetching data for {ticker} from {start_date.date()} to {end_date.date()}')
-
-        # Attempt to fetch new data from Data Bento
-        try:
-            # Add buffer (delta) to the date range to handle overlaps
-            delta = timedelta(days=3)
-            df_new = get_data_from_databento(ticker, start_date - delta, end_date + delta)
-
-            # Ensure ts_event is not set as index
-            if df_new.index.name == 'ts_event':
-                df_new.reset_index(inplace=True)
-
-            # If data exists in the database, append new data
-            if dates is not None:
-                # Fetch existing data
-                df_existing = get_data_from_postgresql(ticker)
-                df_existing['ts_event'] = pd.to_datetime(df_existing['ts_event'], utc=True)
-                # Ensure ts_event is not set as index
-                if df_existing.index.name == 'ts_event':
-                    df_existing.reset_index(inplace=True)
+    ticker = context.partition_key
+    intervals = load_coverage(ticker, 'ohlcv-1d', COVERAGE_FOLDER) or []
+    if not intervals:
+        raise ValueError(f'No data stored for {ticker}')
+    convert_stored_data(ticker, intervals[0][0], intervals[-1][1], config.frequency, max_workers=1, engine=config.engine)
+    return MaterializeResult(metadata={'start': str(intervals[0][0].date()), 'end': str(intervals[-1][1].date())})
 
-                # Combine data and remove duplicates based on ts_event
-                df_combined = pd.concat([df_existing, df_new], ignore_index=True)
-                df_combined.drop_duplicates(subset='ts_event', keep='last', inplace=True)
-                df_combined['ts_event'] = pd.to_datetime(df_combined['ts_event'], utc=True)
-                df_combined.sort_values(by='ts_event', inplace=True)
-                # Upload the amended data to PostgreSQL
-                upload_to_postgresql(df_combined, ticker)
-            else:
-                # Upload the new data to PostgreSQL
-                upload_to_postgresql(df_new, ticker)
-            print(f'Ticker {ticker} data updated in PostgreSQL')
+ohlcv_partitions_job = define_asset_job('ohlcv_partitions_job', selection=[databento_dbn, postgres_ohlcv])
 
-        except Exception as e:
-            print(f'Error fetching data for {ticker}: {e}')
-            return None
-    else:
-        print(f'Ticker {ticker} already up-to-date')
+@sensor(job=ohlcv_partitions_job, minimum_interval_seconds=3600)
+def stale_partitions_sensor(context: SensorEvaluationContext):
+    """
+    Requests ohlcv_partitions_job runs for the partitions missing from each ticker's coverage manifest,
+    one run per contiguous date range, so nothing already fetched is materialised again. A range still missing
+    once the coverage changed or a new date partition appeared is requested again.
+    """
+    tickers = context.instance.get_dynamic_partitions(TICKER_PARTITIONS.name)
+    last_date = DATE_PARTITIONS.get_last_partition_key()
+    if not tickers or last_date is None:
+        return SkipReason('No ticker or date partitions yet')
+
+    requests = []
+    for ticker in tickers:
+        intervals = get_coverage(ticker)
+        # Run keys carry the coverage state and the latest date partition: a range is requested once per state, and
+        # again the next day when its run failed or brought nothing back (e.g. a session not published yet)
+        state = hashlib.sha1(repr([(str(a.date()), str(b.date())) for a, b in intervals]).encode()).hexdigest()[:12]
+        for start, end in missing_ranges(intervals, pd.Timestamp(PARTITION_START), pd.Timestamp(last_date)):
+            first = MultiPartitionKey({'date': start.strftime('%Y-%m-%d'), 'ticker': ticker})
+            last = MultiPartitionKey({'date': end.strftime('%Y-%m-%d'), 'ticker': ticker})
+            requests.append(RunRequest(
+                run_key=f'{ticker}:{first.keys_by_dimension["date"]}:{last.keys_by_dimension["date"]}:{state}:{last_date}',
+                tags={'dagster/asset_partition_range_start': first, 'dagster/asset_partition_range_end': last}
+            ))
+    return requests or SkipReason('All partitions are covered')
+
+class RefreshTickersConfig(Config):
+    tickers: list[str]
+    start_date: str
+    end_date: str
+    frequency: str = 'daily'
+    engine: Optional[str] = None
+    # Finer resolution to fetch and aggregate from, e.g. 'minute', unset uses lean_source_resolution
+    source: Optional[str] = None
+
+@op(out=DynamicOut(dict))
+def fan_out_tickers(context, config: RefreshTickersConfig):
+    """
+    Registers the tickers as partitions and emits one DynamicOutput per ticker.
+    """
+    known = set(context.instance.get_dynamic_partitions(TICKER_PARTITIONS.name))
+    new = [ticker for ticker in dict.fromkeys(config.tickers) if ticker not in known]
+    if new:
+        context.instance.add_dynamic_partitions(TICKER_PARTITIONS.name, new)
+    for ticker in dict.fromkeys(config.tickers):
+        # Mapping keys only allow letters, digits and underscores (e.g. BRK.B -> BRK_B)
+        yield DynamicOutput(
+            {'ticker': ticker, 'start_date': config.start_date, 'end_date': config.end_date, 'frequency': config.frequency,
+             'engine': config.engine, 'source': config.source},
+            mapping_key=re.sub(r'\W', '_', ticker)
+        )
 
-    # Fetch the data from PostgreSQL for the required date range
-    df = get_data_from_postgresql(ticker, start_date, end_date)
-    if df is not None and not df.empty:
-        # Ensure ts_event is not set as index
-        if df.index.name == 'ts_event':
-            df.reset_index(inplace=True)
+@op
+def refresh_ticker(context, request: dict) -> str:
+    """
+    Fetches the missing ranges, upserts them and converts the ticker to LEAN format.
+    A failure fails only this ticker's step.
+    """
+    ticker = request['ticker']
+    schema = source_schema(request['frequency'], request['source'])
+    fetched = fetch_missing_data(ticker, request['start_date'], request['end_date'], schema)
+    context.log.info(f'{ticker}: {len(fetched[0])} missing {schema} range(s)')
+    store_fetched_data(ticker, fetched, schema)
+    convert_stored_data(ticker, request['start_date'], request['end_date'], request['frequency'], max_workers=1,
+                        engine=request['engine'], source=request['source'])
+    return ticker
 
-        # Ensure ts_event is timezone-aware
-        df['ts_event'] = pd.to_datetime(df['ts_event'], utc=True)
+@op
+def summarize_refresh(context, tickers: list) -> list:
+    context.log.info(f'{len(tickers)} ticker(s) refreshed: {", ".join(tickers)}')
+    return tickers
 
-        # Convert to LEAN format
-        convert_to_lean_format(df, ticker, frequency)
-        print(f'Data for {ticker} fetched from postgres, converted to LEAN format.')
-    else:
-        print(f"No data available for {ticker} to convert.")
-        return None
+@job
+def refresh_tickers_job():
+    summarize_refresh(fan_out_tickers().map(refresh_ticker).collect())
 
-    return ticker
+defs = Definitions(
+    assets=[databento_dbn, postgres_ohlcv, lean_export],
+    jobs=[ohlcv_partitions_job, refresh_tickers_job],
+    sensors=[stale_partitions_sensor],
+)
 
-# Example ticker list and date range
+# Example ticker list and date range, see run_config.yaml
 if __name__ == '__main__':
-    ticker_list = ['QQQ']
-    for ticker in ticker_list:
-        download_and_append_data(ticker, '2023-09-01', '2023-12-31', frequency='daily')
+    with open('run_config.yaml') as f:
+        run_config = yaml.safe_load(f)
+    refresh_tickers_job.execute_in_process(run_config=run_config)
@@ -0,0 +1,216 @@
+import databento as db
+import pandas as pd
+import numpy as np
+from pathlib import Path
+import hashlib
+import time
+import os
+from instrumentation import span, record
+from symbology import record_dbn_mappings
+
+'''
+Shared Data Bento client and batched multi-symbol fetches.
+One Historical client is created per process and reused by every request.
+A batch of tickers is requested with as few timeseries.get_range calls as the symbol limit allows,
+then split back into one DataFrame per ticker.
+
+Responses can also be kept as native .dbn.zst files (set the databento_dbn_cache environment variable to a folder,
+or pass cache_root). A cached request is replayed from disk with DBNStore.from_file instead of the network, and
+iter_dbn_frames / iter_dbn_arrays decode it in fixed-size record batches so no full pandas copy is held.
+The symbol mappings of every network response are added to the local symbology cache (symbology.py).
+
+Decoded prices are float dollars by default. With databento_price_type=fixed they stay DBN's int64 fixed-point
+(1e-9 dollars) through the raw store and PostgreSQL (BIGINT columns), and the LEAN writers derive deci-cents with
+one integer division instead of a float multiply and truncation (lean_writer.to_deci_cents).
+'''
+
+DATABENTO_DATASET = 'XNAS.ITCH'
+# Data Bento accepts up to 2,000 symbols per timeseries request
+MAX_SYMBOLS_PER_REQUEST = 2000
+
+# Records decoded per batch when iterating a DBN store
+DBN_CHUNK_RECORDS = 250_000
+
+# Price representations of decoded records: float dollars or DBN's int64 fixed-point, 1e-9 dollars per unit
+PRICE_TYPES = ('float', 'fixed')
+FIXED_PRICE_SCALE = 1_000_000_000
+PRICE_COLUMNS = ['open', 'high', 'low', 'close']
+
+_client = None
+
+def get_client():
+    """
+    Returns the process-wide Data Bento Historical client, creating it on first use.
+    Returns:
+        db.Historical: The shared client.
+    """
+    global _client
+    if _client is None:
+        _client = db.Historical(os.getenv('databento_api_key'))
+    return _client
+
+def set_client(client):
+    """
+    Replaces the shared client, e.g. with a local fake that serves canned DBN data.
+    Args:
+        client: Any object exposing timeseries.get_range like db.Historical. None resets to lazy creation.
+    """
+    global _client
+    _client = client
+
+def get_price_type(price_type=None):
+    """
+    Returns price_type, or the databento_price_type environment variable, or 'float'.
+    """
+    price_type = price_type or os.getenv('databento_price_type', 'float')
+    if price_type not in PRICE_TYPES:
+        raise ValueError(f"Unknown price type {price_type!r}, expected one of {PRICE_TYPES}")
+    return price_type
+
+def to_df(store, count=None, price_type=None):
+    """
+    Decodes a DBN store like DBNStore.to_df(), with prices in the representation picked by get_price_type.
+    """
+    return store.to_df(price_type=get_price_type(price_type), count=count)
+
+def convert_prices(df, price_type=None, columns=PRICE_COLUMNS):
+    """
+    Returns df with its price columns in the given representation, e.g. to add rows to a store kept in the other one.
+    Integer columns are fixed-point. Float dollars are rounded to the nearest 1e-9, which gives back the DBN values
+    exactly; fixed-point is divided like DBNStore.to_df(), so either way the result equals a decode in that representation.
+    """
+    fixed = get_price_type(price_type) == 'fixed'
+    updates = {}
+    for col in columns:
+        if col not in df.columns or pd.api.types.is_integer_dtype(df[col]) == fixed:
+            continue
+        values = df[col].to_numpy()
+        updates[col] = np.rint(values * FIXED_PRICE_SCALE).astype(np.int64) if fixed else values / FIXED_PRICE_SCALE
+    return df.assign(**updates) if updates else df
+
+def dbn_cache_path(symbols, start_date, end_date, schema, dataset=DATABENTO_DATASET, cache_root=None):
+    """
+    Returns where the native DBN response for a request is cached:
+    {cache_root}/{dataset}/{schema}/{symbol or batch hash}/{start}_{end}.dbn.zst
+    """
+    symbols = [symbols] if isinstance(symbols, str) else sorted(symbols)
+    if len(symbols) == 1:
+        key = symbols[0]
+    else:
+        key = 'batch-' + hashlib.sha1(','.join(symbols).encode()).hexdigest()[:12]
+    name = f"{start_date.strftime('%Y-%m-%d')}_{end_date.strftime('%Y-%m-%d')}.dbn.zst"
+    return Path(cache_root) / dataset / schema / key / name
+
+def get_range_cached(symbols, start_date, end_date, schema='ohlcv-1d', dataset=DATABENTO_DATASET, client=None,
+                     cache_root=None, refresh=False):
+    """
+    Runs timeseries.get_range, keeping the raw .dbn.zst response on disk when a cache folder is set.
+    A request already in the cache is replayed from the file without touching the network.
+    Args:
+        symbols (str or list): Ticker symbol(s).
+        start_date (datetime): The start date of the data to retrieve.
+        end_date (datetime): The end date of the data to retrieve (exclusive).
+        schema (str): Data Bento schema. Defaults to 'ohlcv-1d'.
+        dataset (str): Data Bento dataset. Defaults to 'XNAS.ITCH'.
+        client (optional): Client to use instead of the shared one.
+        cache_root (str, optional): Cache folder. Defaults to the databento_dbn_cache environment variable; no caching if unset.
+        refresh (bool): Fetch again even if the request is cached. Defaults to False.
+    Returns:
+        db.DBNStore: The response, backed by the cached file when caching is on.
+    """
+    cache_root = cache_root or os.getenv('databento_dbn_cache')
+    request = dict(
+        dataset=dataset,
+        symbols=symbols,
+        start=start_date.strftime('%Y-%m-%d'),
+        end=end_date.strftime('%Y-%m-%d'),
+        schema=schema
+    )
+    symbol_count = 1 if isinstance(symbols, str) else len(symbols)
+    with span('vendor_fetch', symbols=symbol_count, schema=schema, start=request['start'], end=request['end']) as s:
+        if not cache_root:
+            store = (client or get_client()).timeseries.get_range(**request)
+            s.add(requests=1, bytes=store.nbytes)
+            record_dbn_mappings(store)
+            return store
+
+        path = dbn_cache_path(symbols, start_date, end_date, schema, dataset, cache_root)
+        if refresh or not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            # Stream the response to a temp file so an interrupted download is never replayed
+            tmp_path = path.with_name(path.name + '.tmp')
+            (client or get_client()).timeseries.get_range(**request, path=tmp_path)
+            os.replace(tmp_path, path)
+            s.add(requests=1, bytes=path.stat().st_size)
+            store = db.DBNStore.from_file(path)
+            record_dbn_mappings(store)
+            return store
+        s.add(cache_hits=1)
+        return db.DBNStore.from_file(path)
+
+def iter_dbn_frames(store, count=DBN_CHUNK_RECORDS):
+    """
+    Decodes a DBN store into DataFrames of at most count records, in the DBNStore.to_df() layout (see to_df).
+    """
+    frames = iter(to_df(store, count=count))
+    while True:
+        start = time.perf_counter()
+        df = next(frames, None)
+        if df is None:
+            return
+        record('decode', time.perf_counter() - start, rows=len(df))
+        yield df
+
+def iter_dbn_arrays(store, count=DBN_CHUNK_RECORDS):
+    """
+    Decodes a DBN store into NumPy structured arrays of at most count records.
+    Prices stay as int64 fixed-point (1e-9 dollars) and ts_event as uint64 nanoseconds.
+    """
+    return store.to_ndarray(count=count)
+
+def split_by_symbol(df, tickers):
+    """
+    Splits a multi-symbol DataFrame into one DataFrame per requested ticker.
+    Args:
+        df (pd.DataFrame): Records with a 'symbol' column, as returned by DBNStore.to_df().
+        tickers (list): The requested ticker symbols.
+    Returns:
+        dict: ticker -> pd.DataFrame. Tickers without records map to an empty DataFrame.
+    """
+    frames = {ticker: df.iloc[0:0] for ticker in tickers}
+    for symbol, frame in df.groupby('symbol', sort=False):
+        if symbol in frames:
+            frames[symbol] = frame
+    return frames
+
+def get_data_from_databento_batch(tickers, start_date, end_date, schema='ohlcv-1d', dataset=DATABENTO_DATASET,
+                                  client=None, batch_size=MAX_SYMBOLS_PER_REQUEST, cache_root=None):
+    """
+    Fetches data for many tickers from Data Bento with one request per batch of symbols.
+    Args:
+        tickers (list): The stock ticker symbols.
+        start_date (datetime): The start date of the data to retrieve.
+        end_date (datetime): The end date of the data to retrieve.
+        schema (str): Data Bento schema. Defaults to 'ohlcv-1d'.
+        dataset (str): Data Bento dataset. Defaults to 'XNAS.ITCH'.
+        client (optional): Client to use instead of the shared one (e.g. a fake for offline runs).
+        batch_size (int): Maximum symbols per request. Defaults to 2000.
+        cache_root (str, optional): Keep/replay the native DBN responses here, see get_range_cached.
+    Returns:
+        dict: ticker -> pd.DataFrame indexed by ts_event, in the same layout as DBNStore.to_df().
+    """
+    # Each batch goes through the request planner, which imports this module
+    from request_planner import get_range_planned
+    tickers = list(dict.fromkeys(tickers))
+
+    frames = {}
+    for i in range(0, len(tickers), batch_size):
+        batch = tickers[i:i + batch_size]
+        stores = get_range_planned(batch, start_date, end_date, schema, dataset, client, cache_root)
+        with span('decode', symbols=len(batch)) as s:
+            decoded = [to_df(store) for store in stores]
+            # Nothing is requested when no ticker of the batch is listed over the range
+            df = pd.concat(decoded) if decoded else pd.DataFrame(columns=['symbol'])
+            s.add(rows=len(df))
+        frames.update(split_by_symbol(df, batch))
+    return frames
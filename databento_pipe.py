@@ -1,40 +1,49 @@
-import databento as db
 import pandas as pd
-from datetime import datetime, timedelta
+from datetime import timedelta
 from pathlib import Path
-import zipfile
+import logging
 import os
-from sqlalchemy import create_engine
-from sqlalchemy.exc import SQLAlchemyError
+from databento_fetch import get_data_from_databento_batch, iter_dbn_frames, iter_dbn_arrays, to_df
+from request_planner import get_range_planned
+from coverage_manifest import load_coverage, intervals_from_dates, missing_ranges, mark_covered, last_event
+from raw_store import (RAW_STORE_ROOT, write_raw, iter_raw_years, scan_raw, get_existing_dates, list_files, import_csv,
+                       summarize_files)
+from lean_writer import (LEAN_EQUITY_ROOT, LEAN_TIMEZONE, TICK_SCHEMAS, write_lean_minute_data, write_lean_bars,
+                         write_lean_minute_data_polars, write_lean_bars_polars, write_lean_ticks, append_lean_bars,
+                         get_engine)
+from lean_manifest import fingerprint, load_manifest, source_unchanged, extendable_source, record_source
+from resolution import schema_for, source_resolution, source_schema, get_session, iter_resampled, resample_polars
+from pipeline import run_pipeline, print_statuses
+from functools import partial
+from itertools import chain
+from instrumentation import configure, log_error
 
 ''' Python Script to download data form data bento and convert it to LEAN format 
     Requires manual saving/moving to the lean data directory within Algos folder
-    
-    To add:
-    Overwrite if file exists logic - Take from the medium article tbh - TBD 28SEP24
     '''
 
-def get_data_from_databento(ticker, start_date, end_date):
+logger = logging.getLogger(__name__)
+
+# Columns the LEAN converter needs from the raw store
+LEAN_SOURCE_COLUMNS = ['open', 'high', 'low', 'close', 'volume']
+
+def get_data_from_databento(ticker, start_date, end_date, schema='ohlcv-1d'):
     """
     Fetches OHLCV data for a given ticker from Data Bento for the specified date range.
     Args:
         ticker (str): The stock ticker symbol.
         start_date (datetime): The start date of the data to retrieve.
         end_date (datetime): The end date of the data to retrieve.
+        schema (str, optional): Data Bento schema, e.g. 'ohlcv-1m' or 'trades'. Defaults to 'ohlcv-1d'.
     
     Returns:
         pd.DataFrame: A DataFrame containing the retrieved data.
     """
-    client = db.Historical(os.getenv('databento_api_key'))
-    dataset = client.timeseries.get_range(
-        dataset="XNAS.ITCH",
-        symbols=ticker,
-        start=start_date.strftime('%Y-%m-%d'),
-        end=end_date.strftime('%Y-%m-%d'),
-        schema='ohlcv-1d'
-    )
+    # Large ranges are split into size-bounded chunks fetched concurrently (request_planner.py),
+    # replayed from the local .dbn.zst cache when databento_dbn_cache is set
+    stores = get_range_planned(ticker, start_date, end_date, schema=schema)
     
-    df = dataset.to_df()
+    df = pd.concat([to_df(store) for store in stores])
     return df
 
 # testing convert_utc_to_ny time
@@ -61,121 +70,365 @@ def convert_utc_to_ny(df, datetime_column='ts_event'):
     
     return df
 
-def convert_to_lean_format(csv_file, ticker, frequency='daily'):
+def convert_to_lean_format(source, ticker, frequency='daily', max_workers=None, keep_csv=False, engine=None, force=False):
     '''
-    Converts a CSV file containing stock data into a format compatible with LEAN Local CLI Framework.
+    Converts stock data into a format compatible with LEAN Local CLI Framework.
     Args:
-        csv_file (str): The path to the input CSV file containing stock data.
+        source (str or iterable): The path to an input CSV file containing stock data, or a DataFrame / iterable of
+            time-ordered DataFrames (e.g. raw_store.iter_raw_years), or a Polars LazyFrame (e.g. raw_store.scan_raw).
         ticker (str): The stock ticker symbol.
         frequency (str, optional): The frequency of the data. Can be 'daily', 'hourly', or 'minute'. Defaults to 'daily'.
+        max_workers (int, optional): Processes used to write minute data days in parallel. Defaults to os.cpu_count().
+        keep_csv (bool, optional): Keep the plain {ticker}.csv next to the daily/hourly zip. Defaults to False.
+        engine (str, optional): 'pandas' or 'polars', both write the same bytes. Defaults to the lean_engine environment variable or 'pandas'.
+        force (bool, optional): Rewrite outputs whose content did not change (see lean_manifest.py). Defaults to False.
     Returns:
         None: The function saves the converted data to a file in the appropriate directory based on the frequency. Located within project directory.
     '''
-    # Read the Loaded CSV File
-    df = pd.read_csv(csv_file)
-    
-    # Convert the time to NY time (exchange time zone) Optional, still deciding if needed
-    #convert_utc_to_ny(df, datetime_column='ts_event')
-    
-    # Strip the extra time info from CONVERTED time zone to match lean format
-    df['date'] = pd.to_datetime(df.pop('ts_event')).dt.strftime('%Y%m%d %H:%M')
-    df = df[['date', 'open', 'high', 'low', 'close', 'volume']]
-    
-    # Conversion from dollars to deci-cents
-    df[['open', 'high', 'low', 'close']] = (df[['open', 'high', 'low', 'close']] * 10000).astype(int)
-    
-    # Data type sorting for directory saving for csv
-    if frequency == 'daily':
-        output_dir = 'data/equity/usa/daily/'
-        output_file = f"{output_dir}{ticker.lower()}.csv"
-    elif frequency == 'hourly':
-        output_dir = 'data/equity/usa/hourly/'
-        output_file = f"{output_dir}{ticker.lower()}.csv"
+    polars = get_engine(engine) == 'polars'
+    if isinstance(source, (str, Path)):
+        if polars:
+            import polars as pl
+            # Lazy scan, the CSV is read in batches while the zip is written
+            chunks = pl.scan_csv(source, schema_overrides={'ts_event': pl.String})
+        else:
+            # Read the Loaded CSV File in chunks so large histories are never fully in memory
+            chunks = pd.read_csv(source, chunksize=500_000)
     else:
-        output_dir = 'data/equity/usa/minute/'
-        output_file = f"{output_dir}{(ticker.lower())}.csv"
-    
-    df.to_csv(output_file, index=False, header=False)
-        
-    # Zip File
-    zip_file = os.path.join(output_dir, f'{ticker.lower()}.zip')
-    # Create a zip file and add the csv file to it
-    with zipfile.ZipFile(zip_file, 'w') as zf:
-        zf.write(output_file, arcname=f'{ticker.lower()}.csv')
-
-    # Optionally, remove the csv file after zipping (if you want the zip to be the only output)
-    #os.remove(csv_file)
-
-    print(f"{output_file} has been successfully zipped into {zip_file}.")
+        chunks = source
+
+    # Minute data is written as one zip per trading day
+    if frequency == 'minute':
+        write_minute = write_lean_minute_data_polars if polars else write_lean_minute_data
+        zip_files = write_minute(chunks, ticker, max_workers=max_workers, force=force)
+        logger.info(f"{len(zip_files)} trading days for {ticker} written to data/equity/usa/minute/{ticker.lower()}/.")
+        return
+
+    # Rows are encoded to LEAN bytes (deci-cent prices) and streamed into the zip, no intermediate CSV
+    # Times are kept in UTC as downloaded, see convert_utc_to_ny for the exchange time zone
+    write_bars = write_lean_bars_polars if polars else write_lean_bars
+    zip_file = write_bars(chunks, ticker, frequency, timezone='UTC', keep_csv=keep_csv, force=force)
+
+    logger.info(f"{ticker} has been successfully converted into {zip_file}.")
     
-def download_and_append_data(ticker, start_date, end_date, folder='databento/downloads', frequency='daily'):
+def get_coverage(ticker, folder, store_root=RAW_STORE_ROOT, schema='ohlcv-1d'):
+    """
+    Returns the fetched date intervals for a ticker from its coverage manifest.
+    Data downloaded before manifests existed seeds the manifest from the dates in the raw store.
+    """
+    intervals = load_coverage(ticker, schema, folder)
+    if intervals is None:
+        intervals = intervals_from_dates(get_existing_dates(ticker, schema, store_root))
+    return intervals
+
+def import_legacy_csv(ticker, folder, store_root=RAW_STORE_ROOT, schema='ohlcv-1d'):
+    """
+    Imports databento/downloads/{ticker}_data.csv into the Parquet raw store the first time the ticker is seen.
+    The CSV itself is left in place.
+    """
+    path = Path(folder) / f'{ticker}_data.csv'
+    if path.exists() and not list_files(ticker, schema, store_root):
+        import_csv(path, ticker, schema, store_root)
+        logger.info(f'Imported {path} into the raw store')
+
+def fetch_missing_data(ticker, start_date, end_date, folder='databento/downloads', store_root=RAW_STORE_ROOT,
+                       schema='ohlcv-1d'):
+    """
+    Fetch stage: requests the trading-day ranges missing from the ticker's coverage manifest for the schema.
+    Responses are returned undecoded so the store stage can decode them in record batches.
+    Returns:
+        tuple: (missing ranges, coverage intervals, iterable of DBNStore read one at a time), nothing is fetched when
+            missing is empty.
+    """
+    # Existing CSV downloads are imported into the raw store once
+    import_legacy_csv(ticker, folder, store_root)
+
+    # Work out which trading-day ranges have not been fetched yet
+    intervals = get_coverage(ticker, folder, store_root, schema)
+    missing = missing_ranges(intervals, pd.to_datetime(start_date), pd.to_datetime(end_date))
+    # Data Bento's end date is exclusive, so each range is requested through the following day. Every range goes
+    # through the request planner: checked against databento_max_cost, split into bounded chunks and resumable
+    stores = chain.from_iterable([get_range_planned(ticker, start, end + timedelta(days=1), schema=schema)
+                                  for start, end in missing])
+    return missing, intervals, stores
+
+def store_fetched_data(ticker, fetched, folder='databento/downloads', store_root=RAW_STORE_ROOT, schema='ohlcv-1d'):
+    """
+    Store stage: writes the output of fetch_missing_data to the raw store and marks the ranges covered.
+    The fetched data can also be DataFrames already decoded, e.g. from a batched request.
+    Returns:
+        list: Paths of the Parquet files written.
+    """
+    missing, intervals, stores = fetched
+    files = []
+    last_received = None
+    for store in stores:
+        # Decode in record batches so a large pull is never held as one DataFrame
+        chunks = [store] if isinstance(store, pd.DataFrame) else iter_dbn_frames(store)
+        for chunk in chunks:
+            files += write_raw(chunk, ticker, schema, store_root)
+            last_received = last_event(chunk, last_received)
+    if missing:
+        # Dates past the last bar received are only marked once they are settled
+        mark_covered(ticker, schema, folder, missing, intervals, last_received)
+    return files
+
+def get_append_start(manifest, source_fingerprint, summary):
+    """
+    Finds where the LEAN outputs can be extended from instead of rebuilt, see databento_sql.get_append_start.
+    Raw-store files are never rewritten, so the rows converted last time are unchanged when every file they were
+    read from is still there and the files added since only hold rows from the last converted exchange date on.
+    Args:
+        manifest (dict): The ticker's LEAN manifest.
+        source_fingerprint (dict): Fingerprint of the files to convert, with their relative paths under 'files'.
+        summary (dict): raw_store.summarize_files of the same files.
+    Returns:
+        pd.Timestamp: UTC start of the exchange date of the last converted row, or None for a full conversion.
+    """
+    previous = extendable_source(manifest, source_fingerprint)
+    if previous is None or 'files' not in previous:
+        return None
+    since = pd.Timestamp(previous['max_ts_event']).tz_convert(LEAN_TIMEZONE).normalize().tz_convert('UTC')
+    converted, stored = set(previous['files']), set(source_fingerprint['files'])
+    if not converted <= stored:
+        return None
+    # Later files win over earlier ones, an added file reaching back before since revises converted rows
+    first = summary['first_ts_event']
+    if any(first[name] is None or first[name] < since for name in stored - converted):
+        return None
+    return since
+
+def convert_stored_data(ticker, start_date, end_date, frequency='daily', store_root=RAW_STORE_ROOT, max_workers=None,
+                        engine=None, force=False, source=None, session=None, keep_csv=False):
+    """
+    Convert stage: converts the ticker's raw store to QuantConnect format.
+    Bars are read from the schema of the frequency, or aggregated from a finer source resolution (see resolution.py).
+    Only the bar columns are read, a year at a time (one lazy scan of the files with engine='polars').
+    Minute data is one file per day, so only the requested days are read and rewritten.
+    Nothing is read when the stored files are the ones the current LEAN outputs were converted from, and only the
+    days from the last converted one on when files were merely added after it (see get_append_start).
+    keep_csv keeps the plain {ticker}.csv next to a daily or hourly zip, whether it is rewritten or extended.
+    """
+    polars = get_engine(engine) == 'polars'
+    read = scan_raw if polars else iter_raw_years
+    source = source_resolution(frequency, source)
+    schema = schema_for(source)
+    end = None
+    if frequency == 'minute':
+        start, end = pd.to_datetime(start_date), pd.to_datetime(end_date)
+        key = {'frequency': frequency, 'start': start.date(), 'end': end.date()}
+        summary = summarize_files(ticker, schema, store_root, start, end, timezone='America/New_York')
+    else:
+        key = {'frequency': frequency}
+        summary = summarize_files(ticker, schema, store_root)
+    key.update(schema=schema, output_root=os.path.abspath(LEAN_EQUITY_ROOT))
+    if source != frequency:
+        key['session'] = get_session(session)
+    source_fingerprint = fingerprint(key, summary['rows'], summary['max_ts_event'], summary['files'])
+    # The file list tells the next run which files were added since
+    source_fingerprint['files'] = [name for name, size in summary['files']]
+    manifest = load_manifest(ticker, frequency)
+    if not force and source_unchanged(manifest, source_fingerprint):
+        logger.info(f'{ticker} {frequency} LEAN data is up to date with the raw store, skipped')
+        return
+
+    since = None if force else get_append_start(manifest, source_fingerprint, summary)
+    if since is not None:
+        # Only the days from the last converted one on are read, encoded and written
+        bars = iter_raw_years(ticker, schema, since.tz_convert(LEAN_TIMEZONE).date(), end, columns=LEAN_SOURCE_COLUMNS,
+                              root=store_root, timezone=LEAN_TIMEZONE)
+        if source != frequency:
+            bars = iter_resampled(bars, frequency, session)
+        if frequency == 'minute':
+            write_lean_minute_data(bars, ticker, max_workers=max_workers)
+        else:
+            append_lean_bars(bars, ticker, frequency, timezone='UTC', keep_csv=keep_csv)
+        record_source(ticker, frequency, source_fingerprint)
+        logger.info(f'{ticker} {frequency} LEAN data extended from {since.date()}')
+        return
+
+    if frequency == 'minute':
+        bars = read(ticker, schema, start, end, columns=LEAN_SOURCE_COLUMNS, root=store_root, timezone='America/New_York')
+    else:
+        bars = read(ticker, schema, columns=LEAN_SOURCE_COLUMNS, root=store_root)
+    # scan_raw returns None when nothing is stored
+    bars = bars if bars is not None else []
+    if source != frequency:
+        # Coarser bars are aggregated locally from the stored finer ones
+        bars = resample_polars(bars, frequency, session) if polars else iter_resampled(bars, frequency, session)
+    convert_to_lean_format(bars, ticker, frequency, max_workers=max_workers, keep_csv=keep_csv, engine=engine,
+                           force=force)
+    record_source(ticker, frequency, source_fingerprint)
+
+def download_and_append_data(ticker, start_date, end_date, folder='databento/downloads', frequency='daily', df_new=None,
+                             store_root=RAW_STORE_ROOT, engine=None, source=None):
     """
     Downloads and appends stock data from Data Bento API if necessary, then converts the data to QuantConnect format.
+    Only the trading-day ranges missing from the ticker's coverage manifest are requested, and new data is added to
+    the Parquet raw store as new partition files.
     Args:
         ticker (str): The stock ticker symbol.
         start_date (str): The start date for data retrieval.
         end_date (str): The end date for data retrieval.
-        folder (str): Folder to save the CSV file.
+        folder (str): Folder holding legacy CSV downloads and the coverage manifests.
         frequency (str): Data frequency ('daily', 'hourly', 'minute').
+        df_new (pd.DataFrame, optional): Data already fetched for the missing ranges (see download_and_append_data_batch).
+        store_root (str): Root of the Parquet raw store. Defaults to 'databento/raw'.
+        engine (str, optional): LEAN conversion engine, 'pandas' or 'polars'. Defaults to the lean_engine environment variable.
+        source (str, optional): Finer resolution to fetch and aggregate from, e.g. 'minute'. Defaults to the
+            lean_source_resolution environment variable, else the frequency's own schema (see resolution.py).
     
     Returns:
         str: The ticker symbol.
     """
-    # Define file path for the ticker - Saves the databento download file
-    #fname = ticker.lower() + '.csv'
-    fname = f'{ticker}_data.csv'
-    path = Path(folder) / fname
-
     # Convert start_date and end_date to datetime objects
     start_date = pd.to_datetime(start_date)
     end_date = pd.to_datetime(end_date)
+    # Data Bento schema the frequency is fetched and stored as
+    schema = source_schema(frequency, source)
 
-    # Check if the file exists
-    if path.exists():
-        # Open the file and retrieve existing dates
-        df_existing = pd.read_csv(path, index_col=0)
-        df_existing.index = pd.to_datetime(df_existing.index)  # Ensure the index is converted to Timestamps
-        dates = pd.DatetimeIndex(df_existing.index.sort_values(ascending=True))
-        
-        # Convert the existing dates to tz-naive (remove timezone)
-        dates = dates.tz_localize(None)
-    else:
-        dates = None
+    # Attempt to fetch new data from Data Bento
+    try:
+        if df_new is None:
+            fetched = fetch_missing_data(ticker, start_date, end_date, folder, store_root, schema)
+        else:
+            import_legacy_csv(ticker, folder, store_root)
+            intervals = get_coverage(ticker, folder, store_root, schema)
+            fetched = (missing_ranges(intervals, start_date, end_date), intervals, [df_new])
+        missing, intervals, _ = fetched
+
+        # If no data or part of the date range is not covered
+        if missing:
+            logger.info(f'Fetching data for {ticker}: {len(missing)} missing range(s) between {start_date.date()} and {end_date.date()}')
+            # New data goes into new partition files, history is not rewritten
+            files = store_fetched_data(ticker, fetched, folder, store_root, schema)
+            logger.info(f'Ticker {ticker} data saved to {len(files)} file(s) under {store_root}/{ticker}')
+        else:
+            logger.info(f'Ticker {ticker} already up-to-date')
+    except Exception as e:
+        log_error(logger, f'Error fetching data for {ticker}', e)
+        return None
+
+    # Convert to QuantConnect format
+    convert_stored_data(ticker, start_date, end_date, frequency, store_root, engine=engine, source=source)
+
+    return ticker
+
+def download_and_append_data_batch(ticker_list, start_date, end_date, folder='databento/downloads', frequency='daily',
+                                   store_root=RAW_STORE_ROOT, engine=None, source=None):
+    """
+    Batched version of download_and_append_data. Tickers missing the same date ranges are fetched together
+    in as few Data Bento requests as possible using the shared client, then appended per ticker.
+    Args:
+        ticker_list (list): The stock ticker symbols.
+        start_date (str): The start date for data retrieval.
+        end_date (str): The end date for data retrieval.
+        folder (str): Folder holding legacy CSV downloads and the coverage manifests.
+        frequency (str): Data frequency ('daily', 'hourly', 'minute').
+        store_root (str): Root of the Parquet raw store. Defaults to 'databento/raw'.
+        engine (str, optional): LEAN conversion engine, 'pandas' or 'polars'. Defaults to the lean_engine environment variable.
+        source (str, optional): Finer resolution to fetch and aggregate from, see download_and_append_data.
+    
+    Returns:
+        list: The ticker symbols that were processed successfully.
+    """
+    start = pd.to_datetime(start_date)
+    end = pd.to_datetime(end_date)
+    schema = source_schema(frequency, source)
+
+    # Group tickers by their missing ranges, a daily top-up usually leaves one group
+    groups = {}
+    for ticker in ticker_list:
+        import_legacy_csv(ticker, folder, store_root)
+        missing = missing_ranges(get_coverage(ticker, folder, store_root, schema), start, end)
+        if missing:
+            groups.setdefault(tuple(missing), []).append(ticker)
 
-    # If no file or date range is not covered
-    if dates is None or start_date < dates[0] or end_date > dates[-1]:
-        print(f'Fetching data for {ticker} from {start_date} to {end_date}')
-        
-        # Attempt to fetch new data from Data Bento
+    frames = {}
+    stale = set()
+    for missing, tickers in groups.items():
+        stale.update(tickers)
+        logger.info(f'Fetching data for {len(tickers)} tickers: {len(missing)} missing range(s) between {start.date()} and {end.date()}')
         try:
-            # Add buffer (delta) to the date range to handle overlaps
-            delta = timedelta(days=3)
-            df_new = get_data_from_databento(ticker, start_date - delta, end_date + delta)
-            
-            # If file exists, append new data
-            if path.exists():
-                df_combined = pd.concat([df_existing, df_new]).drop_duplicates()
-                df_combined.sort_index(inplace=True)
-                df_combined.to_csv(path)
-
-            else:
-                # Save the new data if no file exists
-                df_new.to_csv(path)
-            print(f'Ticker {ticker} data saved to {path}')
-        
+            # Data Bento's end date is exclusive, so each range is requested through the following day
+            parts = [get_data_from_databento_batch(tickers, s, e + timedelta(days=1), schema) for s, e in missing]
+            frames.update({ticker: pd.concat([part[ticker] for part in parts]) for ticker in tickers})
         except Exception as e:
-            print(f'Error fetching data for {ticker}: {e}')
-            return None
-    else:
-        print(f'Ticker {ticker} already up-to-date')
+            log_error(logger, 'Error fetching batch data', e)
 
-    # Convert to QuantConnect format (path = path to csv file incl. .csv, ticker = ticker symbol, frequency = 'daily', 'hourly', 'minute')
-    convert_to_lean_format(path, ticker, frequency)
+    processed = []
+    for ticker in ticker_list:
+        if ticker in stale and ticker not in frames:
+            # The batch request failed, leave the ticker for the next run
+            continue
+        if download_and_append_data(ticker, start_date, end_date, folder, frequency, frames.get(ticker), store_root, engine,
+                                    source) is not None:
+            processed.append(ticker)
+    return processed
 
-    return ticker
+def download_and_append_data_concurrent(ticker_list, start_date, end_date, folder='databento/downloads', frequency='daily',
+                                        store_root=RAW_STORE_ROOT, engine=None, source=None, **pipeline_options):
+    """
+    Concurrent version of download_and_append_data. Fetches run in threads under the Data Bento request limits,
+    raw store writes in a bounded writer stage and LEAN conversions in a process pool, overlapping across tickers.
+    Args:
+        ticker_list (list): The stock ticker symbols.
+        start_date (str): The start date for data retrieval.
+        end_date (str): The end date for data retrieval.
+        folder (str): Folder holding legacy CSV downloads and the coverage manifests.
+        frequency (str): Data frequency ('daily', 'hourly', 'minute').
+        store_root (str): Root of the Parquet raw store. Defaults to 'databento/raw'.
+        engine (str, optional): LEAN conversion engine, 'pandas' or 'polars'. Defaults to the lean_engine environment variable.
+        source (str, optional): Finer resolution to fetch and aggregate from, see download_and_append_data.
+        **pipeline_options: Passed to pipeline.run_pipeline (fetch_workers, requests_per_second, convert_workers, ...).
+
+    Returns:
+        dict: ticker -> pipeline.TickerStatus.
+    """
+    schema = source_schema(frequency, source)
+    return run_pipeline(
+        ticker_list,
+        fetch=partial(fetch_missing_data, start_date=start_date, end_date=end_date, folder=folder, store_root=store_root,
+                      schema=schema),
+        store=partial(store_fetched_data, folder=folder, store_root=store_root, schema=schema),
+        # Tickers are already converted in parallel, each one is written serially
+        convert=partial(convert_stored_data, start_date=start_date, end_date=end_date, frequency=frequency,
+                        store_root=store_root, max_workers=1, engine=engine, source=source),
+        **pipeline_options
+    )
+
+def download_tick_data(ticker, start_date, end_date, tick_types=('trade', 'quote'), max_workers=None, force=False):
+    """
+    Downloads Data Bento trades and/or mbp-1 records and writes them as LEAN tick data
+    (data/equity/usa/tick/{ticker}/{YYYYMMDD}_trade.zip and _quote.zip).
+    Ticks are not added to the raw store: the DBN responses (kept under databento_dbn_cache when set) are decoded in
+    record batches and streamed into per-day zips, so memory stays bounded however many months are requested.
+    Args:
+        ticker (str): The stock ticker symbol.
+        start_date (str or datetime): The first trading day to export.
+        end_date (str or datetime): The last trading day to export (inclusive).
+        tick_types (tuple): 'trade' and/or 'quote'. Defaults to both.
+        max_workers (int, optional): Processes used to write the days in parallel. Defaults to os.cpu_count().
+        force (bool, optional): Rewrite days whose ticks did not change. Defaults to False.
+    Returns:
+        dict: tick type -> list of the day zip files written.
+    """
+    start_date = pd.to_datetime(start_date)
+    end_date = pd.to_datetime(end_date)
+    zip_files = {}
+    for tick_type in tick_types:
+        # Large ranges come back as size-bounded chunks (request_planner.py), decoded one record batch at a time
+        stores = get_range_planned(ticker, start_date, end_date + timedelta(days=1), schema=TICK_SCHEMAS[tick_type])
+        batches = (batch for store in stores for batch in iter_dbn_arrays(store))
+        zip_files[tick_type] = write_lean_ticks(batches, ticker, tick_type, max_workers=max_workers, force=force)
+        logger.info(f"{len(zip_files[tick_type])} days of {tick_type} ticks for {ticker} written to "
+                    f"data/equity/usa/tick/{ticker.lower()}/.")
+    return zip_files
 
 # Example ticker list and date range
 if __name__ == '__main__':
+    # Log level/format and the metrics file come from the lean_log_* and lean_metrics_* environment variables
+    configure()
     ticker_list = ['IWM']
-    for ticker in ticker_list:
-        download_and_append_data(ticker, '2023-01-01', '2023-12-31', frequency='daily')
\ No newline at end of file
+    statuses = download_and_append_data_concurrent(ticker_list, '2023-01-01', '2023-12-31', frequency='daily')
+    print_statuses(statuses)
@@ -1,42 +1,88 @@
-import databento as db
 import pandas as pd
 import numpy as np
-from datetime import datetime, timedelta
+from datetime import timedelta
+import logging
 import os
-from sqlalchemy import create_engine, inspect
+import io
+from sqlalchemy import text
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.types import BigInteger, DateTime, Float
-import zipfile
 from sqlalchemy.types import TIMESTAMP
-import pytz
+from databento_fetch import (get_data_from_databento_batch, iter_dbn_frames, to_df, convert_prices,
+                             PRICE_COLUMNS)
+from request_planner import get_range_planned
+from coverage_manifest import load_coverage, intervals_from_dates, missing_ranges, mark_covered, last_event
+from pg_engine import timed_connection, copy_from_buffer, copy_to_bytes, decode_copy_binary, print_timings
+import pg_store
+from lean_writer import (LEAN_EQUITY_ROOT, LEAN_TIMEZONE, write_lean_minute_data, write_lean_bars,
+                         write_lean_minute_data_polars, write_lean_bars_polars, append_lean_bars, iter_polars_chunks,
+                         get_engine)
+from lean_manifest import fingerprint, load_manifest, source_unchanged, extendable_source, record_source
+from resolution import schema_for, session_bounds, source_resolution, source_schema, get_session, iter_resampled, resample_polars
+from pipeline import run_pipeline, print_statuses
+from functools import partial
+from itertools import chain
+from instrumentation import span, configure, log_error
+
+# Define data types for SQL columns
+OHLCV_DTYPE = {
+    'ts_event': TIMESTAMP(timezone=True),
+    'open': Float(),
+    'high': Float(),
+    'low': Float(),
+    'close': Float(),
+    'volume': BigInteger(),
+    # Add other columns if necessary
+}
+
+# Price column type of the tables created with databento_price_type=fixed, DBN fixed-point (1e-9 dollars)
+FIXED_OHLCV_DTYPE = dict(OHLCV_DTYPE, **{col: BigInteger() for col in PRICE_COLUMNS})
+
+# PostgreSQL schema holding each Data Bento schema's tables, one table per ticker
+PG_SCHEMAS = {'ohlcv-1d': 'databento_ohlcv', 'ohlcv-1h': 'databento_ohlcv_1h', 'ohlcv-1m': 'databento_ohlcv_1m'}
+
+# Per-schema metadata table with the first/last ts_event and the distinct UTC dates of every ticker table.
+# It is maintained by the write helpers, so coverage and existence checks are one primary-key lookup.
+COVERAGE_TABLE = 'symbol_coverage'
+
+# Columns the LEAN converter needs from a ticker table
+LEAN_SOURCE_COLUMNS = ['open', 'high', 'low', 'close', 'volume']
+
+# Types the ticker table columns are copied out with by the binary read path (pg_engine.decode_copy_binary)
+COPY_TYPES = {'ts_event': 'timestamptz', 'open': 'float8', 'high': 'float8', 'low': 'float8', 'close': 'float8',
+              'volume': 'int8'}
+
+# Rows per chunk of iter_data_from_postgresql
+READ_CHUNK_ROWS = int(os.getenv('pg_read_chunk_rows', 500_000))
 
 ''' 
 Python Script to download data from Data Bento and convert it to LEAN format.
 If the data already exists, then it will be fetched from the PostgreSQL database instead of databento
 '''
 
-def get_data_from_databento(ticker, start_date, end_date):
+logger = logging.getLogger(__name__)
+
+def get_data_from_databento(ticker, start_date, end_date, schema='ohlcv-1d'):
     """
     Fetches OHLCV data for a given ticker from Data Bento for the specified date range.
+    Large ranges are split into size-bounded chunks fetched concurrently, see request_planner.py.
     """
-    client = db.Historical(os.getenv('databento_api_key'))
-    dataset = client.timeseries.get_range(
-        dataset="XNAS.ITCH",
-        symbols=ticker,
-        start=start_date.strftime('%Y-%m-%d'),
-        end=end_date.strftime('%Y-%m-%d'),
-        schema='ohlcv-1d'
-    )
-    df = dataset.to_df()
+    # Replayed from the local .dbn.zst cache when databento_dbn_cache is set
+    stores = get_range_planned(ticker, start_date, end_date, schema=schema)
+    return prepare_databento_df(pd.concat([to_df(store) for store in stores]))
 
+def prepare_databento_df(df):
+    """
+    Makes a Data Bento DataFrame ready for PostgreSQL: downcasts uint64 columns and moves ts_event to a column.
+    """
     # Identify uint64 columns. If a number is a decimal then convert to float64.
     uint64_cols = df.select_dtypes(include=['uint64']).columns.tolist()
     if uint64_cols:
-        print(f"Converting uint64 columns to int64: {uint64_cols}")
+        logger.debug(f"Converting uint64 columns to int64: {uint64_cols}")
         # Ensure values are within int64 range
         for col in uint64_cols:
             if df[col].max() > np.iinfo('int64').max:
-                print(f"Warning: Values in column {col} exceed int64 range. Converting to float.")
+                logger.warning(f"Values in column {col} exceed int64 range. Converting to float.")
                 df[col] = df[col].astype('float64')
             else:
                 df[col] = df[col].astype('int64')
@@ -47,229 +93,605 @@ def get_data_from_databento(ticker, start_date, end_date):
 
     return df
 
+def ohlcv_dtype():
+    """
+    Returns the column types of new ticker tables: float prices, or BIGINT with databento_price_type=fixed.
+    """
+    return FIXED_OHLCV_DTYPE if pg_store.price_sql_type() == 'bigint' else OHLCV_DTYPE
+
 def upload_to_postgresql(df, ticker, schema='databento_ohlcv'):
     """
     Uploads a DataFrame to a PostgreSQL database using SQLAlchemy.
     Ensures that ts_event is included as a standard column.
+    Prices are stored in the databento_price_type representation (see databento_fetch.get_price_type).
     """
     # Ensure ts_event is a column and not the index
     if 'ts_event' not in df.columns:
         df.reset_index(inplace=True)
+    df = convert_prices(df)
+
+    try:
+        # Write the DataFrame to the PostgreSQL table using a pooled connection
+        with span('db_write', ticker=ticker, mode='replace') as s, timed_connection('upload_to_postgresql', transaction=True) as conn:
+            conn.execute(text(f'CREATE SCHEMA IF NOT EXISTS "{schema}"'))
+            df.to_sql(ticker, conn, schema=schema, if_exists='replace', index=False, dtype=ohlcv_dtype())
+            s.add(rows=len(df))
+            # Replacing drops the index and invalidates the ticker's coverage, both are rebuilt from the new table
+            ensure_ohlcv_table(conn, df, ticker, schema)
+            update_symbol_coverage(conn, ticker, schema, f'"{schema}"."{ticker}"', replace=True)
+        logger.info(f"Data for {ticker} uploaded successfully to {schema}.{ticker}.")
+    except SQLAlchemyError as e:
+        log_error(logger, f"Error uploading data for {ticker} to PostgreSQL", e)
+
+def ensure_ohlcv_table(conn, df, ticker, schema='databento_ohlcv'):
+    """
+    Creates the schema, the ticker's table with the standard column types (ohlcv_dtype), its unique B-tree index on
+    ts_event (which serves the range reads) and the schema's symbol_coverage table, only if they do not exist yet.
+    """
+    conn.execute(text(f'CREATE SCHEMA IF NOT EXISTS "{schema}"'))
+    df.head(0).to_sql(ticker, conn, schema=schema, if_exists='append', index=False, dtype=ohlcv_dtype())
+    conn.execute(text(f'CREATE UNIQUE INDEX IF NOT EXISTS "{ticker}_ts_event_key" ON "{schema}"."{ticker}" (ts_event)'))
+    _create_coverage_table(conn, schema)
+
+def _create_coverage_table(conn, schema):
+    conn.execute(text(
+        f'CREATE TABLE IF NOT EXISTS "{schema}".{COVERAGE_TABLE} ('
+        f'symbol text PRIMARY KEY, first_ts timestamptz NOT NULL, last_ts timestamptz NOT NULL, '
+        f'dates date[] NOT NULL, updated_at timestamptz NOT NULL)'
+    ))
+
+def update_symbol_coverage(conn, ticker, schema, source, replace=False):
+    """
+    Adds the rows of source (a table or the upsert staging table) to the ticker's symbol_coverage row.
+    With replace=True the row is rebuilt from source alone, e.g. after the ticker's table was rewritten.
+    """
+    coverage = f'"{schema}".{COVERAGE_TABLE}'
+    if replace:
+        conn.execute(text(f'DELETE FROM {coverage} WHERE symbol = :symbol'), {'symbol': ticker})
+    conn.execute(text(
+        f'INSERT INTO {coverage} AS c (symbol, first_ts, last_ts, dates, updated_at) '
+        f"SELECT :symbol, min(ts_event), max(ts_event), "
+        f"array_agg(DISTINCT (ts_event AT TIME ZONE 'UTC')::date ORDER BY (ts_event AT TIME ZONE 'UTC')::date), now() "
+        f'FROM {source} HAVING count(*) > 0 '
+        f'ON CONFLICT (symbol) DO UPDATE SET first_ts = least(c.first_ts, EXCLUDED.first_ts), '
+        f'last_ts = greatest(c.last_ts, EXCLUDED.last_ts), '
+        f'dates = ARRAY(SELECT DISTINCT d FROM unnest(c.dates || EXCLUDED.dates) AS d ORDER BY d), '
+        f'updated_at = EXCLUDED.updated_at'
+    ), {'symbol': ticker})
+
+def table_exists(conn, ticker, schema='databento_ohlcv'):
+    """
+    Checks for the ticker's table with one catalog lookup instead of listing every table in the schema.
+    """
+    return conn.execute(text('SELECT to_regclass(:name) IS NOT NULL'), {'name': f'"{schema}"."{ticker}"'}).scalar()
 
-    # Fetch credentials from environment variables
-    pguser = os.getenv('pguser')
-    pgpass = os.getenv('pgpass')
-    pghost = os.getenv('pghost')
+def get_symbol_coverage(ticker, schema='databento_ohlcv'):
+    """
+    Returns the ticker's row of the schema's symbol_coverage table, one primary-key lookup.
+    Tables written before the metadata existed are scanned once to add their row.
+    Returns:
+        dict: first_ts, last_ts (UTC datetimes) and dates (sorted datetime.date list), or None if the ticker has no table.
+    """
+    query = text(f'SELECT first_ts, last_ts, dates FROM "{schema}".{COVERAGE_TABLE} WHERE symbol = :symbol')
+    with span('db_read', ticker=ticker, query='coverage'), timed_connection('get_symbol_coverage', transaction=True) as conn:
+        exists = conn.execute(text('SELECT to_regclass(:name) IS NOT NULL'),
+                              {'name': f'"{schema}".{COVERAGE_TABLE}'}).scalar()
+        row = conn.execute(query, {'symbol': ticker}).mappings().first() if exists else None
+        if row is None and table_exists(conn, ticker, schema):
+            logger.info(f"Building {schema}.{COVERAGE_TABLE} for {ticker} from its table")
+            _create_coverage_table(conn, schema)
+            update_symbol_coverage(conn, ticker, schema, f'"{schema}"."{ticker}"', replace=True)
+            row = conn.execute(query, {'symbol': ticker}).mappings().first()
+    return dict(row) if row is not None else None
+
+def upsert_to_postgresql(df, ticker, schema='databento_ohlcv'):
+    """
+    Appends new rows to a ticker's table without reading or rewriting its history.
+    Rows are bulk loaded with COPY into a temporary staging table, then merged with
+    INSERT ... ON CONFLICT (ts_event) DO UPDATE. The table and its unique ts_event index are created if missing.
+    Prices are converted to the representation the table stores, see ohlcv_dtype.
+    """
+    # Ensure ts_event is a column and not the index
+    if 'ts_event' not in df.columns:
+        df = df.reset_index()
+    # ON CONFLICT cannot touch the same row twice in one statement, keep the latest record per ts_event
+    df = df.drop_duplicates(subset='ts_event', keep='last')
 
-    # Database connection URL using environment variables
-    db_url = f'postgresql://{pguser}:{pgpass}@{pghost}/FinancialData'
-    engine = create_engine(db_url)
+    columns = ', '.join(f'"{col}"' for col in df.columns)
+    updates = ', '.join(f'"{col}" = EXCLUDED."{col}"' for col in df.columns if col != 'ts_event')
+    target = f'"{schema}"."{ticker}"'
 
     try:
-        # Define data types for SQL columns
-        dtype = {
-            'ts_event': TIMESTAMP(timezone=True),
-            'open': Float(),
-            'high': Float(),
-            'low': Float(),
-            'close': Float(),
-            'volume': BigInteger(),
-            # Add other columns if necessary
-        }
-
-        # Write the DataFrame to the PostgreSQL table
-        df.to_sql(ticker, engine, schema=schema, if_exists='replace', index=False, dtype=dtype)
-        print(f"Data for {ticker} uploaded successfully to {schema}.{ticker}.")
+        with timed_connection('upsert_to_postgresql', transaction=True) as conn:
+            ensure_ohlcv_table(conn, df, ticker, schema)
+            df = convert_prices(df, pg_store.stored_price_type(conn, target))
+            conn.execute(text(f'CREATE TEMP TABLE ohlcv_stage ON COMMIT DROP AS SELECT {columns} FROM {target} WITH NO DATA'))
+
+            # Stream the new rows through COPY on the underlying DBAPI connection
+            with span('db_write', ticker=ticker, mode='copy') as s:
+                buffer = io.StringIO()
+                df.to_csv(buffer, index=False, header=False)
+                s.add(rows=len(df), bytes=buffer.tell())
+                buffer.seek(0)
+                copy_from_buffer(conn, f'COPY ohlcv_stage ({columns}) FROM STDIN WITH (FORMAT csv)', buffer)
+
+            with span('merge', ticker=ticker) as s:
+                result = conn.execute(text(
+                    f'INSERT INTO {target} ({columns}) SELECT {columns} FROM ohlcv_stage '
+                    f'ON CONFLICT (ts_event) DO UPDATE SET {updates}'
+                ))
+                s.add(rows=result.rowcount)
+            # Only the staged rows are scanned to extend the ticker's coverage
+            update_symbol_coverage(conn, ticker, schema, 'ohlcv_stage')
+        logger.info(f"{len(df)} rows for {ticker} upserted into {schema}.{ticker}.")
     except SQLAlchemyError as e:
-        print(f"Error uploading data for {ticker} to PostgreSQL: {e}")
-    finally:
-        engine.dispose()
+        log_error(logger, f"Error upserting data for {ticker} to PostgreSQL", e)
+        # The caller must not mark the range covered
+        raise
 
 def get_existing_dates_from_postgresql(ticker, schema='databento_ohlcv'):
     """
-    Retrieves the existing dates for a given ticker from PostgreSQL database.
+    Retrieves the existing dates (UTC) for a given ticker from its symbol_coverage row.
     """
-    # Fetch credentials from environment variables
-    pguser = os.getenv('pguser')
-    pgpass = os.getenv('pgpass')
-    pghost = os.getenv('pghost')
-
-    # Database connection URL using environment variables
-    db_url = f'postgresql://{pguser}:{pgpass}@{pghost}/FinancialData'
-    engine = create_engine(db_url)
-
     try:
-        # Check if table exists
-        inspector = inspect(engine)
-        tables = inspector.get_table_names(schema=schema)
-        if ticker in tables:
-            # Table exists, retrieve existing dates
-            query = f'SELECT DISTINCT ts_event::date FROM "{schema}"."{ticker}"'
-            df_existing = pd.read_sql(query, con=engine)
-            df_existing['ts_event'] = pd.to_datetime(df_existing['ts_event'],utc=True)
-            dates = pd.DatetimeIndex(df_existing['ts_event'].sort_values())
-            return dates
-        else:
+        coverage = get_symbol_coverage(ticker, schema)
+        if coverage is None:
             return None
+        return pd.DatetimeIndex(coverage['dates']).tz_localize('UTC')
     except Exception as e:
-        print(f"Error retrieving existing dates for {ticker}: {e}")
+        log_error(logger, f"Error retrieving existing dates for {ticker}", e)
+        return None
+
+def _range_bounds(start_date, end_date):
+    # Bounds of the ts_event >= start AND ts_event < end filter, or None without a range (see pg_store.end_bound)
+    if start_date is None or end_date is None:
         return None
-    finally:
-        engine.dispose()
+    start = pd.Timestamp(start_date)
+    start = start.tz_localize('UTC') if start.tzinfo is None else start
+    return {'start': start.to_pydatetime(), 'end': pg_store.end_bound(end_date).to_pydatetime()}
 
-def get_data_from_postgresql(ticker, start_date=None, end_date=None, schema='databento_ohlcv'):
+def iter_data_from_postgresql(ticker, start_date=None, end_date=None, schema='databento_ohlcv', columns=None,
+                              chunk_rows=None, engine=None, since=None):
+    """
+    Streams a ticker's bars in ts_event order as DataFrames of at most chunk_rows rows, so memory stays bounded.
+    Each chunk is one keyset-paginated range query on the ts_event index (ts_event after the last one read),
+    copied out with COPY ... TO STDOUT (FORMAT binary) and decoded straight into typed columns; ts_event arrives
+    as UTC datetime64[ns] and is never parsed. BIGINT prices (databento_price_type=fixed) arrive as int64 fixed-point.
+    Args:
+        ticker (str): The ticker table.
+        start_date, end_date (str or datetime, optional): Date range, like get_data_from_postgresql.
+        schema (str): PostgreSQL schema of the table. Defaults to 'databento_ohlcv'.
+        columns (list, optional): Columns to read besides ts_event (COPY_TYPES keys). Defaults to LEAN_SOURCE_COLUMNS.
+        chunk_rows (int, optional): Rows per chunk. Defaults to the pg_read_chunk_rows environment variable (500,000).
+        engine (str, optional): 'pandas' or 'polars', see lean_writer.get_engine.
+        since (datetime, optional): First ts_event to read, narrowing the range to its tail.
+    Yields:
+        pd.DataFrame (or pl.DataFrame with engine='polars'): ts_event and the columns.
+    """
+    types = {col: COPY_TYPES[col] for col in ['ts_event'] + list(columns or LEAN_SOURCE_COLUMNS)}
+    chunk_rows = chunk_rows or READ_CHUNK_ROWS
+    with timed_connection('iter_data_from_postgresql') as conn:
+        # Fixed-point prices are copied as they are stored
+        types = pg_store.price_copy_types(types, pg_store.stored_price_type(conn, f'"{schema}"."{ticker}"'))
+    # Casts pin every column to the fixed-width type the decoder expects, NULLs read as NaN prices or 0 volume
+    select = ', '.join(pg_store.copy_column(col, pg_type) for col, pg_type in types.items())
+    filters, params = [], {'limit': chunk_rows}
+    bounds = _range_bounds(start_date, end_date)
+    if bounds:
+        filters.append('ts_event >= %(start)s AND ts_event < %(end)s')
+        params.update(bounds)
+    if since is not None:
+        filters.append('ts_event >= %(since)s')
+        params['since'] = pd.Timestamp(since).to_pydatetime()
+    after = None
+    while True:
+        where = filters + (['ts_event > %(after)s'] if after is not None else [])
+        query = (f'COPY (SELECT {select} FROM "{schema}"."{ticker}"'
+                 f'{" WHERE " + " AND ".join(where) if where else ""} ORDER BY ts_event LIMIT %(limit)s) '
+                 f'TO STDOUT (FORMAT binary)')
+        with span('db_read', ticker=ticker, mode='copy_binary') as s, \
+                timed_connection('iter_data_from_postgresql') as conn:
+            data = copy_to_bytes(conn, query, dict(params, after=after))
+            decoded = decode_copy_binary(data, types)
+            s.add(rows=len(decoded['ts_event']), bytes=len(data))
+        rows = len(decoded['ts_event'])
+        if rows:
+            yield pg_store.frame_from_columns(decoded, engine)
+        if rows < chunk_rows:
+            return
+        after = pd.Timestamp(decoded['ts_event'][-1], tz='UTC').to_pydatetime()
+
+def get_data_from_postgresql(ticker, start_date=None, end_date=None, schema='databento_ohlcv', engine=None, columns=None):
     """
     Retrieves data for a given ticker from PostgreSQL database, optionally within a date range.
+    The range is a bound-parameter filter on ts_event, served by the table's ts_event index.
+    columns restricts the read to ts_event and those columns (default: every column). The OHLCV columns are read
+    through the binary COPY path of iter_data_from_postgresql, other columns with a regular query.
+    Returns a pd.DataFrame, or a pl.DataFrame with engine='polars'.
     """
-    # Fetch credentials from environment variables
-    pguser = os.getenv('pguser')
-    pgpass = os.getenv('pgpass')
-    pghost = os.getenv('pghost')
-
-    # Database connection URL using environment variables
-    db_url = f'postgresql://{pguser}:{pgpass}@{pghost}/FinancialData'
-    engine = create_engine(db_url)
-
     try:
+        if columns and set(columns) <= set(COPY_TYPES):
+            frames = list(iter_data_from_postgresql(ticker, start_date, end_date, schema, columns, engine=engine))
+            if get_engine(engine) == 'polars':
+                import polars as pl
+                return pl.concat(frames) if frames else pl.DataFrame()
+            return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=['ts_event'] + list(columns))
+
         # Build the query
-        query = f'SELECT * FROM "{schema}"."{ticker}"'
-        if start_date is not None and end_date is not None:
-            # Convert date string to datetime object
-            if not isinstance(start_date, datetime):
-                start_date = datetime.strptime(start_date, '%Y-%m-%d')
-            if not isinstance(end_date, datetime):
-                end_date = datetime.strptime(end_date, '%Y-%m-%d')
-            
-            query += f" WHERE ts_event BETWEEN '{start_date.strftime('%Y-%m-%d')}' AND '{end_date.strftime('%Y-%m-%d')}'"
-        df = pd.read_sql(query, con=engine)
+        select = ', '.join(f'"{col}"' for col in ['ts_event'] + list(columns)) if columns else '*'
+        query = f'SELECT {select} FROM "{schema}"."{ticker}"'
+        params = _range_bounds(start_date, end_date) or {}
+        if params:
+            query += ' WHERE ts_event >= :start AND ts_event < :end'
+        # Upserted rows are not stored in time order, the LEAN writers expect sorted bars
+        query += ' ORDER BY ts_event'
+        with span('db_read', ticker=ticker) as s, timed_connection('get_data_from_postgresql') as conn:
+            if get_engine(engine) == 'polars':
+                import polars as pl
+                df = pl.read_database(text(query), connection=conn, execute_options={'parameters': params})
+                s.add(rows=len(df))
+                return df
+            df = pd.read_sql(text(query), con=conn, params=params)
+            s.add(rows=len(df))
         
         # Ensure ts_event is parsed as timezone-aware datetime
         df['ts_event'] = pd.to_datetime(df['ts_event'], utc=True)
         
         return df
     except Exception as e:
-        print(f"Error retrieving data for {ticker} from PostgreSQL: {e}")
+        log_error(logger, f"Error retrieving data for {ticker} from PostgreSQL", e)
         return None
-    finally:
-        engine.dispose()
-
-def convert_to_lean_format(df, ticker, frequency='daily'):
-    # Convert 'ts_event' to America/New_York timezone and required date format
-    df['date'] = df['ts_event'].dt.tz_convert('America/New_York').dt.strftime('%Y%m%d %H:%M')
-
-    # Select required columns without copying
-    df = df[['date', 'open', 'high', 'low', 'close', 'volume']]
-
-    # Use .loc for assignment to avoid the warning
-    df.loc[:, ['open', 'high', 'low', 'close']] = (df[['open', 'high', 'low', 'close']] * 10000).astype(int)
-
-    # Data type sorting for directory saving for csv
-    if frequency == 'daily':
-        output_dir = 'data/equity/usa/daily/'
-        output_file = f"{output_dir}{ticker.lower()}.csv"
-    elif frequency == 'hourly':
-        output_dir = 'data/equity/usa/hourly/'
-        output_file = f"{output_dir}{ticker.lower()}.csv"
-    else:
-        output_dir = 'data/equity/usa/minute/'
-        output_file = f"{output_dir}{ticker.lower()}.csv"
 
-    # Ensure the output directory exists
-    os.makedirs(output_dir, exist_ok=True)
+def _summarize_source(ticker, start, end, schema, store_schema=None, split=None):
+    # Aggregates of pg_store.summary_query over start <= ts_event < end, raises SQLAlchemyError
+    if store_schema is not None:
+        return pg_store.summarize(ticker, store_schema, start, end, schema, split)
+    query = pg_store.summary_query(f'"{schema}"."{ticker}"', 'ts_event >= :start AND ts_event < :end', split is not None)
+    params = _range_bounds(start, end)
+    if split is not None:
+        params['split'] = split.to_pydatetime()
+    with span('db_read', ticker=ticker, query='fingerprint'), timed_connection('get_source_fingerprint') as conn:
+        return tuple(conn.execute(query, params).one())
+
+def get_source_fingerprints(ticker, start_date, end_date, frequency, schema='databento_ohlcv', session=None,
+                            store_schema=None, previous=None):
+    """
+    Fingerprints the rows convert_stored_data would read, with one aggregate query instead of reading them.
+    The content hash is the sum of a 64-bit hash of every row, computed in PostgreSQL.
+    session is the aggregation session when the bars are resampled, see resolution.py.
+    With store_schema (a Data Bento schema) the rows are the ticker's in the partitioned store (pg_store.py) held in schema.
+    previous is the manifest's last source fingerprint: the rows up to its max_ts_event are fingerprinted again
+    in the same scan, under its key, so they can be compared with it (see get_append_start).
+    Returns:
+        tuple: (fingerprint, fingerprint of the rows up to previous's max_ts_event), see lean_manifest.fingerprint.
+            Either is None when the table cannot be queried or there is no previous conversion.
+    """
+    start, end = start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d')
+    bounds = _range_bounds(start_date, end_date)
+    split = None
+    if previous is not None and previous.get('max_ts_event') is not None:
+        split = pd.Timestamp(previous['max_ts_event'])
+    try:
+        summary = _summarize_source(ticker, bounds['start'], bounds['end'], schema, store_schema, split)
+    except SQLAlchemyError as e:
+        logger.debug(f"No source fingerprint for {ticker}: {e!r}")
+        return None, None
+    key = {'schema': schema, 'frequency': frequency, 'start': start, 'end': end,
+           'output_root': os.path.abspath(LEAN_EQUITY_ROOT)}
+    if store_schema is not None:
+        key['store_schema'] = store_schema
+    if session:
+        key['session'] = session
+    rows, max_ts_event, content_hash = summary[:3]
+    prefix = None
+    if split is not None:
+        prefix_rows, prefix_max, prefix_hash = summary[3:]
+        prefix = fingerprint(previous['key'], prefix_rows, prefix_max, [prefix_hash])
+    return fingerprint(key, rows, max_ts_event, [content_hash]), prefix
+
+def get_source_fingerprint(ticker, start_date, end_date, frequency, schema='databento_ohlcv', session=None,
+                           store_schema=None):
+    """
+    Returns the fingerprint of the rows convert_stored_data would read, see get_source_fingerprints.
+    """
+    return get_source_fingerprints(ticker, start_date, end_date, frequency, schema, session, store_schema)[0]
+
+def get_append_start(ticker, manifest, source_fingerprint, prefix_fingerprint):
+    """
+    Finds where the LEAN outputs can be extended from instead of rebuilt: the conversion must only have grown
+    (lean_manifest.extendable_source) and the rows converted last time must be unchanged, i.e. prefix_fingerprint
+    (from get_source_fingerprints) must equal the recorded fingerprint.
+    Returns:
+        pd.Timestamp: UTC start of the exchange date of the last converted row, from which the outputs are rewritten
+            (a partial last day may have grown), or None when a full conversion is needed.
+    """
+    previous = extendable_source(manifest, source_fingerprint)
+    if previous is None or prefix_fingerprint is None:
+        return None
+    last = pd.Timestamp(previous['max_ts_event'])
+    if prefix_fingerprint != previous:
+        logger.info(f'{ticker} rows up to {last} changed since the last conversion, the LEAN data is rebuilt')
+        return None
+    return last.tz_convert(LEAN_TIMEZONE).normalize().tz_convert('UTC')
+
+def convert_to_lean_format(df, ticker, frequency='daily', max_workers=None, keep_csv=False, engine=None, force=False):
+    # The Polars engine formats the rows with multi-threaded expressions, the output bytes are the same
+    polars = get_engine(engine) == 'polars'
 
-    df.to_csv(output_file, index=False, header=False)
+    # Minute data is written as one zip per trading day, days are encoded in parallel
+    if frequency == 'minute':
+        write_minute = write_lean_minute_data_polars if polars else write_lean_minute_data
+        zip_files = write_minute(df, ticker, max_workers=max_workers, force=force)
+        logger.info(f"{len(zip_files)} trading days for {ticker} written to data/equity/usa/minute/{ticker.lower()}/.")
+        return
 
-    # Zip the CSV file
-    zip_file = os.path.join(output_dir, f'{ticker.lower()}.zip')
-    with zipfile.ZipFile(zip_file, 'w') as zf:
-        zf.write(output_file, arcname=f'{ticker.lower()}.csv')
+    # Encode rows in America/New_York time with deci-cent prices and stream them straight into the zip
+    # The plain CSV is only written next to the zip when keep_csv is set
+    write_bars = write_lean_bars_polars if polars else write_lean_bars
+    zip_file = write_bars(df, ticker, frequency, keep_csv=keep_csv, force=force)
 
-    # Optionally, remove the csv file after zipping (if you want the zip to be the only output)
-    # os.remove(output_file)
+    logger.info(f"{ticker} has been successfully converted into {zip_file}.")
 
-    print(f"{output_file} has been successfully zipped into {zip_file}.")
+# Coverage manifests (fetched date intervals per ticker) are kept next to the downloads
+COVERAGE_FOLDER = 'databento/coverage'
 
-def download_and_append_data(ticker, start_date, end_date, frequency='daily'):
+def get_coverage(ticker, schema='ohlcv-1d'):
+    """
+    Returns the fetched date intervals for a ticker from its coverage manifest.
+    Tickers loaded before manifests existed seed the manifest from the dates stored in PostgreSQL.
+    """
+    intervals = load_coverage(ticker, schema, COVERAGE_FOLDER)
+    if intervals is None:
+        if pg_store.use_partitioned_store():
+            dates = pg_store.get_existing_dates(ticker, schema)
+        else:
+            dates = get_existing_dates_from_postgresql(ticker, PG_SCHEMAS[schema])
+        intervals = intervals_from_dates(dates)
+    return intervals
+
+def fetch_missing_data(ticker, start_date, end_date, schema='ohlcv-1d'):
+    """
+    Fetch stage: requests the trading-day ranges missing from the ticker's coverage manifest for the schema.
+    Responses are returned undecoded so the store stage can decode them in record batches.
+    Returns:
+        tuple: (missing ranges, coverage intervals, iterable of DBNStore read one at a time), nothing is fetched when
+            missing is empty.
+    """
+    intervals = get_coverage(ticker, schema)
+    missing = missing_ranges(intervals, pd.to_datetime(start_date), pd.to_datetime(end_date))
+    # Data Bento's end date is exclusive, so each range is requested through the following day. Every range goes
+    # through the request planner: checked against databento_max_cost, split into bounded chunks and resumable
+    stores = chain.from_iterable([get_range_planned(ticker, start, end + timedelta(days=1), schema=schema)
+                                  for start, end in missing])
+    return missing, intervals, stores
+
+def store_fetched_data(ticker, fetched, schema='ohlcv-1d'):
+    """
+    Store stage: upserts the output of fetch_missing_data into PostgreSQL and marks the ranges covered.
+    The fetched data can also be DataFrames already decoded, e.g. from a batched request.
+    Each Data Bento schema is kept in its own PostgreSQL schema (see PG_SCHEMAS), or in the partitioned store
+    with pg_layout=partitioned.
+    """
+    missing, intervals, stores = fetched
+    if pg_store.use_partitioned_store():
+        # One multi-symbol table keyed by (symbol, schema, ts_event), see pg_store.py
+        upsert = partial(pg_store.upsert_bars, schema=schema, symbol=ticker)
+    else:
+        upsert = partial(upsert_to_postgresql, ticker=ticker, schema=PG_SCHEMAS[schema])
+    # Only the new rows are loaded and merged on ts_event, existing history stays in PostgreSQL
+    last_received = None
+    for store in stores:
+        if isinstance(store, pd.DataFrame):
+            # Ensure ts_event is not set as index
+            df = store.reset_index() if store.index.name == 'ts_event' else store
+            df['ts_event'] = pd.to_datetime(df['ts_event'], utc=True)
+            upsert(df)
+            last_received = last_event(df, last_received)
+            continue
+        # Decode and upsert in record batches so a large pull is never held as one DataFrame
+        for chunk in iter_dbn_frames(store):
+            df = prepare_databento_df(chunk)
+            upsert(df)
+            last_received = last_event(df, last_received)
+    if missing:
+        # Dates past the last bar received are only marked once they are settled
+        mark_covered(ticker, schema, COVERAGE_FOLDER, missing, intervals, last_received)
+
+def convert_stored_data(ticker, start_date, end_date, frequency='daily', max_workers=None, engine=None, force=False,
+                        source=None, session=None, keep_csv=False):
+    """
+    Convert stage: reads the date range from PostgreSQL and converts it to LEAN format.
+    Bars are read from the schema of the frequency, or aggregated from a finer source resolution (see resolution.py).
+    Nothing is read when the rows in the range are the ones the current LEAN outputs were converted from.
+    keep_csv keeps the plain {ticker}.csv next to a daily or hourly zip, whether it is rewritten or extended.
+    Raises ValueError when there is nothing to convert.
+    """
+    polars = get_engine(engine) == 'polars'
+    source = source_resolution(frequency, source)
+    schema = schema_for(source)
+    partitioned = pg_store.use_partitioned_store()
+    pg_schema = pg_store.get_store_schema() if partitioned else PG_SCHEMAS[schema]
+    # UTC bounds of the trading dates, the end exclusive: the last day's bars are all read (resolution.session_bounds)
+    start_date, end_date = session_bounds(start_date, end_date, schema)
+
+    session = get_session(session) if source != frequency else None
+    store_schema = schema if partitioned else None
+    manifest = load_manifest(ticker, frequency)
+    source_fingerprint, prefix_fingerprint = get_source_fingerprints(
+        ticker, start_date, end_date, frequency, pg_schema, session, store_schema, None if force else manifest['source'])
+    if not force and source_unchanged(manifest, source_fingerprint):
+        logger.info(f'{ticker} {frequency} LEAN data is up to date with PostgreSQL, skipped')
+        return
+
+    # New rows after an unchanged history only extend the outputs, from the last converted day on
+    since = None if force else get_append_start(ticker, manifest, source_fingerprint, prefix_fingerprint)
+    if since is not None:
+        if partitioned:
+            frames = (bars[['ts_event'] + LEAN_SOURCE_COLUMNS] for bars in pg_store.iter_bars(
+                ticker, schema, since, end_date, LEAN_SOURCE_COLUMNS, pg_schema))
+        else:
+            frames = iter_data_from_postgresql(ticker, start_date, end_date, pg_schema, LEAN_SOURCE_COLUMNS, since=since)
+        if source != frequency:
+            frames = iter_resampled(frames, frequency, session)
+        # Both engines write the same bytes, the few new bars are encoded with NumPy
+        if frequency == 'minute':
+            write_lean_minute_data(frames, ticker, max_workers=max_workers)
+        else:
+            append_lean_bars(frames, ticker, frequency, keep_csv=keep_csv)
+        record_source(ticker, frequency, source_fingerprint)
+        logger.info(f'{ticker} {frequency} LEAN data extended from {since.date()}')
+        return
+
+    # Fetch the data from PostgreSQL for the required date range
+    # Typed chunks stream from PostgreSQL into the writers (as Polars frames with that engine), the history is never
+    # held at once
+    if partitioned:
+        # Keyset-paginated chunks of the store
+        chunks = (bars[['ts_event'] + LEAN_SOURCE_COLUMNS] for bars in pg_store.iter_bars(
+            ticker, schema, start_date, end_date, LEAN_SOURCE_COLUMNS, pg_schema, engine))
+    else:
+        # Binary COPY of the ticker's table
+        chunks = iter_data_from_postgresql(ticker, start_date, end_date, pg_schema, LEAN_SOURCE_COLUMNS, engine=engine)
+    try:
+        first = next(chunks, None)
+    except Exception as e:
+        log_error(logger, f"Error retrieving data for {ticker} from PostgreSQL", e)
+        first = None
+    if first is None or len(first) == 0:
+        raise ValueError(f"No data available for {ticker} to convert.")
+
+    if polars:
+        # Read straight into Polars, the writers normalise ts_event to UTC
+        frames = chain([first], chunks)
+        if source != frequency:
+            # Whole trading days are aggregated at a time, so no bar is split between two chunks
+            frames = (resample_polars(df, frequency, session).collect() for df in iter_polars_chunks(frames))
+        convert_to_lean_format(frames, ticker, frequency, max_workers=max_workers, keep_csv=keep_csv, engine=engine,
+                               force=force)
+        record_source(ticker, frequency, source_fingerprint)
+        return
+
+    # ts_event is already a UTC datetime column, the chunks are not parsed again
+    frames = chain([first], chunks)
+
+    # Coarser bars are aggregated locally from the stored finer ones, chunk by chunk
+    if source != frequency:
+        frames = iter_resampled(frames, frequency, session)
+
+    # Convert to LEAN format
+    convert_to_lean_format(frames, ticker, frequency, max_workers=max_workers, keep_csv=keep_csv, force=force)
+    record_source(ticker, frequency, source_fingerprint)
+
+def download_and_append_data(ticker, start_date, end_date, frequency='daily', df_new=None, engine=None, source=None):
     """
     Downloads and appends stock data from Data Bento API if necessary, then converts the data to LEAN format.
+    Only the trading-day ranges missing from the ticker's coverage manifest are requested.
+    df_new can carry data already fetched for those ranges (see download_and_append_data_batch).
+    engine picks the LEAN conversion engine, 'pandas' or 'polars' (default: lean_engine environment variable).
+    source picks a finer resolution to fetch and aggregate from, e.g. 'minute' (default: lean_source_resolution
+    environment variable, else the frequency's own schema, see resolution.py).
     """
     # Convert start_date and end_date to datetime objects
     start_date = pd.to_datetime(start_date)
     end_date = pd.to_datetime(end_date)
-    
-    # Localize the datetime to NY time (exchange time zone)
-    start_date = start_date.tz_localize('America/New_York').astimezone(pytz.utc)
-    end_date = end_date.tz_localize('America/New_York').astimezone(pytz.utc)
-
-    # Fetch existing dates from PostgreSQL
-    dates = get_existing_dates_from_postgresql(ticker)
-    
-    # Ensure dates are in UTC
-    if dates is not None:
-        dates = dates.tz_convert('UTC')
-    
-    # If dates is None or date range is not covered
-    if dates is None or start_date.date() < dates[0].date() or end_date.date() > dates[-1].date():
-        print(f'Fetching data for {ticker} from {start_date.date()} to {end_date.date()}')
-
-        # Attempt to fetch new data from Data Bento
-        try:
-            # Add buffer (delta) to the date range to handle overlaps
-            delta = timedelta(days=3)
-            df_new = get_data_from_databento(ticker, start_date - delta, end_date + delta)
+    # Data Bento schema the frequency is fetched and stored as
+    schema = source_schema(frequency, source)
 
-            # Ensure ts_event is not set as index
-            if df_new.index.name == 'ts_event':
-                df_new.reset_index(inplace=True)
-
-            # If data exists in the database, append new data
-            if dates is not None:
-                # Fetch existing data
-                df_existing = get_data_from_postgresql(ticker)
-                df_existing['ts_event'] = pd.to_datetime(df_existing['ts_event'], utc=True)
-                # Ensure ts_event is not set as index
-                if df_existing.index.name == 'ts_event':
-                    df_existing.reset_index(inplace=True)
-
-                # Combine data and remove duplicates based on ts_event
-                df_combined = pd.concat([df_existing, df_new], ignore_index=True)
-                df_combined.drop_duplicates(subset='ts_event', keep='last', inplace=True)
-                df_combined['ts_event'] = pd.to_datetime(df_combined['ts_event'], utc=True)
-                df_combined.sort_values(by='ts_event', inplace=True)
-                # Upload the amended data to PostgreSQL
-                upload_to_postgresql(df_combined, ticker)
-            else:
-                # Upload the new data to PostgreSQL
-                upload_to_postgresql(df_new, ticker)
-            print(f'Ticker {ticker} data updated in PostgreSQL')
+    # Attempt to fetch new data from Data Bento
+    try:
+        # Work out which trading-day ranges (exchange dates) have not been fetched yet
+        if df_new is None:
+            fetched = fetch_missing_data(ticker, start_date, end_date, schema)
+        else:
+            intervals = get_coverage(ticker, schema)
+            fetched = (missing_ranges(intervals, start_date, end_date), intervals, [df_new])
+        missing = fetched[0]
+
+        # If part of the date range is not covered
+        if missing:
+            logger.info(f'Fetching data for {ticker}: {len(missing)} missing range(s) between {start_date.date()} and {end_date.date()}')
+            store_fetched_data(ticker, fetched, schema)
+            logger.info(f'Ticker {ticker} data updated in PostgreSQL')
+        else:
+            logger.info(f'Ticker {ticker} already up-to-date')
+    except Exception as e:
+        log_error(logger, f'Error fetching data for {ticker}', e)
+        return None
 
-        except Exception as e:
-            print(f'Error fetching data for {ticker}: {e}')
-            return None
-    else:
-        print(f'Ticker {ticker} already up-to-date')
+    try:
+        convert_stored_data(ticker, start_date, end_date, frequency, engine=engine, source=source)
+    except ValueError as e:
+        logger.warning(str(e))
+        return None
+    logger.info(f'Data for {ticker} fetched from postgres, converted to LEAN format.')
 
-    # Fetch the data from PostgreSQL for the required date range
-    df = get_data_from_postgresql(ticker, start_date, end_date)
-    if df is not None and not df.empty:
-        # Ensure ts_event is not set as index
-        if df.index.name == 'ts_event':
-            df.reset_index(inplace=True)
+    return ticker
 
-        # Ensure ts_event is timezone-aware
-        df['ts_event'] = pd.to_datetime(df['ts_event'], utc=True)
+def download_and_append_data_concurrent(ticker_list, start_date, end_date, frequency='daily', engine=None, source=None,
+                                        **pipeline_options):
+    """
+    Concurrent version of download_and_append_data. Fetches run in threads under the Data Bento request limits,
+    upserts in a bounded writer stage sharing the connection pool and LEAN conversions in a process pool,
+    overlapping across tickers. pipeline_options are passed to pipeline.run_pipeline
+    (fetch_workers, requests_per_second, store_workers, convert_workers, ...).
+    Returns a pipeline.TickerStatus per ticker.
+    """
+    schema = source_schema(frequency, source)
+    return run_pipeline(
+        ticker_list,
+        fetch=partial(fetch_missing_data, start_date=start_date, end_date=end_date, schema=schema),
+        store=partial(store_fetched_data, schema=schema),
+        # Tickers are already converted in parallel, each one is written serially
+        convert=partial(convert_stored_data, start_date=start_date, end_date=end_date, frequency=frequency, max_workers=1,
+                        engine=engine, source=source),
+        **pipeline_options
+    )
 
-        # Convert to LEAN format
-        convert_to_lean_format(df, ticker, frequency)
-        print(f'Data for {ticker} fetched from postgres, converted to LEAN format.')
-    else:
-        print(f"No data available for {ticker} to convert.")
-        return None
+def download_and_append_data_batch(ticker_list, start_date, end_date, frequency='daily', engine=None, source=None):
+    """
+    Batched version of download_and_append_data. Tickers missing the same date ranges are fetched together
+    in as few Data Bento requests as possible, then appended and converted per ticker.
+    Returns the list of tickers processed successfully.
+    """
+    start = pd.to_datetime(start_date)
+    end = pd.to_datetime(end_date)
+    schema = source_schema(frequency, source)
 
-    return ticker
+    # Group tickers by their missing ranges, a daily top-up usually leaves one group
+    groups = {}
+    for ticker in ticker_list:
+        missing = missing_ranges(get_coverage(ticker, schema), start, end)
+        if missing:
+            groups.setdefault(tuple(missing), []).append(ticker)
+
+    frames = {}
+    stale = set()
+    for missing, tickers in groups.items():
+        stale.update(tickers)
+        logger.info(f'Fetching data for {len(tickers)} tickers: {len(missing)} missing range(s) between {start.date()} and {end.date()}')
+        try:
+            # Data Bento's end date is exclusive, so each range is requested through the following day
+            parts = [get_data_from_databento_batch(tickers, s, e + timedelta(days=1), schema) for s, e in missing]
+            frames.update({ticker: prepare_databento_df(pd.concat([part[ticker] for part in parts])) for ticker in tickers})
+        except Exception as e:
+            log_error(logger, 'Error fetching batch data', e)
+
+    processed = []
+    for ticker in ticker_list:
+        if ticker in stale and ticker not in frames:
+            # The batch request failed, leave the ticker for the next run
+            continue
+        if download_and_append_data(ticker, start_date, end_date, frequency, df_new=frames.get(ticker), engine=engine,
+                                    source=source) is not None:
+            processed.append(ticker)
+    return processed
 
 # Example ticker list and date range
 if __name__ == '__main__':
+    # Log level/format and the metrics file come from the lean_log_* and lean_metrics_* environment variables
+    configure()
     ticker_list = ['QQQ']
-    for ticker in ticker_list:
-        download_and_append_data(ticker, '2023-09-01', '2023-12-31', frequency='daily')
+    statuses = download_and_append_data_concurrent(ticker_list, '2023-09-01', '2023-12-31', frequency='daily')
+    print_statuses(statuses)
+    # Pool checkout versus query time per helper across the run
+    print_timings()
@@ -0,0 +1,237 @@
+from contextlib import contextmanager
+import threading
+import logging
+import atexit
+import json
+import time
+import os
+
+'''
+Stage-level instrumentation for the download, storage and LEAN conversion paths.
+Stages are wrapped in timed spans that carry counters (rows, bytes, requests, files, ...):
+
+    with span('db_write', ticker=ticker) as s:
+        ...
+        s.add(rows=len(df), bytes=size)
+
+Every span adds its duration, error and counters to a process-wide registry (a lock and a few dict updates,
+cheap enough to leave on) and is logged at DEBUG, failures at ERROR with the traceback.
+Logging and export are set up with configure(), from arguments or environment variables:
+    lean_log_level       - logging level, default INFO
+    lean_log_format      - 'text' (default) or 'json', one JSON object per line with the span fields
+    lean_metrics_file    - write the registry to this file when the process exits
+    lean_metrics_format  - 'prometheus' (default, text exposition format for a textfile collector)
+                           or 'otlp' (OpenTelemetry OTLP/JSON metrics, one line per export)
+'''
+
+logger = logging.getLogger('lean_pipeline')
+
+_metrics = {}
+_metrics_lock = threading.Lock()
+_start_time_ns = time.time_ns()
+
+class Span:
+    """
+    A running stage. add() accumulates counters reported when the span ends.
+    """
+    __slots__ = ('stage', 'attributes', 'counts')
+
+    def __init__(self, stage, attributes):
+        self.stage = stage
+        self.attributes = attributes
+        self.counts = {}
+
+    def add(self, **counts):
+        for name, value in counts.items():
+            self.counts[name] = self.counts.get(name, 0) + value
+
+@contextmanager
+def span(stage, **attributes):
+    """
+    Times a stage and records it in the registry, see the module docstring.
+    Args:
+        stage (str): Stage name, e.g. 'vendor_fetch', 'db_read', 'merge', 'db_write', 'lean_encode', 'zip_write'.
+        **attributes: Context for the log line only (ticker, schema, ...), not metric labels.
+    Yields:
+        Span: Call add(rows=..., bytes=...) on it.
+    """
+    current = Span(stage, attributes)
+    start = time.perf_counter()
+    error = None
+    try:
+        yield current
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        seconds = time.perf_counter() - start
+        _record(stage, seconds, current.counts, error is not None)
+        if error is not None:
+            fields = {'stage': stage, 'seconds': seconds, 'error': repr(error), **attributes, **current.counts}
+            # The innermost span logs the traceback, enclosing spans only note the failure
+            if getattr(error, '_span_logged', False):
+                logger.debug(f'{stage} failed after {seconds:.3f}s: {error!r}', extra={'fields': fields})
+            else:
+                logger.error(f'{stage} failed after {seconds:.3f}s: {error!r}', exc_info=error, extra={'fields': fields})
+                try:
+                    error._span_logged = True
+                except AttributeError:
+                    pass
+        elif logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f'{stage} took {seconds:.3f}s',
+                         extra={'fields': {'stage': stage, 'seconds': seconds, **attributes, **current.counts}})
+
+def log_error(log, message, error):
+    """
+    Logs a caught exception at ERROR, with the traceback unless a span already logged it.
+    """
+    log.error(f'{message}: {error!r}', exc_info=None if getattr(error, '_span_logged', False) else error)
+
+def record(stage, seconds, **counts):
+    """
+    Records an already-timed stage, for loops where a context manager does not fit (e.g. iterator pulls).
+    """
+    _record(stage, seconds, counts, False)
+
+def _record(stage, seconds, counts, failed):
+    with _metrics_lock:
+        stats = _metrics.get(stage)
+        if stats is None:
+            stats = _metrics[stage] = {'calls': 0, 'errors': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'counts': {}}
+        stats['calls'] += 1
+        stats['errors'] += failed
+        stats['seconds'] += seconds
+        stats['max_seconds'] = max(stats['max_seconds'], seconds)
+        for name, value in counts.items():
+            stats['counts'][name] = stats['counts'].get(name, 0) + value
+
+def get_metrics():
+    """
+    Returns a copy of the registry: stage -> {'calls', 'errors', 'seconds', 'max_seconds', 'counts': {name: total}}.
+    """
+    with _metrics_lock:
+        return {stage: dict(stats, counts=dict(stats['counts'])) for stage, stats in _metrics.items()}
+
+def merge_metrics(metrics):
+    """
+    Adds a registry snapshot from another process (see get_metrics) into this one.
+    """
+    with _metrics_lock:
+        for stage, other in metrics.items():
+            stats = _metrics.setdefault(stage, {'calls': 0, 'errors': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'counts': {}})
+            stats['calls'] += other['calls']
+            stats['errors'] += other['errors']
+            stats['seconds'] += other['seconds']
+            stats['max_seconds'] = max(stats['max_seconds'], other['max_seconds'])
+            for name, value in other['counts'].items():
+                stats['counts'][name] = stats['counts'].get(name, 0) + value
+
+def reset_metrics():
+    with _metrics_lock:
+        _metrics.clear()
+
+def format_prometheus(metrics=None):
+    """
+    Renders the registry in the Prometheus text exposition format.
+    """
+    metrics = get_metrics() if metrics is None else metrics
+    series = {
+        'lean_stage_calls_total': ('counter', 'Spans completed per stage.', lambda s: s['calls']),
+        'lean_stage_errors_total': ('counter', 'Spans that raised per stage.', lambda s: s['errors']),
+        'lean_stage_seconds_total': ('counter', 'Seconds spent per stage.', lambda s: s['seconds']),
+        'lean_stage_max_seconds': ('gauge', 'Longest single span per stage.', lambda s: s['max_seconds']),
+    }
+    for name in sorted({name for stats in metrics.values() for name in stats['counts']}):
+        series[f'lean_stage_{name}_total'] = ('counter', f'{name} counted per stage.',
+                                              lambda s, name=name: s['counts'].get(name, 0))
+    lines = []
+    for metric, (kind, help_text, value) in series.items():
+        lines.append(f'# HELP {metric} {help_text}')
+        lines.append(f'# TYPE {metric} {kind}')
+        for stage in sorted(metrics):
+            lines.append(f'{metric}{{stage="{stage}"}} {value(metrics[stage])}')
+    return '\n'.join(lines) + '\n'
+
+def format_otlp(metrics=None):
+    """
+    Renders the registry as one OpenTelemetry OTLP/JSON metrics export (cumulative sums per stage).
+    """
+    metrics = get_metrics() if metrics is None else metrics
+    now = str(time.time_ns())
+
+    def sum_metric(name, unit, value, as_int=True):
+        points = [{
+            'attributes': [{'key': 'stage', 'value': {'stringValue': stage}}],
+            'startTimeUnixNano': str(_start_time_ns),
+            'timeUnixNano': now,
+            **({'asInt': str(int(value(stats)))} if as_int else {'asDouble': float(value(stats))}),
+        } for stage, stats in sorted(metrics.items())]
+        return {'name': name, 'unit': unit,
+                'sum': {'aggregationTemporality': 2, 'isMonotonic': True, 'dataPoints': points}}
+
+    entries = [
+        sum_metric('lean.stage.calls', '1', lambda s: s['calls']),
+        sum_metric('lean.stage.errors', '1', lambda s: s['errors']),
+        sum_metric('lean.stage.duration', 's', lambda s: s['seconds'], as_int=False),
+    ]
+    for name in sorted({name for stats in metrics.values() for name in stats['counts']}):
+        entries.append(sum_metric(f'lean.stage.{name}', 'By' if name == 'bytes' else '1',
+                                  lambda s, name=name: s['counts'].get(name, 0)))
+    return json.dumps({'resourceMetrics': [{
+        'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': 'lean_external_datavendors'}}]},
+        'scopeMetrics': [{'scope': {'name': 'instrumentation'}, 'metrics': entries}],
+    }]})
+
+def write_metrics(path, metrics_format='prometheus'):
+    """
+    Writes the registry to path. Prometheus output replaces the file atomically, OTLP output appends a line.
+    """
+    if metrics_format == 'otlp':
+        with open(path, 'a') as f:
+            f.write(format_otlp() + '\n')
+        return
+    if metrics_format != 'prometheus':
+        raise ValueError(f"Unknown metrics format {metrics_format!r}, expected 'prometheus' or 'otlp'")
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(format_prometheus())
+    os.replace(tmp_path, path)
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per line: time, level, logger, message and the span fields.
+    """
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+_exporting = False
+
+def configure(level=None, log_format=None, metrics_file=None, metrics_format=None, export=True):
+    """
+    Sets up logging for the scripts and, if a metrics file is given, writes the metrics to it at exit.
+    Arguments default to the environment variables in the module docstring. Worker processes pass export=False:
+    their metrics are merged into the parent's (merge_metrics), which writes the file.
+    """
+    global _exporting
+    level = level or os.getenv('lean_log_level', 'INFO')
+    log_format = log_format or os.getenv('lean_log_format', 'text')
+    handler = logging.StreamHandler()
+    handler.setFormatter(JsonFormatter() if log_format == 'json' else logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level.upper() if isinstance(level, str) else level)
+
+    metrics_file = metrics_file or os.getenv('lean_metrics_file')
+    metrics_format = metrics_format or os.getenv('lean_metrics_format', 'prometheus')
+    if export and metrics_file and not _exporting:
+        _exporting = True
+        atexit.register(write_metrics, metrics_file, metrics_format)
@@ -0,0 +1,454 @@
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial, lru_cache
+from pathlib import Path
+import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import tempfile
+import hashlib
+import logging
+import os
+from sqlalchemy import text
+from raw_store import RAW_STORE_ROOT, list_symbols, list_files, file_time_bounds, read_raw
+from lean_writer import (LEAN_EQUITY_ROOT, NS_PER_DAY, to_deci_cents, civil_from_days, _int_digits, _fixed_digits,
+                         _char_column)
+from lean_manifest import LEAN_MANIFEST_ROOT, atomic_path
+from instrumentation import span, configure, get_metrics, merge_metrics, reset_metrics
+
+'''
+LEAN coarse universe files for the whole stored universe, built from every symbol's daily bars:
+    data/equity/usa/fundamental/coarse/{YYYYMMDD}.csv -> SID,SYMBOL,close,volume,dollar volume (one line per symbol)
+The stores hold each symbol's history on its own (raw-store folders, one PostgreSQL table per ticker) while LEAN
+wants one file per date, so the bars are transposed out of core in two passes:
+    spill:  every symbol is streamed once in bounded chunks (its raw-store files of the months, keyset COPY
+            chunks, or one month of the partitioned store at a time) and its rows are buffered per month, then
+            written as Parquet files under a temporary folder, {spill}/{month}/{n}.parquet, whenever spill_rows
+            rows are held
+    gather: months are handed to worker processes, each reading its month's spill files, sorting them by date and
+            symbol and writing the month's date files
+Dates are the UTC dates of ts_event (the session date of Data Bento and CRSP daily bars). The close is written in
+dollars with four decimals from its LEAN deci-cents (exact from fixed-point prices) and the dollar volume as
+close * volume rounded to whole dollars. The SID is LEAN's equity security identifier with the first date
+(1998-01-02) LEAN gives a symbol without a map file.
+
+Only months whose stored bars changed are regenerated. A digest per symbol and month is kept in
+{lean_manifest_root}/coarse/{source}-{schema}.parquet: the names and sizes of the raw-store files overlapping the
+month (files are never rewritten), or the row count and content hash of the month's rows in PostgreSQL, queried
+only for the symbols whose coverage updated_at moved since the last run. A date file whose content did not change
+is left as it is, and a date left without bars loses its file.
+
+The spill folder is created in the lean_coarse_spill_dir environment variable (default: the system temp folder)
+and flushed every lean_coarse_spill_rows rows (default 1,000,000).
+
+    python lean_coarse.py raw ohlcv-1d        # or: python lean_coarse.py postgresql ohlcv-1d
+'''
+
+logger = logging.getLogger(__name__)
+
+COARSE_DIR = 'fundamental/coarse'
+COARSE_COLUMNS = ['close', 'volume']
+SOURCES = ('raw', 'postgresql')
+SPILL_ROWS = int(os.getenv('lean_coarse_spill_rows', 1_000_000))
+
+# LEAN SecurityIdentifier of a USA equity: base 36 of days since 1899-12-30 * 10^14 + market * 100 + security type
+SID_DEFAULT_DATE = '1998-01-02'
+SID_EPOCH = pd.Timestamp('1899-12-30')
+SID_DAYS_OFFSET = 10 ** 14
+SID_MARKET_USA = 1
+SID_SECURITY_TYPE_EQUITY = 1
+BASE36_DIGITS = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+
+# Row count and content hash (the sum of a 64-bit hash of every row, like pg_store.summary_query) per symbol and month
+MONTH_DIGEST_QUERY = '''
+    SELECT {symbol} AS symbol,
+           (extract(year FROM t.ts_event AT TIME ZONE 'UTC') * 12
+            + extract(month FROM t.ts_event AT TIME ZONE 'UTC') - 1)::int AS month,
+           count(*) AS rows, sum(hashtextextended(t::text, 0)) AS hash
+    FROM {source} AS t
+    WHERE {where}
+    GROUP BY 1, 2
+'''
+
+@lru_cache(maxsize=None)
+def security_id(ticker, first_date=SID_DEFAULT_DATE):
+    """
+    Returns LEAN's SecurityIdentifier string of a USA equity, e.g. 'AAPL R735QTJ8XC9X'.
+    """
+    days = (pd.Timestamp(first_date).normalize() - SID_EPOCH).days
+    value = days * SID_DAYS_OFFSET + SID_MARKET_USA * 100 + SID_SECURITY_TYPE_EQUITY
+    digits = ''
+    while value:
+        value, digit = divmod(value, 36)
+        digits = BASE36_DIGITS[digit] + digits
+    return f'{ticker.upper()} {digits}'
+
+def month_name(month):
+    """
+    Formats a month number (year * 12 + month - 1) as 'YYYY-MM'.
+    """
+    return f'{month // 12:04d}-{month % 12 + 1:02d}'
+
+def _month_start(month):
+    return pd.Timestamp(year=month // 12, month=month % 12 + 1, day=1, tz='UTC')
+
+def _month_days(month):
+    # Days since the epoch of the month's first day and of the next month's first day
+    start = _month_start(month)
+    end = _month_start(month + 1)
+    return start.value // NS_PER_DAY, end.value // NS_PER_DAY
+
+def _month_runs(months):
+    # Contiguous runs of sorted months as (first, last) pairs, so far apart months are read separately
+    runs = []
+    for month in months:
+        if runs and runs[-1][1] == month - 1:
+            runs[-1][1] = month
+        else:
+            runs.append([month, month])
+    return [tuple(run) for run in runs]
+
+def _empty_digests():
+    return pd.DataFrame({'symbol': pd.Series(dtype=object), 'month': pd.Series(dtype=np.int64),
+                         'digest': pd.Series(dtype=object), 'updated': pd.Series(dtype=object)})
+
+def raw_month_digests(schema='ohlcv-1d', root=RAW_STORE_ROOT):
+    """
+    Digests the raw store per symbol and month from the file names, sizes and Parquet footers, reading no data.
+    Returns:
+        pd.DataFrame: symbol, month (year * 12 + month - 1), digest and updated (None).
+    """
+    rows = []
+    for symbol in list_symbols(schema, root):
+        parts = {}
+        for f in list_files(symbol, schema, root):
+            bounds = file_time_bounds(f)
+            if bounds is None:
+                continue
+            first, last = (ts.year * 12 + ts.month - 1 for ts in bounds)
+            for month in range(first, last + 1):
+                parts.setdefault(month, []).append(f'{f.parent.name}/{f.name}:{f.stat().st_size}')
+        for month, names in parts.items():
+            digest = hashlib.sha1('\0'.join(names).encode()).hexdigest()[:16]
+            rows.append((symbol, month, digest, None))
+    return pd.DataFrame(rows, columns=list(_empty_digests().columns)) if rows else _empty_digests()
+
+def _month_digest_rows(conn, query, params, updated):
+    return [(row.symbol, int(row.month), f'{row.rows}:{row.hash}', updated.get(row.symbol))
+            for row in conn.execute(query, params)]
+
+def postgres_month_digests(schema='ohlcv-1d', previous=None):
+    """
+    Digests the PostgreSQL bars per symbol and month: row count and content hash of the month's rows.
+    Only the symbols whose coverage updated_at differs from previous are queried, the others keep their digests.
+    Reads the store with pg_layout=partitioned, otherwise the per-ticker tables of databento_sql.PG_SCHEMAS[schema].
+    Returns:
+        pd.DataFrame: symbol, month (year * 12 + month - 1), digest and updated (the coverage updated_at).
+    """
+    import pg_store
+    from pg_engine import timed_connection
+    from databento_sql import PG_SCHEMAS, COVERAGE_TABLE, get_symbol_coverage
+
+    previous = _empty_digests() if previous is None else previous
+    partitioned = pg_store.use_partitioned_store()
+    if partitioned:
+        pg_schema = pg_store.get_store_schema()
+        coverage = f'"{pg_schema}".{pg_store.COVERAGE_TABLE}'
+        coverage_query = text(f'SELECT symbol, updated_at FROM {coverage} WHERE schema = :schema')
+    else:
+        pg_schema = PG_SCHEMAS[schema]
+        coverage = f'"{pg_schema}".{COVERAGE_TABLE}'
+        coverage_query = text(f'SELECT symbol, updated_at FROM {coverage}')
+        # Tables written before the coverage metadata existed get their row now
+        with timed_connection('coarse_coverage') as conn:
+            exists = conn.execute(text('SELECT to_regclass(:name) IS NOT NULL'), {'name': coverage}).scalar()
+            covered = {row[0] for row in conn.execute(text(f'SELECT symbol FROM {coverage}'))} if exists else set()
+        for ticker in pg_store.list_ticker_tables(pg_schema):
+            if ticker not in covered:
+                get_symbol_coverage(ticker, pg_schema)
+
+    with span('db_read', schema=schema, query='coarse_digests') as s, timed_connection('coarse_digests') as conn:
+        if not conn.execute(text('SELECT to_regclass(:name) IS NOT NULL'), {'name': coverage}).scalar():
+            return _empty_digests()
+        updated = {row.symbol: str(row.updated_at) for row in conn.execute(coverage_query, {'schema': schema})}
+        known = previous.drop_duplicates('symbol').set_index('symbol')['updated']
+        changed = sorted(symbol for symbol, stamp in updated.items() if known.get(symbol) != stamp)
+        rows = []
+        if partitioned:
+            # One scan of the changed symbols' primary-key ranges
+            query = text(MONTH_DIGEST_QUERY.format(symbol='t.symbol', source=f'"{pg_schema}".{pg_store.STORE_TABLE}',
+                                                   where='t.schema = :schema AND t.symbol = ANY(:symbols)'))
+            rows = _month_digest_rows(conn, query, {'schema': schema, 'symbols': changed}, updated) if changed else []
+        else:
+            for ticker in changed:
+                source = f'"{pg_schema}"."{ticker}"'
+                query = text(MONTH_DIGEST_QUERY.format(symbol='CAST(:symbol AS text)', source=source, where='true'))
+                rows += _month_digest_rows(conn, query, {'symbol': ticker}, updated)
+        s.add(rows=len(rows), requests=len(changed))
+    # Symbols left out of updated were dropped, their months count as changed
+    kept = previous[previous['symbol'].isin(set(updated) - set(changed))]
+    fresh = pd.DataFrame(rows, columns=list(_empty_digests().columns)) if rows else _empty_digests()
+    return pd.concat([kept, fresh], ignore_index=True)
+
+def digests_path(name, root=None):
+    return Path(root or LEAN_MANIFEST_ROOT) / 'coarse' / f'{name}.parquet'
+
+def load_digests(name, output_dir, root=None):
+    """
+    Reads the digests recorded by the last run, empty when there is none or it wrote to another folder.
+    """
+    path = digests_path(name, root)
+    if not path.exists():
+        return _empty_digests()
+    table = pq.read_table(path)
+    if (table.schema.metadata or {}).get(b'output_dir', b'').decode() != os.path.abspath(output_dir):
+        return _empty_digests()
+    return table.to_pandas()
+
+def save_digests(digests, name, output_dir, root=None):
+    """
+    Records the digests of the stored bars the coarse files were written from, atomically.
+    """
+    path = digests_path(name, root)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    table = pa.Table.from_pandas(digests.astype({'updated': object}), preserve_index=False)
+    table = table.replace_schema_metadata({'output_dir': os.path.abspath(output_dir)})
+    with atomic_path(path) as tmp_path:
+        pq.write_table(table, tmp_path, compression='zstd')
+
+def changed_months(previous, current):
+    """
+    Returns the sorted months whose digest differs for any symbol, including symbols added or removed.
+    """
+    keys = ['symbol', 'month']
+    merged = previous[keys + ['digest']].merge(current[keys + ['digest']], on=keys, how='outer', suffixes=('_old', ''))
+    changed = merged['digest_old'].isna() | merged['digest'].isna() | (merged['digest_old'] != merged['digest'])
+    return sorted(int(month) for month in merged.loc[changed, 'month'].unique())
+
+def iter_source_frames(source, schema, months, digests, store_root=RAW_STORE_ROOT):
+    """
+    Streams the stored daily bars of the months in bounded chunks, every symbol read once per run of months.
+    Yields:
+        pd.DataFrame: symbol, ts_event (UTC) and close, volume.
+    """
+    in_months = digests[digests['month'].isin(months)]
+    for first, last in _month_runs(months):
+        start, end = _month_start(first), _month_start(last + 1)
+        symbols = sorted(in_months.loc[in_months['month'].between(first, last), 'symbol'].unique())
+        if source == 'raw':
+            for symbol in symbols:
+                # A symbol's daily bars over the run are small, its files are read and merged in one go
+                df = read_raw(symbol, schema, start, end - pd.Timedelta(days=1), COARSE_COLUMNS, store_root)
+                if df is not None:
+                    df = df.reset_index()
+                    df['symbol'] = symbol
+                    yield df
+            continue
+        import pg_store
+        from databento_sql import PG_SCHEMAS, iter_data_from_postgresql
+        if pg_store.use_partitioned_store():
+            # The store is already cross-sectional, the run is read in keyset-paginated chunks of every symbol
+            yield from pg_store.iter_bars(symbols, schema, start, end, COARSE_COLUMNS)
+            continue
+        for ticker in symbols:
+            for df in iter_data_from_postgresql(ticker, schema=PG_SCHEMAS[schema], columns=COARSE_COLUMNS,
+                                                since=start.to_pydatetime()):
+                yield df.assign(symbol=ticker)
+                # Chunks are in ts_event order, the rest of the table is past the run
+                if df['ts_event'].iat[-1] >= end:
+                    break
+
+class MonthSpill:
+    """
+    Buffers coarse rows (date, symbol, close deci-cents, volume) per month and writes them out as Parquet files
+    under folder/{month}/ whenever spill_rows rows are held, so memory stays bounded whatever the universe size.
+    """
+    def __init__(self, folder, months, spill_rows=None):
+        self.folder = Path(folder)
+        self.months = np.asarray(sorted(months), dtype=np.int64)
+        self.spill_rows = spill_rows or SPILL_ROWS
+        self.pending = []
+        self.held = 0
+        self.files = 0
+
+    def add(self, df):
+        if df.empty:
+            return
+        ts = df['ts_event'].dt.tz_convert('UTC').dt.tz_localize(None).to_numpy().astype('datetime64[ns]')
+        days = ts.view(np.int64) // NS_PER_DAY
+        year, month, _ = civil_from_days(days)
+        months = year * 12 + month - 1
+        close = df['close'].to_numpy()
+        keep = np.isin(months, self.months)
+        if not np.issubdtype(close.dtype, np.integer):
+            keep &= ~np.isnan(close)
+        if not keep.any():
+            return
+        self.pending.append(pd.DataFrame({
+            'month': months[keep], 'date': days[keep].astype(np.int32),
+            'symbol': np.char.upper(df['symbol'].to_numpy()[keep].astype(str)), 'close': to_deci_cents(close[keep]),
+            'volume': df['volume'].to_numpy()[keep].astype(np.int64),
+        }))
+        self.held += int(keep.sum())
+        if self.held >= self.spill_rows:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        with span('spill', source='coarse') as s:
+            df = pd.concat(self.pending, ignore_index=True)
+            for month, part in df.groupby('month', sort=False):
+                path = self.folder / str(month) / f'{self.files}.parquet'
+                path.parent.mkdir(parents=True, exist_ok=True)
+                pq.write_table(pa.Table.from_pandas(part.drop(columns='month'), preserve_index=False), path)
+                s.add(files=1, bytes=path.stat().st_size)
+            s.add(rows=len(df))
+        self.pending, self.held = [], 0
+        self.files += 1
+
+def encode_coarse_rows(symbols, close, volume):
+    """
+    Encodes 'SID,SYMBOL,close,volume,dollar volume' rows into CSV bytes with NumPy, like lean_writer.encode_lean_rows.
+    Args:
+        symbols (np.ndarray): Upper case ticker per row.
+        close (np.ndarray): int64 deci-cent closes.
+        volume (np.ndarray): Volume per row.
+    Returns:
+        bytes: The encoded rows, newline terminated.
+    """
+    close = np.asarray(close, dtype=np.int64)
+    volume = np.asarray(volume, dtype=np.int64)
+    n = len(close)
+    if n == 0:
+        return b''
+    codes, uniques = pd.factorize(np.asarray(symbols))
+    # The SID and symbol prefix of every distinct ticker as NUL padded bytes, picked per row
+    prefixes = np.array([f'{security_id(symbol)},{symbol},'.encode() for symbol in uniques])
+    prefix = prefixes.view(np.uint8).reshape(len(uniques), prefixes.dtype.itemsize)[codes]
+    dollar_volume = (close * volume + 5000) // 10000
+    columns = [
+        prefix, _int_digits(close // 10000), _char_column(n, '.'), _fixed_digits(close % 10000, 4),
+        _char_column(n, ','), _int_digits(volume), _char_column(n, ','), _int_digits(dollar_volume),
+        _char_column(n, '\n'),
+    ]
+    encoded = np.hstack(columns).ravel()
+    return encoded[encoded != 0].tobytes()
+
+def _date_name(day):
+    year, month, date = (int(value[0]) for value in civil_from_days(np.array([day], dtype=np.int64)))
+    return f'{year:04d}{month:02d}{date:02d}'
+
+def write_coarse_month(month, spill_dir, output_dir):
+    """
+    Writes the coarse file of every date of a month from its spill files. Files whose content is unchanged are
+    left as they are, files of dates without bars are removed.
+    Returns:
+        tuple: (files written, files removed, rows)
+    """
+    output_dir = Path(output_dir)
+    folder = Path(spill_dir) / str(month)
+    files = sorted(folder.glob('*.parquet'), key=lambda p: int(p.stem)) if folder.exists() else []
+    with span('merge', source='coarse', month=month_name(month)) as s:
+        if files:
+            df = pd.concat([pq.read_table(f).to_pandas() for f in files], ignore_index=True)
+            # A bar read twice (e.g. from overlapping chunks) keeps its last copy
+            df = df.drop_duplicates(['date', 'symbol'], keep='last').sort_values(['date', 'symbol'], kind='stable')
+        else:
+            df = pd.DataFrame({'date': pd.Series(dtype=np.int32)})
+        s.add(files=len(files), rows=len(df))
+
+    written = removed = 0
+    first_day, end_day = _month_days(month)
+    dates = df['date'].to_numpy()
+    bounds = np.searchsorted(dates, np.arange(first_day, end_day + 1))
+    with span('lean_write', source='coarse', month=month_name(month)) as s:
+        for day, start, end in zip(range(first_day, end_day), bounds[:-1], bounds[1:]):
+            path = output_dir / f'{_date_name(day)}.csv'
+            if start == end:
+                if path.exists():
+                    path.unlink()
+                    removed += 1
+                continue
+            part = df.iloc[start:end]
+            payload = encode_coarse_rows(part['symbol'].to_numpy(), part['close'].to_numpy(), part['volume'].to_numpy())
+            if path.exists() and path.stat().st_size == len(payload) and path.read_bytes() == payload:
+                continue
+            with atomic_path(path) as tmp_path:
+                with open(tmp_path, 'wb') as f:
+                    f.write(payload)
+            written += 1
+            s.add(rows=end - start, files=1, bytes=len(payload))
+    return written, removed, len(df)
+
+def _write_in_worker(write, month):
+    # Spans recorded in the worker process are sent back with the result and merged by the parent
+    reset_metrics()
+    result = write(month)
+    return result, get_metrics()
+
+def write_coarse_universe(source='raw', schema='ohlcv-1d', store_root=RAW_STORE_ROOT, output_root=LEAN_EQUITY_ROOT,
+                          max_workers=None, spill_rows=None, spill_dir=None, force=False, manifest_root=None):
+    """
+    Writes LEAN coarse universe files for every stored symbol, regenerating only the months whose bars changed.
+    Args:
+        source (str): 'raw' (the raw store) or 'postgresql' (the tables or store picked by pg_layout).
+        schema (str): Daily schema, 'ohlcv-1d' or 'crsp-dsf' in the raw store. Defaults to 'ohlcv-1d'.
+        store_root (str): Root of the raw store. Defaults to 'databento/raw'.
+        output_root (str): Root of the LEAN equity data folder. Defaults to 'data/equity/usa'.
+        max_workers (int, optional): Processes writing months. 1 writes serially. Defaults to os.cpu_count().
+        spill_rows (int, optional): Rows held before spilling. Defaults to the lean_coarse_spill_rows environment variable.
+        spill_dir (str, optional): Folder of the temporary spill files. Defaults to the lean_coarse_spill_dir
+            environment variable, or the system temp folder.
+        force (bool): Regenerate every month, ignoring the recorded digests.
+        manifest_root (str, optional): Manifest folder. Defaults to the lean_manifest_root environment variable.
+    Returns:
+        list: The months regenerated, as 'YYYY-MM'.
+    """
+    if source not in SOURCES:
+        raise ValueError(f'Unknown coarse source {source!r}, expected one of {SOURCES}')
+    name = f'{source}-{schema}'
+    output_dir = Path(output_root) / COARSE_DIR
+    previous = load_digests(name, output_dir, manifest_root)
+    with span('plan', source='coarse', store=source) as s:
+        if source == 'raw':
+            current = raw_month_digests(schema, store_root)
+        else:
+            current = postgres_month_digests(schema, previous)
+        months = changed_months(_empty_digests() if force else previous, current)
+        s.add(symbols=current['symbol'].nunique(), months=len(months))
+    if not months:
+        save_digests(current, name, output_dir, manifest_root)
+        logger.info(f'Coarse universe files in {output_dir} are up to date')
+        return []
+
+    output_dir.mkdir(parents=True, exist_ok=True)
+    written = removed = rows = 0
+    with tempfile.TemporaryDirectory(prefix='coarse-', dir=spill_dir or os.getenv('lean_coarse_spill_dir')) as folder:
+        spill = MonthSpill(folder, months, spill_rows)
+        for df in iter_source_frames(source, schema, months, current, store_root):
+            spill.add(df)
+        spill.flush()
+        write = partial(write_coarse_month, spill_dir=folder, output_dir=output_dir)
+        with span('lean_write', source='coarse', months=len(months)):
+            if max_workers == 1:
+                results = [write(month) for month in months]
+            else:
+                results = []
+                with ProcessPoolExecutor(max_workers=max_workers or os.cpu_count() or 1) as executor:
+                    for result, metrics in executor.map(partial(_write_in_worker, write), months):
+                        results.append(result)
+                        merge_metrics(metrics)
+    for month_written, month_removed, month_rows in results:
+        written, removed, rows = written + month_written, removed + month_removed, rows + month_rows
+    # Recorded last, so an interrupted run regenerates the same months next time
+    save_digests(current, name, output_dir, manifest_root)
+    logger.info(f'{len(months)} month(s) of coarse universe files regenerated in {output_dir}: '
+                f'{rows} rows, {written} files written, {removed} removed')
+    return [month_name(month) for month in months]
+
+if __name__ == '__main__':
+    import sys
+    # Log level/format and the metrics file come from the lean_log_* and lean_metrics_* environment variables
+    configure()
+    write_coarse_universe(*sys.argv[1:3])
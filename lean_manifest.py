@@ -0,0 +1,198 @@
+from contextlib import contextmanager
+from pathlib import Path
+import tempfile
+import hashlib
+import json
+import io
+import os
+
+'''
+Output manifest for the LEAN writers, so unchanged LEAN files are neither rebuilt nor rewritten.
+For every ticker and resolution a JSON sidecar outside the LEAN data folder records:
+    {root}/{resolution}/{ticker}.json -> {
+        "source":  {"key": ..., "rows": ..., "max_ts_event": ..., "hash": ...},   fingerprint of the last converted input
+        "outputs": {"/abs/path/aapl.zip": {"rows": ..., "last_bar": ..., "sha1": ..., "size": ..., "mtime_ns": ...}}
+    }
+Two levels of skipping:
+    - source: convert_stored_data fingerprints its input cheaply (raw-store file list, or an aggregate query in
+      PostgreSQL) and skips reading and encoding altogether when it matches and every recorded output is intact.
+    - outputs: the writers hash each file's CSV payload and leave the existing zip untouched when the hash,
+      size and modification time match, e.g. the old days of a minute history when one new day was appended.
+Every output is written to a temporary file in the same folder and renamed into place, so readers and parallel
+runs never see a half-written zip.
+
+When the source only grew past the last conversion (extendable_source, plus the caller's check that the rows it
+converted are unchanged), convert_stored_data reads and writes from the last converted day on: daily and hourly
+zips get their tail replaced (lean_writer.append_lean_bars), minute histories only the day files touched.
+
+The manifest folder is the lean_manifest_root environment variable, default databento/lean_manifest.
+'''
+
+LEAN_MANIFEST_ROOT = os.getenv('lean_manifest_root', 'databento/lean_manifest')
+# Enough of the end of a payload to hold its last LEAN line
+TAIL_BYTES = 256
+
+def manifest_path(ticker, resolution, root=None):
+    return Path(root or LEAN_MANIFEST_ROOT) / resolution / f'{ticker.lower()}.json'
+
+def load_manifest(ticker, resolution, root=None):
+    """
+    Reads a ticker's manifest.
+    Returns:
+        dict: {'source': dict or None, 'outputs': {path: entry}}, empty when no manifest exists yet.
+    """
+    path = manifest_path(ticker, resolution, root)
+    if not path.exists():
+        return {'source': None, 'outputs': {}}
+    with open(path) as f:
+        return json.load(f)
+
+def save_manifest(manifest, ticker, resolution, root=None):
+    """
+    Writes a ticker's manifest atomically.
+    """
+    path = manifest_path(ticker, resolution, root)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with atomic_path(path) as tmp_path:
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f)
+
+# Read once at import, os.umask can only be read by setting it
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+@contextmanager
+def atomic_path(path):
+    """
+    Yields a temporary path next to path; on success it is renamed over path, on failure removed.
+    Removing the temporary file inside the block keeps path as it was.
+    """
+    path = Path(path)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f'.{path.name}.', suffix='.tmp')
+    os.close(fd)
+    try:
+        yield tmp_path
+        if os.path.exists(tmp_path):
+            # mkstemp creates the file 0600, outputs get the mode a plain open() would give them
+            os.chmod(tmp_path, 0o666 & ~_UMASK)
+            os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def output_key(path):
+    return os.path.abspath(path)
+
+def output_entry(path, rows, last_bar, sha1):
+    """
+    Describes a written output: its row count, the LEAN time of its last bar, payload hash and file stat.
+    The stat survives the rename, so path may be the temporary file about to be moved into place.
+    """
+    stat = os.stat(path)
+    return {'rows': int(rows), 'last_bar': last_bar, 'sha1': sha1, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+def is_intact(path, entry):
+    """
+    True when path still is the file recorded in entry (same size and modification time).
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return False
+    return entry is not None and stat.st_size == entry['size'] and stat.st_mtime_ns == entry['mtime_ns']
+
+def is_unchanged(path, entry, sha1):
+    """
+    True when the output at path was written from a payload with this hash and has not been touched since.
+    """
+    return entry is not None and entry['sha1'] == sha1 and is_intact(path, entry)
+
+def source_unchanged(manifest, fingerprint):
+    """
+    True when the manifest's last conversion had this source fingerprint and all its outputs are intact.
+    """
+    return (fingerprint is not None and manifest.get('source') == fingerprint
+            and all(is_intact(path, entry) for path, entry in manifest['outputs'].items()))
+
+def record_source(ticker, resolution, fingerprint, root=None):
+    """
+    Stores the fingerprint of the input that the ticker's current outputs were converted from.
+    """
+    manifest = load_manifest(ticker, resolution, root)
+    manifest['source'] = fingerprint
+    save_manifest(manifest, ticker, resolution, root)
+
+def extendable_source(manifest, fingerprint):
+    """
+    Returns the manifest's last source fingerprint when the new one can only extend it: the same conversion apart
+    from a later end of the range, with every recorded output intact. Whether the rows converted last time are
+    still the same is left to the caller, e.g. by fingerprinting the source up to the old max_ts_event again.
+    Returns:
+        dict: The previous fingerprint, or None when a full conversion is needed.
+    """
+    previous = manifest.get('source')
+    if fingerprint is None or previous is None or previous.get('max_ts_event') is None:
+        return None
+    old_key, new_key = previous['key'], fingerprint['key']
+    if {k: v for k, v in old_key.items() if k != 'end'} != {k: v for k, v in new_key.items() if k != 'end'}:
+        return None
+    # ISO dates compare in time order
+    if old_key.get('end', '') > new_key.get('end', ''):
+        return None
+    if not manifest['outputs'] or not all(is_intact(path, entry) for path, entry in manifest['outputs'].items()):
+        return None
+    return previous
+
+def fingerprint(key, rows, max_ts_event, parts):
+    """
+    Builds a source fingerprint.
+    Args:
+        key (dict): What was converted and how (frequency, date range, output folder, ...).
+        rows (int): Source row count.
+        max_ts_event: Last source timestamp.
+        parts (iterable): Values identifying the source content (file names and sizes, a content hash, ...).
+    Returns:
+        dict: JSON-serialisable fingerprint.
+    """
+    digest = hashlib.sha1()
+    for part in parts:
+        digest.update(str(part).encode())
+        digest.update(b'\0')
+    return {'key': {name: str(value) for name, value in key.items()}, 'rows': int(rows),
+            'max_ts_event': None if max_ts_event is None else str(max_ts_event), 'hash': digest.hexdigest()}
+
+class HashingWriter(io.RawIOBase):
+    """
+    Write-only wrapper hashing (SHA-1) and counting the bytes and lines of LEAN CSV written through it.
+    With target None the data is only hashed.
+    """
+    def __init__(self, target=None):
+        self.target = target
+        self.sha1 = hashlib.sha1()
+        self.size = 0
+        self.rows = 0
+        self.tail = b''
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.sha1.update(data)
+        self.size += len(data)
+        self.rows += data.count(b'\n')
+        self.tail = (self.tail + bytes(data[-TAIL_BYTES:]))[-TAIL_BYTES:]
+        return len(data) if self.target is None else self.target.write(data)
+
+    def hexdigest(self):
+        return self.sha1.hexdigest()
+
+    def last_bar(self):
+        return last_bar(self.tail)
+
+def last_bar(payload):
+    """
+    Returns the time field of the last line of LEAN CSV bytes, or None when empty.
+    """
+    line = payload.rstrip(b'\n').rsplit(b'\n', 1)[-1]
+    return line.split(b',', 1)[0].decode() if line else None
@@ -0,0 +1,861 @@
+import pandas as pd
+import numpy as np
+from numpy.lib.recfunctions import repack_fields
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from contextlib import nullcontext
+import zipfile
+import shutil
+import os
+from instrumentation import span, get_metrics, merge_metrics, reset_metrics
+from lean_manifest import (HashingWriter, atomic_path, load_manifest, save_manifest, output_key, output_entry,
+                           is_unchanged, is_intact)
+
+'''
+LEAN equity writers shared by databento_pipe.py, databento_sql.py and databento_dagster.py.
+
+Minute and second data in LEAN is stored as one zip per exchange-local trading day:
+    data/equity/usa/minute/{ticker}/{YYYYMMDD}_trade.zip -> {YYYYMMDD}_{ticker}_minute_trade.csv
+Each row starts with the milliseconds since midnight (New York time) of the bar.
+The writer consumes bars day by day, so only one trading day is held per task.
+
+Daily and hourly data is a single {ticker}.zip -> {ticker}.csv with 'YYYYMMDD HH:MM' times.
+Rows are encoded with NumPy integer arithmetic into bytes and streamed straight into the zip entry,
+no intermediate CSV is written unless asked for. Bar prices are float dollars, or DBN int64 fixed-point
+with databento_price_type=fixed, which gives exact deci-cents with one integer division (to_deci_cents).
+
+Every output is built in a temporary file next to its target and renamed into place. Its CSV payload is hashed
+on the way and recorded in the ticker's manifest (lean_manifest.py); an output whose hash matches the recorded
+one, and whose file was not touched since, is left as it is instead of being rewritten (force=True rewrites it).
+append_lean_bars extends an existing daily or hourly zip with new bars only, replacing the lines they overlap.
+
+Tick data uses the same per-day layout with one zip per tick type, built from Data Bento trades and mbp-1 records:
+    data/equity/usa/tick/{ticker}/{YYYYMMDD}_trade.zip -> {YYYYMMDD}_{ticker}_Trade_Tick.csv
+        time ms, price, quantity, exchange, sale condition, suspicious
+    data/equity/usa/tick/{ticker}/{YYYYMMDD}_quote.zip -> {YYYYMMDD}_{ticker}_Quote_Tick.csv
+        time ms, bid price, bid size, ask price, ask size, exchange, condition, suspicious
+Records are read as DBN record batches (databento_fetch.iter_dbn_arrays) and encoded from their int64 fixed-point
+prices, so a day's ticks never go through a DataFrame. Quote ticks are only written when the top of book changes.
+
+The *_polars writers are an alternative engine producing the same bytes: rows are formatted by Polars
+expressions on all cores and a lazy plan (e.g. raw_store.scan_raw or pl.scan_csv) is streamed with sink_csv, or for
+per-day outputs collected a few trading days at a time (iter_polars_chunks).
+Polars is optional and only imported by them; the engine is picked with engine= or the lean_engine environment
+variable ('pandas' by default or 'polars').
+'''
+
+LEAN_TIMEZONE = 'America/New_York'
+LEAN_EQUITY_ROOT = 'data/equity/usa'
+PRICE_COLUMNS = ['open', 'high', 'low', 'close']
+BAR_COLUMNS = ['local_ns'] + PRICE_COLUMNS + ['volume']
+NS_PER_DAY = 86_400_000_000_000
+NS_PER_MS = 1_000_000
+NS_PER_MINUTE = 60_000_000_000
+ENCODE_CHUNK_ROWS = 1_000_000
+FREQUENCY_DIRS = {'daily': 'daily', 'hourly': 'hourly', 'minute': 'minute'}
+ENGINES = ('pandas', 'polars')
+# Data Bento schema each LEAN tick type is built from
+TICK_SCHEMAS = {'trade': 'trades', 'quote': 'mbp-1'}
+# DBN prices are int64 1e-9 dollars, LEAN prices are deci-cents (1e-4 dollars)
+DBN_PRICE_PER_DECI_CENT = 100_000
+DBN_UNDEF_PRICE = np.iinfo(np.int64).max
+QUOTE_FIELDS = ['bid_px_00', 'bid_sz_00', 'ask_px_00', 'ask_sz_00']
+TICK_FIELDS = {'trade': ['publisher_id', 'price', 'size'], 'quote': ['publisher_id'] + QUOTE_FIELDS}
+# LEAN exchange codes by Data Bento venue (MIC), unknown venues are written as an empty field
+VENUE_EXCHANGE_CODES = {
+    'XNAS': 'Q', 'XBOS': 'B', 'XPSX': 'X', 'XNYS': 'N', 'ARCX': 'P', 'XASE': 'A', 'XCHI': 'M', 'XCIS': 'C',
+    'BATS': 'Z', 'BATY': 'Y', 'EDGA': 'J', 'EDGX': 'K', 'IEXG': 'V', 'MEMX': 'U', 'EPRL': 'H', 'LTSE': 'L',
+    'FINN': 'D', 'FINY': 'D', 'FINC': 'D',
+}
+# Sale condition and suspicious flag of every tick, Data Bento records carry neither
+TICK_CONDITION = b'00000000'
+TICK_SUSPICIOUS = b'0'
+
+_exchange_table = None
+
+def get_engine(engine=None):
+    """
+    Returns engine, or the lean_engine environment variable, or 'pandas'.
+    """
+    engine = engine or os.getenv('lean_engine', 'pandas')
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown engine {engine!r}, expected one of {ENGINES}")
+    return engine
+
+def to_exchange_ns(ts, timezone=LEAN_TIMEZONE):
+    """
+    Converts a timestamp column to int64 nanoseconds of exchange-local wall-clock time.
+    Naive timestamps (e.g. re-read from CSV without an offset) are assumed to be UTC.
+    Args:
+        ts (pd.Series): Timestamps as strings, naive or tz-aware datetimes.
+        timezone (str): Exchange time zone. Defaults to New York.
+    Returns:
+        np.ndarray: int64 nanoseconds since the epoch in local wall-clock time.
+    """
+    ts = pd.to_datetime(ts, utc=True)
+    return ts.dt.tz_convert(timezone).dt.tz_localize(None).to_numpy('datetime64[ns]').view('int64')
+
+def iter_trading_days(frames, datetime_column='ts_event'):
+    """
+    Groups time-ordered bars by exchange-local trading day.
+    Accepts a single DataFrame or any iterable of DataFrame chunks (e.g. pd.read_csv(..., chunksize=...)).
+    A day is only yielded once the next day has started, so days split over chunk boundaries stay whole.
+    Args:
+        frames (pd.DataFrame or iterable): Bars sorted by datetime_column.
+        datetime_column (str): The name of the bar timestamp column. Defaults to 'ts_event'.
+    Yields:
+        tuple: (day (np.int64 days since epoch), pd.DataFrame of that day's bars with a 'local_ns' column).
+    """
+    if isinstance(frames, pd.DataFrame):
+        frames = [frames]
+
+    pending = None
+    for chunk in frames:
+        if chunk.index.name == datetime_column:
+            chunk = chunk.reset_index()
+        if chunk.empty:
+            continue
+        chunk = chunk.assign(local_ns=to_exchange_ns(chunk[datetime_column]))
+        if pending is not None:
+            chunk = pd.concat([pending, chunk], ignore_index=True)
+
+        days = chunk['local_ns'].to_numpy() // NS_PER_DAY
+        # Split points where the trading day changes; the last day may continue in the next chunk
+        bounds = np.flatnonzero(np.diff(days)) + 1
+        starts = np.concatenate(([0], bounds))
+        ends = np.concatenate((bounds, [len(chunk)]))
+        for start, end in zip(starts[:-1], ends[:-1]):
+            yield days[start], chunk.iloc[start:end]
+        pending = chunk.iloc[starts[-1]:]
+
+    if pending is not None:
+        yield pending['local_ns'].iat[0] // NS_PER_DAY, pending
+
+def civil_from_days(days):
+    """
+    Vectorized conversion of days since 1970-01-01 to calendar year, month and day (Hinnant's algorithm).
+    Args:
+        days (np.ndarray): int64 days since the epoch.
+    Returns:
+        tuple: (year, month, day) int64 arrays.
+    """
+    z = days + 719468
+    era = np.floor_divide(z, 146097)
+    doe = z - era * 146097
+    yoe = (doe - doe // 1460 + doe // 36524 - doe // 146096) // 365
+    doy = doe - (365 * yoe + yoe // 4 - yoe // 100)
+    mp = (5 * doy + 2) // 153
+    day = doy - (153 * mp + 2) // 5 + 1
+    month = np.where(mp < 10, mp + 3, mp - 9)
+    year = yoe + era * 400 + (month <= 2)
+    return year, month, day
+
+def _fixed_digits(values, width):
+    # Zero padded ASCII digits, one row per value
+    powers = 10 ** np.arange(width - 1, -1, -1, dtype=np.int64)
+    return ((values[:, None] // powers) % 10 + 48).astype(np.uint8)
+
+def _int_digits(values):
+    # Variable width ASCII digits; unused leading positions are NUL and dropped after concatenation
+    values = np.asarray(values, dtype=np.int64)
+    magnitude = np.abs(values)
+    width = len(str(int(magnitude.max()))) if len(values) else 1
+    powers = 10 ** np.arange(width - 1, -1, -1, dtype=np.int64)
+    digits = ((magnitude[:, None] // powers) % 10 + 48).astype(np.uint8)
+    significant = magnitude[:, None] >= powers
+    significant[:, -1] = True
+    digits[~significant] = 0
+    if (values < 0).any():
+        sign = np.where(values < 0, ord('-'), 0).astype(np.uint8)[:, None]
+        digits = np.hstack([sign, digits])
+    return digits
+
+def _char_column(n, char):
+    return np.full((n, 1), ord(char), dtype=np.uint8)
+
+def to_deci_cents(prices):
+    """
+    Converts prices to LEAN deci-cents as int64.
+    Float dollars are multiplied and truncated like the original astype(int), which can land one deci-cent low when
+    the product falls just under a whole number (e.g. 1.13 * 10000 = 11299.99...). Integer prices are DBN fixed-point
+    (databento_fetch.PRICE_TYPES) and are converted exactly, with one integer division.
+    Args:
+        prices (array-like): Dollar prices, or int64 1e-9 dollar prices.
+    Returns:
+        np.ndarray: int64 deci-cent prices.
+    """
+    prices = np.asarray(prices)
+    if np.issubdtype(prices.dtype, np.integer):
+        return prices.astype(np.int64, copy=False) // DBN_PRICE_PER_DECI_CENT
+    return (prices.astype(np.float64, copy=False) * 10000).astype(np.int64)
+
+def encode_lean_rows(local_ns, values, time_format='date', text=()):
+    """
+    Encodes rows of a LEAN time column followed by integer columns into CSV bytes without per-row Python string work.
+    Args:
+        local_ns (np.ndarray): int64 exchange-local nanoseconds since the epoch.
+        values (list): int64 arrays, one per column after the time.
+        time_format (str): 'date' for 'YYYYMMDD HH:MM' (daily/hourly) or 'ms' for milliseconds since midnight.
+        text (list): ASCII columns written after the integer ones, each an (n, width) uint8 array or bytes repeated
+            on every row. NUL bytes are dropped, so rows of a column can differ in width.
+    Returns:
+        bytes: The encoded rows, newline terminated.
+    """
+    local_ns = np.asarray(local_ns, dtype=np.int64)
+    n = len(local_ns)
+    if n == 0:
+        return b''
+
+    days = np.floor_divide(local_ns, NS_PER_DAY)
+    if time_format == 'ms':
+        columns = [_int_digits((local_ns - days * NS_PER_DAY) // NS_PER_MS)]
+    else:
+        year, month, day = civil_from_days(days)
+        minutes = (local_ns - days * NS_PER_DAY) // NS_PER_MINUTE
+        columns = [
+            _fixed_digits(year, 4), _fixed_digits(month, 2), _fixed_digits(day, 2), _char_column(n, ' '),
+            _fixed_digits(minutes // 60, 2), _char_column(n, ':'), _fixed_digits(minutes % 60, 2),
+        ]
+    for column in values:
+        columns += [_char_column(n, ','), _int_digits(column)]
+    for column in text:
+        if isinstance(column, bytes):
+            column = np.broadcast_to(np.frombuffer(column, dtype=np.uint8), (n, len(column)))
+        columns += [_char_column(n, ','), column]
+    columns.append(_char_column(n, '\n'))
+
+    encoded = np.hstack(columns).ravel()
+    return encoded[encoded != 0].tobytes()
+
+def encode_lean_bars(local_ns, prices, volume, time_format='date'):
+    """
+    Encodes bars into LEAN CSV bytes, see encode_lean_rows.
+    Args:
+        local_ns (np.ndarray): int64 exchange-local nanoseconds since the epoch.
+        prices (list): int64 deci-cent arrays for open, high, low and close.
+        volume (np.ndarray): Volume per bar.
+        time_format (str): 'date' for 'YYYYMMDD HH:MM' (daily/hourly) or 'ms' for milliseconds since midnight.
+    Returns:
+        bytes: The encoded rows, newline terminated.
+    """
+    return encode_lean_rows(local_ns, list(prices) + [volume], time_format)
+
+def encode_lean_frame(df, time_format='date', timezone=LEAN_TIMEZONE, datetime_column='ts_event'):
+    """
+    Encodes a DataFrame of dollar-priced bars into LEAN CSV bytes.
+    Args:
+        df (pd.DataFrame): Bars with a timestamp column (or 'local_ns'), open, high, low, close and volume.
+        time_format (str): 'date' or 'ms', see encode_lean_bars.
+        timezone (str): Time zone the LEAN times are written in. Defaults to New York.
+        datetime_column (str): The name of the bar timestamp column. Defaults to 'ts_event'.
+    Returns:
+        bytes: The encoded rows.
+    """
+    if 'local_ns' in df.columns:
+        local_ns = df['local_ns'].to_numpy()
+    else:
+        ts = df.index.to_series() if df.index.name == datetime_column else df[datetime_column]
+        local_ns = to_exchange_ns(ts, timezone)
+    prices = [to_deci_cents(df[col].to_numpy()) for col in PRICE_COLUMNS]
+    return encode_lean_bars(local_ns, prices, df['volume'].to_numpy(), time_format)
+
+def to_tick_deci_cents(prices):
+    """
+    Converts DBN fixed-point prices (int64 1e-9 dollars) to LEAN deci-cents, truncating like to_deci_cents.
+    Undefined prices (an empty side of the book) become 0.
+    """
+    prices = np.asarray(prices, dtype=np.int64)
+    return np.where(prices == DBN_UNDEF_PRICE, 0, prices // DBN_PRICE_PER_DECI_CENT)
+
+def exchange_codes(publisher_ids):
+    """
+    Maps DBN publisher ids to LEAN exchange codes.
+    Returns:
+        np.ndarray: (n, 1) uint8 ASCII column, NUL (an empty field) for venues without a code.
+    """
+    global _exchange_table
+    if _exchange_table is None:
+        from databento.common.publishers import Publisher
+        table = np.zeros(max(publisher.to_int() for publisher in Publisher) + 1, dtype=np.uint8)
+        for publisher in Publisher:
+            code = VENUE_EXCHANGE_CODES.get(str(publisher.venue))
+            if code:
+                table[publisher.to_int()] = ord(code)
+        _exchange_table = table
+    ids = np.asarray(publisher_ids, dtype=np.int64)
+    known = ids < len(_exchange_table)
+    return np.where(known, _exchange_table[np.where(known, ids, 0)], 0).astype(np.uint8)[:, None]
+
+def top_of_book_changes(records):
+    """
+    Returns a mask of the mbp-1 records whose best bid or offer (price or size) differs from the previous record's.
+    The first record is always kept.
+    """
+    changed = np.ones(len(records), dtype=bool)
+    if len(records) > 1:
+        changed[1:] = np.logical_or.reduce([np.diff(records[field].astype(np.int64)) != 0 for field in QUOTE_FIELDS])
+    return changed
+
+def encode_lean_ticks(local_ns, records, tick_type='trade'):
+    """
+    Encodes DBN trades or mbp-1 records into LEAN equity tick CSV bytes, see the module docstring for the columns.
+    Args:
+        local_ns (np.ndarray): int64 exchange-local nanoseconds since the epoch of each record.
+        records (np.ndarray): DBN records with the TICK_FIELDS of the tick type.
+        tick_type (str): 'trade' or 'quote'. Defaults to 'trade'.
+    Returns:
+        bytes: The encoded rows.
+    """
+    if tick_type == 'trade':
+        values = [to_tick_deci_cents(records['price']), records['size']]
+    else:
+        values = [to_tick_deci_cents(records['bid_px_00']), records['bid_sz_00'],
+                  to_tick_deci_cents(records['ask_px_00']), records['ask_sz_00']]
+    text = [exchange_codes(records['publisher_id']), TICK_CONDITION, TICK_SUSPICIOUS]
+    return encode_lean_rows(local_ns, values, time_format='ms', text=text)
+
+def iter_record_days(batches, timezone=LEAN_TIMEZONE):
+    """
+    Groups time-ordered DBN record batches (e.g. databento_fetch.iter_dbn_arrays) by exchange-local trading day.
+    Like iter_trading_days, a day is only yielded once the next day has started.
+    Yields:
+        tuple: (day (np.int64 days since epoch), records of that day, their int64 exchange-local nanoseconds).
+    """
+    pending = None
+    for batch in batches:
+        if len(batch) == 0:
+            continue
+        local_ns = to_exchange_ns(pd.Series(batch['ts_event'].astype(np.int64)), timezone)
+        if pending is not None:
+            batch = np.concatenate([pending[0], batch])
+            local_ns = np.concatenate([pending[1], local_ns])
+
+        days = local_ns // NS_PER_DAY
+        bounds = np.flatnonzero(np.diff(days)) + 1
+        starts = np.concatenate(([0], bounds))
+        ends = np.concatenate((bounds, [len(batch)]))
+        for start, end in zip(starts[:-1], ends[:-1]):
+            yield days[start], batch[start:end], local_ns[start:end]
+        pending = batch[starts[-1]:], local_ns[starts[-1]:]
+
+    if pending is not None:
+        yield pending[1][0] // NS_PER_DAY, pending[0], pending[1]
+
+def _day_zip_path(output_dir, day, data_type='trade'):
+    date_str = np.datetime64(int(day), 'D').astype(object).strftime('%Y%m%d')
+    return date_str, os.path.join(output_dir, f'{date_str}_{data_type}.zip')
+
+def _write_day_zip(zip_file, entry_name, payload, previous, force, ticker, date_str):
+    # Atomically writes a one-entry zip, unless the existing one was written from the same payload
+    hashed = HashingWriter()
+    hashed.write(payload)
+    with span('zip_write', ticker=ticker, day=date_str) as s:
+        if not force and is_unchanged(zip_file, previous, hashed.hexdigest()):
+            s.add(skipped=1)
+            return previous
+        with atomic_path(zip_file) as tmp_path:
+            with zipfile.ZipFile(tmp_path, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+                zf.writestr(entry_name, payload)
+            entry = output_entry(tmp_path, hashed.rows, hashed.last_bar(), hashed.hexdigest())
+        s.add(bytes=len(payload))
+    return entry
+
+def write_lean_day(day_df, ticker, day, output_dir, resolution='minute', previous=None, force=False):
+    """
+    Writes one trading day of bars to {output_dir}/{YYYYMMDD}_trade.zip, unless the zip already holds them.
+    Args:
+        day_df (pd.DataFrame): One day's bars with a 'local_ns' column.
+        ticker (str): The stock ticker symbol.
+        day (int): Trading day as days since the epoch.
+        output_dir (str): Directory holding the ticker's daily zips.
+        resolution (str): LEAN resolution name used in the entry name. Defaults to 'minute'.
+        previous (dict, optional): The zip's manifest entry from an earlier run, see lean_manifest.
+        force (bool): Rewrite the zip even if its content is unchanged. Defaults to False.
+    Returns:
+        tuple: (path of the zip file, its manifest entry).
+    """
+    date_str, zip_file = _day_zip_path(output_dir, day)
+    with span('lean_encode', ticker=ticker, day=date_str) as s:
+        payload = encode_lean_frame(day_df, time_format='ms')
+        s.add(rows=len(day_df), bytes=len(payload))
+    entry = _write_day_zip(zip_file, f'{date_str}_{ticker.lower()}_{resolution}_trade.csv', payload, previous, force,
+                           ticker, date_str)
+    return zip_file, entry
+
+def write_lean_tick_day(records, local_ns, ticker, day, output_dir, tick_type='trade', previous=None, force=False):
+    """
+    Writes one trading day of ticks to {output_dir}/{YYYYMMDD}_{tick_type}.zip, unless the zip already holds them.
+    Args:
+        records (np.ndarray): One day's DBN trades or mbp-1 records, see encode_lean_ticks.
+        local_ns (np.ndarray): int64 exchange-local nanoseconds since the epoch of each record.
+        ticker (str): The stock ticker symbol.
+        day (int): Trading day as days since the epoch.
+        output_dir (str): Directory holding the ticker's tick zips.
+        tick_type (str): 'trade' or 'quote'. Defaults to 'trade'.
+        previous (dict, optional): The zip's manifest entry from an earlier run, see lean_manifest.
+        force (bool): Rewrite the zip even if its content is unchanged. Defaults to False.
+    Returns:
+        tuple: (path of the zip file, its manifest entry).
+    """
+    date_str, zip_file = _day_zip_path(output_dir, day, tick_type)
+    with span('lean_encode', ticker=ticker, day=date_str, tick_type=tick_type) as s:
+        if tick_type == 'quote':
+            # Book updates that leave the best bid and offer unchanged are not quote ticks
+            keep = top_of_book_changes(records)
+            records, local_ns = records[keep], local_ns[keep]
+        payload = encode_lean_ticks(local_ns, records, tick_type)
+        s.add(rows=len(records), bytes=len(payload))
+    entry = _write_day_zip(zip_file, f'{date_str}_{ticker.lower()}_{tick_type.capitalize()}_Tick.csv', payload, previous,
+                           force, ticker, date_str)
+    return zip_file, entry
+
+def _run_in_worker(write_day, *args):
+    # Spans recorded in the worker process are sent back with the result and merged by the parent
+    reset_metrics()
+    result = write_day(*args)
+    return result, get_metrics()
+
+def _write_days(days, write_day, max_workers=None):
+    # Runs write_day(*args) for every (day, args) of days, serially or in worker processes.
+    # Returns {day: (zip_file, manifest entry)}.
+    written = {}
+    if max_workers == 1:
+        for day, args in days:
+            written[day] = write_day(*args)
+        return written
+
+    def collect(future, day):
+        written[day], metrics = future.result()
+        merge_metrics(metrics)
+
+    max_workers = max_workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        in_flight = {}
+        for day, args in days:
+            # Bound the queued days so memory stays at a few days per worker
+            if len(in_flight) >= 2 * max_workers:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    collect(future, in_flight.pop(future))
+            future = executor.submit(_run_in_worker, write_day, *args)
+            in_flight[future] = day
+        for future, day in in_flight.items():
+            collect(future, day)
+    return written
+
+def _record_outputs(manifest, entries, ticker, resolution, manifest_root):
+    # Outputs of this run replace their old entries, the others (e.g. days outside the converted range) are kept
+    manifest['outputs'].update({output_key(path): entry for path, entry in entries.items()})
+    save_manifest(manifest, ticker, resolution, manifest_root)
+
+def write_lean_minute_data(data, ticker, resolution='minute', output_root=LEAN_EQUITY_ROOT, max_workers=None,
+                           force=False, manifest_root=None):
+    """
+    Streams bars into LEAN's per-day zip layout, writing the days in parallel.
+    Days whose zip already holds the same bars are left untouched, see lean_manifest.
+    Args:
+        data (pd.DataFrame or iterable): Bars sorted by 'ts_event', or an iterable of such chunks.
+        ticker (str): The stock ticker symbol.
+        resolution (str): 'minute' or 'second'. Defaults to 'minute'.
+        output_root (str): Root of the LEAN equity data folder. Defaults to 'data/equity/usa'.
+        max_workers (int, optional): Worker processes for writing days. 1 writes serially. Defaults to os.cpu_count().
+        force (bool): Rewrite unchanged days too. Defaults to False.
+        manifest_root (str, optional): Manifest folder. Defaults to the lean_manifest_root environment variable.
+    Returns:
+        list: Paths of the day zip files, in trading-day order.
+    """
+    output_dir = os.path.join(output_root, resolution, ticker.lower())
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = load_manifest(ticker, resolution, manifest_root)
+
+    def previous(day):
+        return manifest['outputs'].get(output_key(_day_zip_path(output_dir, day)[1]))
+
+    # Only the columns the encoder needs are shipped to the worker processes
+    days = ((day, (day_df[BAR_COLUMNS], ticker, day, output_dir, resolution, previous(day), force))
+            for day, day_df in iter_trading_days(data))
+    with span('lean_write', ticker=ticker, resolution=resolution) as s:
+        written = _write_days(days, write_lean_day, max_workers)
+        entries = dict(written.values())
+        _record_outputs(manifest, entries, ticker, resolution, manifest_root)
+        s.add(files=len(entries), bytes=sum(entry['size'] for entry in entries.values()))
+
+    return [written[day][0] for day in sorted(written)]
+
+def write_lean_ticks(batches, ticker, tick_type='trade', output_root=LEAN_EQUITY_ROOT, max_workers=None, force=False,
+                     manifest_root=None, timezone=LEAN_TIMEZONE):
+    """
+    Streams DBN trades or mbp-1 record batches into LEAN's per-day tick zips, writing the days in parallel.
+    At most one pending day and two queued days per worker are held, however long the range is.
+    Days whose zip already holds the same ticks are left untouched, see lean_manifest.
+    Args:
+        batches (iterable): Time-ordered DBN record arrays of one symbol, e.g. databento_fetch.iter_dbn_arrays(store).
+        ticker (str): The stock ticker symbol.
+        tick_type (str): 'trade' (from trades) or 'quote' (from mbp-1). Defaults to 'trade'.
+        output_root (str): Root of the LEAN equity data folder. Defaults to 'data/equity/usa'.
+        max_workers (int, optional): Worker processes for writing days. 1 writes serially. Defaults to os.cpu_count().
+        force (bool): Rewrite unchanged days too. Defaults to False.
+        manifest_root (str, optional): Manifest folder. Defaults to the lean_manifest_root environment variable.
+        timezone (str): Exchange time zone. Defaults to New York.
+    Returns:
+        list: Paths of the day zip files, in trading-day order.
+    """
+    if tick_type not in TICK_SCHEMAS:
+        raise ValueError(f"Unknown tick type {tick_type!r}, expected one of {list(TICK_SCHEMAS)}")
+    output_dir = os.path.join(output_root, 'tick', ticker.lower())
+    os.makedirs(output_dir, exist_ok=True)
+    # Trade and quote zips share the ticker's tick manifest
+    manifest = load_manifest(ticker, 'tick', manifest_root)
+
+    def previous(day):
+        return manifest['outputs'].get(output_key(_day_zip_path(output_dir, day, tick_type)[1]))
+
+    # Only the fields the encoder needs are shipped to the worker processes
+    fields = TICK_FIELDS[tick_type]
+    days = ((day, (repack_fields(records[fields]), local_ns, ticker, day, output_dir, tick_type, previous(day), force))
+            for day, records, local_ns in iter_record_days(batches, timezone))
+    with span('lean_write', ticker=ticker, resolution='tick', tick_type=tick_type) as s:
+        written = _write_days(days, write_lean_tick_day, max_workers)
+        entries = dict(written.values())
+        _record_outputs(manifest, entries, ticker, 'tick', manifest_root)
+        s.add(files=len(entries), bytes=sum(entry['size'] for entry in entries.values()))
+
+    return [written[day][0] for day in sorted(written)]
+
+def _finish_bars(zip_file, csv_file, tmp_zip, tmp_csv, hashed, manifest, force):
+    # Returns the zip's new manifest entry, or None after dropping the temporary files of an unchanged output
+    # (atomic_path then leaves the existing files in place)
+    previous = manifest['outputs'].get(output_key(zip_file))
+    if not force and is_unchanged(zip_file, previous, hashed.hexdigest()):
+        os.remove(tmp_zip)
+        if tmp_csv is not None and os.path.exists(csv_file):
+            os.remove(tmp_csv)
+        return None
+    return output_entry(tmp_zip, hashed.rows, hashed.last_bar(), hashed.hexdigest())
+
+def write_lean_bars(data, ticker, frequency='daily', timezone=LEAN_TIMEZONE, output_root=LEAN_EQUITY_ROOT, keep_csv=False,
+                    force=False, manifest_root=None):
+    """
+    Writes daily or hourly bars to {output_root}/{frequency}/{ticker}.zip, encoding and zipping in memory.
+    The zip is built next to the target and renamed into place, or dropped when it holds the same bars as the
+    existing one, see lean_manifest.
+    Args:
+        data (pd.DataFrame or iterable): Bars sorted by 'ts_event', or an iterable of such chunks.
+        ticker (str): The stock ticker symbol.
+        frequency (str): 'daily' or 'hourly'. Defaults to 'daily'.
+        timezone (str): Time zone the LEAN times are written in. Defaults to New York.
+        output_root (str): Root of the LEAN equity data folder. Defaults to 'data/equity/usa'.
+        keep_csv (bool): Also write the plain {ticker}.csv next to the zip. Defaults to False.
+        force (bool): Replace the zip even if its content is unchanged. Defaults to False.
+        manifest_root (str, optional): Manifest folder. Defaults to the lean_manifest_root environment variable.
+    Returns:
+        str: Path of the zip file.
+    """
+    if frequency not in ('daily', 'hourly'):
+        raise ValueError(f"Unsupported frequency for a single-file LEAN output: {frequency}")
+    if isinstance(data, pd.DataFrame):
+        data = [data]
+
+    output_dir = os.path.join(output_root, FREQUENCY_DIRS[frequency])
+    os.makedirs(output_dir, exist_ok=True)
+    zip_file = os.path.join(output_dir, f'{ticker.lower()}.zip')
+    csv_file = os.path.join(output_dir, f'{ticker.lower()}.csv')
+    manifest = load_manifest(ticker, frequency, manifest_root)
+
+    with span('lean_write', ticker=ticker, resolution=frequency) as written:
+        with atomic_path(zip_file) as tmp_zip, (atomic_path(csv_file) if keep_csv else nullcontext()) as tmp_csv:
+            with (open(tmp_csv, 'wb') if keep_csv else nullcontext()) as csv_out:
+                with zipfile.ZipFile(tmp_zip, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+                    with zf.open(f'{ticker.lower()}.csv', 'w') as entry:
+                        hashed = HashingWriter(entry)
+                        for chunk in data:
+                            for start in range(0, len(chunk), ENCODE_CHUNK_ROWS):
+                                part = chunk.iloc[start:start + ENCODE_CHUNK_ROWS]
+                                with span('lean_encode', ticker=ticker) as s:
+                                    payload = encode_lean_frame(part, timezone=timezone)
+                                    s.add(rows=len(part), bytes=len(payload))
+                                # Compression happens as the entry is written
+                                with span('zip_write', ticker=ticker) as s:
+                                    hashed.write(payload)
+                                    if csv_out is not None:
+                                        csv_out.write(payload)
+                                    s.add(bytes=len(payload))
+            output = _finish_bars(zip_file, csv_file, tmp_zip, tmp_csv, hashed, manifest, force)
+        if output is None:
+            written.add(skipped=1)
+        else:
+            _record_outputs(manifest, {zip_file: output}, ticker, frequency, manifest_root)
+            written.add(files=1, bytes=output['size'])
+
+    return zip_file
+
+def _replace_offset(payload, time_field):
+    # Offset of the first line whose time is at or after time_field, searched from the end since new bars only
+    # overlap the last day; 'YYYYMMDD HH:MM' times compare in time order
+    end = len(payload)
+    while end:
+        start = payload.rfind(b'\n', 0, end - 1) + 1
+        if payload[start:end].split(b',', 1)[0] < time_field:
+            return end
+        end = start
+    return 0
+
+def append_lean_bars(data, ticker, frequency='daily', timezone=LEAN_TIMEZONE, output_root=LEAN_EQUITY_ROOT,
+                     keep_csv=False, manifest_root=None):
+    """
+    Extends {output_root}/{frequency}/{ticker}.zip, as written by write_lean_bars, with new bars instead of
+    re-encoding its whole history. Lines of the existing entry from the first new bar on are replaced, so the
+    bars may restart inside the last written day (e.g. a day re-aggregated once more minutes arrived).
+    Zip entries are deflate streams that cannot be extended, so the kept lines are compressed again from the
+    decoded entry; only the new bars are read and encoded.
+    Args:
+        data (pd.DataFrame or iterable): New bars sorted by 'ts_event', or an iterable of such chunks.
+        ticker (str): The stock ticker symbol.
+        frequency (str): 'daily' or 'hourly'. Defaults to 'daily'.
+        timezone (str): Time zone the LEAN times are written in, the one of the existing zip. Defaults to New York.
+        output_root (str): Root of the LEAN equity data folder. Defaults to 'data/equity/usa'.
+        keep_csv (bool): Also rewrite the plain {ticker}.csv next to the zip. Defaults to False.
+        manifest_root (str, optional): Manifest folder. Defaults to the lean_manifest_root environment variable.
+    Returns:
+        str: Path of the zip file.
+    Raises:
+        ValueError: If the zip is missing or not the one recorded in the manifest; rebuild it with write_lean_bars.
+    """
+    if frequency not in ('daily', 'hourly'):
+        raise ValueError(f"Unsupported frequency for a single-file LEAN output: {frequency}")
+    if isinstance(data, pd.DataFrame):
+        data = [data]
+
+    output_dir = os.path.join(output_root, FREQUENCY_DIRS[frequency])
+    zip_file = os.path.join(output_dir, f'{ticker.lower()}.zip')
+    csv_file = os.path.join(output_dir, f'{ticker.lower()}.csv')
+    manifest = load_manifest(ticker, frequency, manifest_root)
+    if not is_intact(zip_file, manifest['outputs'].get(output_key(zip_file))):
+        raise ValueError(f"{zip_file} is not the zip recorded in the manifest, it cannot be appended to")
+
+    with span('lean_encode', ticker=ticker) as s:
+        payload = b''.join(encode_lean_frame(chunk, timezone=timezone) for chunk in data if len(chunk))
+        s.add(rows=payload.count(b'\n'), bytes=len(payload))
+    if not payload:
+        return zip_file
+
+    entry_name = f'{ticker.lower()}.csv'
+    with span('lean_write', ticker=ticker, resolution=frequency, mode='append') as written:
+        with zipfile.ZipFile(zip_file) as zf:
+            existing = zf.read(entry_name)
+        kept = existing[:_replace_offset(existing, payload.split(b',', 1)[0])]
+        with atomic_path(zip_file) as tmp_zip, (atomic_path(csv_file) if keep_csv else nullcontext()) as tmp_csv:
+            with zipfile.ZipFile(tmp_zip, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+                with zf.open(entry_name, 'w') as entry:
+                    hashed = HashingWriter(entry)
+                    hashed.write(kept)
+                    hashed.write(payload)
+            if keep_csv:
+                with open(tmp_csv, 'wb') as csv_out:
+                    csv_out.write(kept)
+                    csv_out.write(payload)
+            output = output_entry(tmp_zip, hashed.rows, hashed.last_bar(), hashed.hexdigest())
+        _record_outputs(manifest, {zip_file: output}, ticker, frequency, manifest_root)
+        written.add(files=1, rows=payload.count(b'\n'), replaced=existing.count(b'\n', len(kept)), bytes=output['size'])
+
+    return zip_file
+
+def to_polars(data, datetime_column='ts_event'):
+    """
+    Returns bars as a Polars LazyFrame with a UTC datetime_column.
+    Args:
+        data: A pl.LazyFrame, pl.DataFrame, pd.DataFrame or iterable of chunks of any of these.
+            Timestamps may be strings (e.g. from scan_csv), naive datetimes (taken as UTC) or tz-aware datetimes.
+        datetime_column (str): The name of the bar timestamp column. Defaults to 'ts_event'.
+    Returns:
+        pl.LazyFrame: The bars.
+    """
+    import polars as pl
+    if isinstance(data, pl.DataFrame):
+        data = data.lazy()
+    elif not isinstance(data, pl.LazyFrame):
+        frames = [data] if isinstance(data, pd.DataFrame) else list(data)
+        if not frames:
+            schema = {datetime_column: pl.Datetime('ns', 'UTC'), **{col: pl.Float64 for col in PRICE_COLUMNS}, 'volume': pl.Int64}
+            return pl.LazyFrame(schema=schema)
+        data = pl.concat([_lazy_frame(frame, datetime_column) for frame in frames], how='vertical_relaxed')
+
+    dtype = data.collect_schema()[datetime_column]
+    ts = pl.col(datetime_column)
+    if dtype == pl.String:
+        ts = ts.str.to_datetime(time_zone='UTC')
+    elif dtype.time_zone is None:
+        ts = ts.dt.replace_time_zone('UTC')
+    else:
+        ts = ts.dt.convert_time_zone('UTC')
+    return data.with_columns(ts)
+
+def _lazy_frame(frame, datetime_column):
+    import polars as pl
+    if isinstance(frame, (pl.DataFrame, pl.LazyFrame)):
+        return frame.lazy()
+    if frame.index.name == datetime_column:
+        frame = frame.reset_index()
+    return pl.from_pandas(frame).lazy()
+
+def _collect_windows(data, datetime_column):
+    # Collected frames sorted by datetime_column: a lazy plan one calendar year at a time (the raw store's partitions,
+    # pushed down to the scan), chunks one at a time, a frame already in memory as it is
+    import polars as pl
+    if isinstance(data, (pd.DataFrame, pl.DataFrame)):
+        yield to_polars(data, datetime_column).sort(datetime_column).collect()
+    elif isinstance(data, pl.LazyFrame):
+        plan = to_polars(data, datetime_column)
+        ts = pl.col(datetime_column)
+        first, last = plan.select(ts.min(), ts.max().alias('last')).collect().row(0)
+        if first is None:
+            return
+        for year in range(first.year, last.year + 1):
+            start = pd.Timestamp(f'{year}-01-01', tz='UTC').to_pydatetime()
+            end = pd.Timestamp(f'{year + 1}-01-01', tz='UTC').to_pydatetime()
+            yield plan.filter((ts >= start) & (ts < end)).sort(datetime_column).collect(engine='streaming')
+    else:
+        for chunk in data:
+            yield to_polars(chunk, datetime_column).sort(datetime_column).collect()
+
+def iter_polars_chunks(data, timezone=LEAN_TIMEZONE, datetime_column='ts_event'):
+    """
+    Collects bars as Polars DataFrames of whole exchange-local trading days, so a Polars writer never holds the
+    whole range. Like iter_trading_days, the last day of a chunk is carried into the next one until it is complete.
+    Args:
+        data: Bars in any form accepted by to_polars. A lazy plan is collected one calendar year at a time, an
+            iterable chunk by chunk (each sorted, chunks in time order).
+        timezone (str): Exchange time zone the trading days are taken in. Defaults to New York.
+        datetime_column (str): The name of the bar timestamp column. Defaults to 'ts_event'.
+    Yields:
+        pl.DataFrame: Bars of one or more whole trading days, sorted by datetime_column.
+    """
+    import polars as pl
+    day = _polars_local_time(timezone, datetime_column).dt.date()
+    pending = None
+    for chunk in _collect_windows(data, datetime_column):
+        if pending is not None:
+            chunk = pl.concat([pending, chunk], how='vertical_relaxed')
+        if chunk.is_empty():
+            continue
+        last = chunk.select(day.last()).item()
+        pending = chunk.filter(day == last)
+        complete = chunk.filter(day < last)
+        if not complete.is_empty():
+            yield complete
+    if pending is not None and not pending.is_empty():
+        yield pending
+
+def has_fixed_prices(plan):
+    """
+    True when the prices of a Polars plan are integers, i.e. DBN fixed-point (see to_deci_cents).
+    """
+    return plan.collect_schema()['close'].is_integer()
+
+def _polars_local_time(timezone, datetime_column='ts_event'):
+    import polars as pl
+    return pl.col(datetime_column).dt.convert_time_zone(timezone).dt.replace_time_zone(None)
+
+def lean_line_expr(time_format='date', timezone=LEAN_TIMEZONE, datetime_column='ts_event', fixed=False):
+    """
+    Polars expression formatting each bar as a LEAN CSV line (without the newline), see encode_lean_bars.
+    Prices are converted to deci-cents exactly like to_deci_cents, from DBN fixed-point when fixed is set.
+    """
+    import polars as pl
+    local = _polars_local_time(timezone, datetime_column)
+    if time_format == 'ms':
+        time_str = (local - local.dt.truncate('1d')).dt.total_milliseconds().cast(pl.String)
+    else:
+        time_str = local.dt.strftime('%Y%m%d %H:%M')
+    if fixed:
+        prices = [(pl.col(col).cast(pl.Int64) // DBN_PRICE_PER_DECI_CENT).cast(pl.String) for col in PRICE_COLUMNS]
+    else:
+        prices = [(pl.col(col).cast(pl.Float64) * 10000).cast(pl.Int64).cast(pl.String) for col in PRICE_COLUMNS]
+    volume = pl.col('volume').cast(pl.Int64).cast(pl.String)
+    return pl.concat_str([time_str, *prices, volume], separator=',').alias('line')
+
+def write_lean_minute_data_polars(data, ticker, resolution='minute', output_root=LEAN_EQUITY_ROOT, max_workers=None,
+                                  timezone=LEAN_TIMEZONE, force=False, manifest_root=None):
+    """
+    Polars engine for write_lean_minute_data, writing the same per-day zips and skipping the same unchanged days.
+    The bars are collected in chunks of whole trading days (iter_polars_chunks), each chunk is formatted and its
+    days are zipped by a thread pool (zlib releases the GIL) before the next one is collected.
+    Args:
+        data: Bars in any form accepted by to_polars, e.g. raw_store.scan_raw(...) or an iterable of chunks.
+        ticker (str): The stock ticker symbol.
+        resolution (str): 'minute' or 'second'. Defaults to 'minute'.
+        output_root (str): Root of the LEAN equity data folder. Defaults to 'data/equity/usa'.
+        max_workers (int, optional): Threads zipping days. Defaults to os.cpu_count().
+        timezone (str): Exchange time zone. Defaults to New York.
+        force (bool): Rewrite unchanged days too. Defaults to False.
+        manifest_root (str, optional): Manifest folder. Defaults to the lean_manifest_root environment variable.
+    Returns:
+        list: Paths of the day zip files, in trading-day order.
+    """
+    output_dir = os.path.join(output_root, resolution, ticker.lower())
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = load_manifest(ticker, resolution, manifest_root)
+
+    def write_day(day):
+        date_str = day['date'][0]
+        zip_file = os.path.join(output_dir, f'{date_str}_trade.zip')
+        payload = day.select('line').write_csv(include_header=False, quote_style='never').encode()
+        entry = _write_day_zip(zip_file, f'{date_str}_{ticker.lower()}_{resolution}_trade.csv', payload,
+                               manifest['outputs'].get(output_key(zip_file)), force, ticker, date_str)
+        return zip_file, entry
+
+    written = []
+    with span('lean_write', ticker=ticker, resolution=resolution) as s, \
+            ThreadPoolExecutor(max_workers=max_workers or os.cpu_count() or 1) as executor:
+        for chunk in iter_polars_chunks(data, timezone):
+            with span('lean_encode', ticker=ticker) as encoded:
+                lines = chunk.select(date=_polars_local_time(timezone).dt.strftime('%Y%m%d'),
+                                     line=lean_line_expr('ms', timezone, fixed=has_fixed_prices(chunk)))
+                encoded.add(rows=len(lines))
+            written += executor.map(write_day, lines.partition_by('date', maintain_order=True))
+        entries = dict(written)
+        _record_outputs(manifest, entries, ticker, resolution, manifest_root)
+        s.add(files=len(entries), bytes=sum(entry['size'] for entry in entries.values()))
+    return [zip_file for zip_file, _ in written]
+
+def write_lean_bars_polars(data, ticker, frequency='daily', timezone=LEAN_TIMEZONE, output_root=LEAN_EQUITY_ROOT,
+                           keep_csv=False, force=False, manifest_root=None):
+    """
+    Polars engine for write_lean_bars: the formatted plan is streamed with sink_csv straight into the zip entry.
+    Arguments are the same as write_lean_bars, data in any form accepted by to_polars.
+    Returns:
+        str: Path of the zip file.
+    """
+    if frequency not in ('daily', 'hourly'):
+        raise ValueError(f"Unsupported frequency for a single-file LEAN output: {frequency}")
+    output_dir = os.path.join(output_root, FREQUENCY_DIRS[frequency])
+    os.makedirs(output_dir, exist_ok=True)
+    zip_file = os.path.join(output_dir, f'{ticker.lower()}.zip')
+    csv_file = os.path.join(output_dir, f'{ticker.lower()}.csv')
+    plan = to_polars(data)
+    plan = plan.sort('ts_event').select(lean_line_expr('date', timezone, fixed=has_fixed_prices(plan)))
+    manifest = load_manifest(ticker, frequency, manifest_root)
+
+    with span('lean_write', ticker=ticker, resolution=frequency) as written:
+        with atomic_path(zip_file) as tmp_zip, (atomic_path(csv_file) if keep_csv else nullcontext()) as tmp_csv:
+            with zipfile.ZipFile(tmp_zip, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+                with zf.open(f'{ticker.lower()}.csv', 'w') as entry:
+                    hashed = HashingWriter(entry)
+                    if keep_csv:
+                        with span('lean_encode', ticker=ticker) as s:
+                            plan.sink_csv(tmp_csv, include_header=False, quote_style='never')
+                            s.add(bytes=os.path.getsize(tmp_csv))
+                        with span('zip_write', ticker=ticker) as s, open(tmp_csv, 'rb') as csv_in:
+                            shutil.copyfileobj(csv_in, hashed)
+                            s.add(bytes=hashed.size)
+                    else:
+                        # Encoding and compression overlap, rows go from the plan into the zip entry in batches
+                        with span('lean_encode', ticker=ticker) as s:
+                            plan.sink_csv(hashed, include_header=False, quote_style='never')
+                            s.add(bytes=hashed.size)
+            output = _finish_bars(zip_file, csv_file, tmp_zip, tmp_csv, hashed, manifest, force)
+        if output is None:
+            written.add(skipped=1)
+        else:
+            _record_outputs(manifest, {zip_file: output}, ticker, frequency, manifest_root)
+            written.add(files=1, bytes=output['size'])
+    return zip_file
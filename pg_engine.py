@@ -0,0 +1,252 @@
+from contextlib import contextmanager
+from sqlalchemy import create_engine, text
+import numpy as np
+import threading
+import time
+import io
+import os
+
+'''
+Process-wide SQLAlchemy engine for the PostgreSQL backend.
+The engine (and its connection pool) is created lazily on first use and shared by every helper in
+databento_sql.py and the Dagster ops, instead of creating and disposing a pool per call.
+
+Pool settings come from environment variables (or configure_engine):
+    pgpool_size (default 5), pgmax_overflow (default 10), pgpool_recycle seconds (default 1800),
+    pgpool_pre_ping (default true)
+
+timed_connection records, per label, how long was spent checking a connection out of the pool
+versus running queries on it, see get_timings / print_timings.
+
+copy_from_buffer and copy_to_bytes run COPY on the DBAPI connection behind a pooled connection;
+decode_copy_binary turns binary COPY output of fixed-width columns into NumPy arrays without a per-row loop,
+column_types gives the types to decode a table's columns with.
+'''
+
+# PostgreSQL type -> big-endian NumPy type of its binary COPY representation, fixed-width types only
+COPY_BINARY_TYPES = {'int2': '>i2', 'int4': '>i4', 'int8': '>i8', 'float4': '>f4', 'float8': '>f8', 'timestamptz': '>i8'}
+COPY_SIGNATURE = b'PGCOPY\n\xff\r\n\x00'
+# Binary timestamps count microseconds from 2000-01-01 UTC
+PG_EPOCH_US = 946_684_800_000_000
+
+_engine = None
+_engine_lock = threading.Lock()
+_engine_options = {}
+
+_timings = {}
+_timings_lock = threading.Lock()
+
+def get_db_url():
+    """
+    Builds the PostgreSQL URL from the pguser, pgpass and pghost environment variables.
+    """
+    pguser = os.getenv('pguser')
+    pgpass = os.getenv('pgpass')
+    pghost = os.getenv('pghost')
+    return f'postgresql://{pguser}:{pgpass}@{pghost}/FinancialData'
+
+def _pool_options():
+    options = {
+        'pool_size': int(os.getenv('pgpool_size', 5)),
+        'max_overflow': int(os.getenv('pgmax_overflow', 10)),
+        'pool_recycle': int(os.getenv('pgpool_recycle', 1800)),
+        'pool_pre_ping': os.getenv('pgpool_pre_ping', 'true').lower() in ('1', 'true', 'yes'),
+    }
+    options.update(_engine_options)
+    return options
+
+def _after_fork():
+    # Pooled connections belong to the parent process, a forked worker (e.g. a pipeline converter) opens its own
+    global _engine, _engine_lock
+    _engine_lock = threading.Lock()
+    if _engine is not None:
+        _engine.dispose(close=False)
+    _engine = None
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+def get_engine():
+    """
+    Returns the shared engine, creating it on first use.
+    """
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                options = _pool_options()
+                url = options.pop('url', None) or get_db_url()
+                _engine = create_engine(url, **options)
+    return _engine
+
+def configure_engine(url=None, pool_size=None, max_overflow=None, pool_recycle=None, pool_pre_ping=None):
+    """
+    Overrides the pool settings. The current engine, if any, is disposed and recreated on next use.
+    Args:
+        url (str, optional): Database URL instead of the one built from environment variables.
+        pool_size (int, optional): Connections kept open in the pool.
+        max_overflow (int, optional): Extra connections allowed above pool_size.
+        pool_recycle (int, optional): Seconds after which a pooled connection is replaced.
+        pool_pre_ping (bool, optional): Test connections for liveness on checkout.
+    """
+    overrides = {'url': url, 'pool_size': pool_size, 'max_overflow': max_overflow,
+                 'pool_recycle': pool_recycle, 'pool_pre_ping': pool_pre_ping}
+    _engine_options.update({key: value for key, value in overrides.items() if value is not None})
+    dispose_engine()
+
+def dispose_engine():
+    """
+    Closes every pooled connection. The next get_engine call creates a new engine.
+    """
+    global _engine
+    with _engine_lock:
+        if _engine is not None:
+            _engine.dispose()
+        _engine = None
+
+@contextmanager
+def timed_connection(label, transaction=False):
+    """
+    Checks a connection out of the shared pool and records checkout and query time under label.
+    Args:
+        label (str): Name the timings are aggregated under, e.g. the calling helper.
+        transaction (bool): Wrap the block in a transaction that commits on success. Defaults to False.
+    Yields:
+        sqlalchemy.engine.Connection: The pooled connection.
+    """
+    start = time.perf_counter()
+    conn = get_engine().connect()
+    checked_out = time.perf_counter()
+    try:
+        if transaction:
+            with conn.begin():
+                yield conn
+        else:
+            yield conn
+    finally:
+        conn.close()
+        _record_timing(label, checked_out - start, time.perf_counter() - checked_out)
+
+def _record_timing(label, checkout_s, query_s):
+    with _timings_lock:
+        stats = _timings.setdefault(label, {'calls': 0, 'checkout_s': 0.0, 'query_s': 0.0})
+        stats['calls'] += 1
+        stats['checkout_s'] += checkout_s
+        stats['query_s'] += query_s
+
+def get_timings():
+    """
+    Returns a copy of the accumulated timings: label -> {'calls', 'checkout_s', 'query_s'}.
+    """
+    with _timings_lock:
+        return {label: dict(stats) for label, stats in _timings.items()}
+
+def reset_timings():
+    with _timings_lock:
+        _timings.clear()
+
+def print_timings():
+    """
+    Prints the accumulated checkout versus query time per label.
+    """
+    for label, stats in sorted(get_timings().items()):
+        print(f"{label}: {stats['calls']} calls, checkout {stats['checkout_s']:.3f}s, query {stats['query_s']:.3f}s")
+
+def copy_from_buffer(conn, copy_sql, buffer):
+    """
+    Runs COPY ... FROM STDIN on the DBAPI connection behind a SQLAlchemy connection.
+    Works with psycopg2 (copy_expert) and psycopg 3 (cursor.copy).
+    Args:
+        conn (sqlalchemy.engine.Connection): Connection from timed_connection.
+        copy_sql (str): The COPY statement.
+        buffer (io.StringIO): Data in the format named by the COPY statement.
+    """
+    cursor = conn.connection.cursor()
+    try:
+        if hasattr(cursor, 'copy_expert'):
+            cursor.copy_expert(copy_sql, buffer)
+        else:
+            with cursor.copy(copy_sql) as copy:
+                while data := buffer.read(1 << 20):
+                    copy.write(data)
+    finally:
+        cursor.close()
+
+def copy_to_bytes(conn, copy_sql, params=None):
+    """
+    Runs COPY ... TO STDOUT on the DBAPI connection behind a SQLAlchemy connection and returns its whole output.
+    Works with psycopg2 (copy_expert, parameters bound with mogrify) and psycopg 3 (cursor.copy).
+    Args:
+        conn (sqlalchemy.engine.Connection): Connection from timed_connection.
+        copy_sql (str): The COPY statement, with the driver's %(name)s placeholders.
+        params (dict, optional): Values of the placeholders.
+    Returns:
+        bytes-like: The COPY output.
+    """
+    cursor = conn.connection.cursor()
+    try:
+        if hasattr(cursor, 'copy_expert'):
+            buffer = io.BytesIO()
+            if params:
+                copy_sql = cursor.mogrify(copy_sql, params).decode()
+            cursor.copy_expert(copy_sql, buffer)
+            return buffer.getbuffer()
+        data = bytearray()
+        with cursor.copy(copy_sql, params) as copy:
+            while block := copy.read():
+                data += block
+        return data
+    finally:
+        cursor.close()
+
+def column_types(conn, table):
+    """
+    Returns the types of a table's columns with one catalog query.
+    Args:
+        conn (sqlalchemy.engine.Connection): Any connection.
+        table (str): The quoted, schema-qualified table name.
+    Returns:
+        dict: Column name -> PostgreSQL type name as in COPY_BINARY_TYPES (e.g. 'float8', 'int8'), empty if no such table.
+    """
+    rows = conn.execute(text(
+        'SELECT a.attname, t.typname FROM pg_attribute AS a JOIN pg_type AS t ON t.oid = a.atttypid '
+        'WHERE a.attrelid = to_regclass(:table) AND a.attnum > 0 AND NOT a.attisdropped'
+    ), {'table': table})
+    return dict(rows.all())
+
+def decode_copy_binary(data, types):
+    """
+    Decodes COPY ... TO STDOUT (FORMAT binary) output of fixed-width, non-null columns.
+    Every row then has the same layout, so the rows are viewed as one big-endian record array and each column
+    is converted with a single NumPy cast.
+    Args:
+        data (bytes-like): The COPY output, e.g. from copy_to_bytes.
+        types (dict): Column name -> PostgreSQL type (a COPY_BINARY_TYPES key), in the order of the COPY columns.
+    Returns:
+        dict: Column name -> native NumPy array; timestamptz columns are UTC datetime64[ns] values.
+    Raises:
+        ValueError: If the data is not binary COPY output of those columns, e.g. it holds NULLs.
+    """
+    data = memoryview(data)
+    if len(data) < 21 or bytes(data[:11]) != COPY_SIGNATURE:
+        raise ValueError('Not binary COPY output')
+    offset = 19 + int.from_bytes(data[15:19], 'big')
+    fields = [('fields', '>i2')]
+    for i, (name, pg_type) in enumerate(types.items()):
+        fields += [(f'length{i}', '>i4'), (name, COPY_BINARY_TYPES[pg_type])]
+    layout = np.dtype(fields)
+    count, rest = divmod(len(data) - offset - 2, layout.itemsize)
+    if rest or bytes(data[-2:]) != b'\xff\xff':
+        raise ValueError('Binary COPY rows are not fixed-width, a column is NULL or of another type')
+    rows = np.frombuffer(data, layout, count, offset)
+    if (rows['fields'] != len(types)).any() or any(
+            (rows[f'length{i}'] != layout[name].itemsize).any() for i, name in enumerate(types)):
+        raise ValueError('Binary COPY rows are not fixed-width, a column is NULL or of another type')
+
+    columns = {}
+    for name, pg_type in types.items():
+        values = rows[name].astype(layout[name].newbyteorder('='))
+        if pg_type == 'timestamptz':
+            values = ((values + PG_EPOCH_US) * 1000).view('datetime64[ns]')
+        columns[name] = values
+    return columns
@@ -0,0 +1,481 @@
+import pandas as pd
+import numpy as np
+import logging
+import io
+import os
+from sqlalchemy import text
+from pg_engine import timed_connection, copy_from_buffer, copy_to_bytes, decode_copy_binary, column_types
+from databento_fetch import PRICE_COLUMNS, FIXED_PRICE_SCALE, convert_prices, get_price_type
+from instrumentation import span, configure, log_error
+
+'''
+Single multi-symbol PostgreSQL table for Data Bento bars, instead of one table per ticker.
+
+    {pg_store_schema}.ohlcv (symbol, schema, ts_event, open, high, low, close, volume)
+        primary key (symbol, schema, ts_event), index (schema, ts_event)
+        range-partitioned by month of ts_event: ohlcv_2023_01, ohlcv_2023_02, ...
+        optionally hash-partitioned by symbol inside each month: ohlcv_2023_01_h0 .. _h{n-1}
+
+Monthly partitions are created on demand by the writers. Reads filter on ts_event, so PostgreSQL only opens the
+months of the requested range; one symbol's history is a primary-key range scan and a one-day universe read
+(read_cross_section) one indexed query, where the per-ticker layout needed a UNION over thousands of tables.
+
+{pg_store_schema}.ohlcv_coverage keeps the first/last ts_event and distinct UTC dates per symbol and schema, updated
+in the same transaction as every write (databento_sql.py keeps a symbol_coverage table per schema for the per-ticker layout).
+
+Prices are DOUBLE PRECISION dollars, or BIGINT DBN fixed-point (1e-9 dollars) when the table is created with
+databento_price_type=fixed; rows written in the other representation are converted to the table's.
+
+Settings come from environment variables:
+    pg_store_schema (default 'databento'), pg_hash_partitions (default 0, no hash partitions; only applies to
+    months created afterwards), pg_layout ('tables' (default) or 'partitioned', picks the layout databento_sql.py uses)
+
+migrate_ticker_tables copies existing per-ticker tables into the store:
+    python pg_store.py databento_ohlcv ohlcv-1d
+'''
+
+logger = logging.getLogger(__name__)
+
+# Rows per keyset-paginated chunk of iter_bars, like databento_sql.iter_data_from_postgresql
+READ_CHUNK_ROWS = int(os.getenv('pg_read_chunk_rows', 500_000))
+STORE_TABLE = 'ohlcv'
+COVERAGE_TABLE = 'ohlcv_coverage'
+BAR_COLUMNS = ['open', 'high', 'low', 'close', 'volume']
+KEY_COLUMNS = ['symbol', 'schema', 'ts_event']
+# Types the bars are copied out with by read_bars, symbols travel as their 1-based position in the symbol list
+COPY_TYPES = {'symbol': 'int4', 'ts_event': 'timestamptz', 'open': 'float8', 'high': 'float8', 'low': 'float8',
+              'close': 'float8', 'volume': 'int8'}
+
+def price_sql_type(price_type=None):
+    """
+    Returns the PostgreSQL type of the price columns of new tables, see databento_fetch.get_price_type.
+    """
+    return 'bigint' if get_price_type(price_type) == 'fixed' else 'double precision'
+
+def stored_price_type(conn, table):
+    """
+    Returns 'fixed' when the table's price columns are BIGINT fixed-point, else 'float'.
+    """
+    return 'fixed' if column_types(conn, table).get('close') == 'int8' else 'float'
+
+def price_copy_types(types, price_type):
+    """
+    Returns COPY column types (see COPY_TYPES) with the price columns read as int8 when price_type is 'fixed'.
+    """
+    if price_type != 'fixed':
+        return types
+    return {col: 'int8' if col in PRICE_COLUMNS else pg_type for col, pg_type in types.items()}
+
+def copy_column(column, pg_type, qualifier=''):
+    """
+    Returns the select expression of a bar column for binary COPY. Casts pin it to the fixed-width type
+    decode_copy_binary expects, which has no NULLs: NULL prices read as NaN like pd.read_sql, a NULL volume as 0.
+    """
+    expression = f'{qualifier}"{column}"::{pg_type}'
+    if pg_type == 'float8':
+        return f"coalesce({expression}, 'NaN')"
+    if column == 'volume':
+        return f'coalesce({expression}, 0)'
+    return expression
+
+def get_store_schema():
+    """
+    Returns the PostgreSQL schema holding the store, the pg_store_schema environment variable or 'databento'.
+    """
+    return os.getenv('pg_store_schema', 'databento')
+
+def use_partitioned_store():
+    """
+    Returns True when databento_sql.py should read and write the store (pg_layout=partitioned).
+    """
+    layout = os.getenv('pg_layout', 'tables')
+    if layout not in ('tables', 'partitioned'):
+        raise ValueError(f"Unknown pg_layout {layout!r}, expected 'tables' or 'partitioned'")
+    return layout == 'partitioned'
+
+def _month_starts(start, end):
+    # First day of every month touched by [start, end]
+    start = pd.Timestamp(start).tz_localize(None).to_period('M').to_timestamp()
+    end = pd.Timestamp(end).tz_localize(None).to_period('M').to_timestamp()
+    return pd.date_range(start, end, freq='MS')
+
+def _exists(conn, name):
+    return conn.execute(text('SELECT to_regclass(:name) IS NOT NULL'), {'name': name}).scalar()
+
+def ensure_store(conn, pg_schema=None):
+    """
+    Creates the schema, the partitioned store table, its indexes and the coverage table, only if missing.
+    """
+    pg_schema = pg_schema or get_store_schema()
+    prices = ', '.join(f'{col} {price_sql_type()}' for col in PRICE_COLUMNS)
+    conn.execute(text(f'CREATE SCHEMA IF NOT EXISTS "{pg_schema}"'))
+    conn.execute(text(
+        f'CREATE TABLE IF NOT EXISTS "{pg_schema}".{STORE_TABLE} ('
+        f'symbol text NOT NULL, schema text NOT NULL, ts_event timestamptz NOT NULL, {prices}, volume bigint, '
+        f'PRIMARY KEY (symbol, schema, ts_event)) PARTITION BY RANGE (ts_event)'
+    ))
+    # Cross-sectional reads (every symbol over a few days) use this index instead of the primary key
+    conn.execute(text(
+        f'CREATE INDEX IF NOT EXISTS {STORE_TABLE}_schema_ts_event_idx ON "{pg_schema}".{STORE_TABLE} (schema, ts_event)'
+    ))
+    conn.execute(text(
+        f'CREATE TABLE IF NOT EXISTS "{pg_schema}".{COVERAGE_TABLE} ('
+        f'symbol text NOT NULL, schema text NOT NULL, first_ts timestamptz NOT NULL, last_ts timestamptz NOT NULL, '
+        f'dates date[] NOT NULL, updated_at timestamptz NOT NULL, PRIMARY KEY (symbol, schema))'
+    ))
+
+def ensure_partitions(conn, start, end, pg_schema=None, hash_partitions=None):
+    """
+    Creates the monthly partitions covering [start, end] that do not exist yet.
+    With hash_partitions (default: the pg_hash_partitions environment variable) each new month is split by symbol.
+    """
+    pg_schema = pg_schema or get_store_schema()
+    if hash_partitions is None:
+        hash_partitions = int(os.getenv('pg_hash_partitions', 0))
+    # Concurrent writers would race on creating the same month
+    conn.execute(text('SELECT pg_advisory_xact_lock(hashtext(:key))'), {'key': f'{pg_schema}.{STORE_TABLE}'})
+    for month in _month_starts(start, end):
+        name = f'{STORE_TABLE}_{month:%Y_%m}'
+        upper = month + pd.offsets.MonthBegin(1)
+        split = ' PARTITION BY HASH (symbol)' if hash_partitions else ''
+        if _exists(conn, f'"{pg_schema}".{name}'):
+            continue
+        conn.execute(text(
+            f'CREATE TABLE "{pg_schema}".{name} PARTITION OF "{pg_schema}".{STORE_TABLE} '
+            f"FOR VALUES FROM ('{month:%Y-%m-%d} 00:00:00+00') TO ('{upper:%Y-%m-%d} 00:00:00+00'){split}"
+        ))
+        for remainder in range(hash_partitions):
+            conn.execute(text(
+                f'CREATE TABLE "{pg_schema}".{name}_h{remainder} PARTITION OF "{pg_schema}".{name} '
+                f'FOR VALUES WITH (MODULUS {hash_partitions}, REMAINDER {remainder})'
+            ))
+        logger.debug(f'Created partition {pg_schema}.{name}')
+
+def _update_coverage(conn, source, pg_schema, params=None):
+    # Adds the rows of source (anything with symbol, schema and ts_event columns) to their coverage rows
+    conn.execute(text(
+        f'INSERT INTO "{pg_schema}".{COVERAGE_TABLE} AS c (symbol, schema, first_ts, last_ts, dates, updated_at) '
+        f"SELECT symbol, schema, min(ts_event), max(ts_event), "
+        f"array_agg(DISTINCT (ts_event AT TIME ZONE 'UTC')::date ORDER BY (ts_event AT TIME ZONE 'UTC')::date), now() "
+        f'FROM {source} GROUP BY symbol, schema '
+        f'ON CONFLICT (symbol, schema) DO UPDATE SET first_ts = least(c.first_ts, EXCLUDED.first_ts), '
+        f'last_ts = greatest(c.last_ts, EXCLUDED.last_ts), '
+        f'dates = ARRAY(SELECT DISTINCT d FROM unnest(c.dates || EXCLUDED.dates) AS d ORDER BY d), '
+        f'updated_at = EXCLUDED.updated_at'
+    ), params or {})
+
+def upsert_bars(df, schema='ohlcv-1d', symbol=None, pg_schema=None):
+    """
+    Upserts bars of any number of symbols into the store.
+    Rows are bulk loaded with COPY into a staging table and merged with INSERT ... ON CONFLICT (symbol, schema, ts_event),
+    creating the months they fall in first.
+    Args:
+        df (pd.DataFrame): Bars with ts_event (column or index), the BAR_COLUMNS and a 'symbol' column unless symbol is given.
+        schema (str): Data Bento schema of the bars. Defaults to 'ohlcv-1d'.
+        symbol (str, optional): The symbol of every row, overriding any 'symbol' column.
+        pg_schema (str, optional): Schema holding the store. Defaults to the pg_store_schema environment variable.
+    Returns:
+        int: Rows inserted or updated.
+    """
+    pg_schema = pg_schema or get_store_schema()
+    if 'ts_event' not in df.columns:
+        df = df.reset_index()
+    df = df.assign(schema=schema, ts_event=pd.to_datetime(df['ts_event'], utc=True))
+    if symbol is not None:
+        df = df.assign(symbol=symbol)
+    df = df[KEY_COLUMNS + BAR_COLUMNS].drop_duplicates(subset=KEY_COLUMNS, keep='last')
+    if df.empty:
+        return 0
+
+    columns = ', '.join(KEY_COLUMNS + BAR_COLUMNS)
+    updates = ', '.join(f'{col} = EXCLUDED.{col}' for col in BAR_COLUMNS)
+    target = f'"{pg_schema}".{STORE_TABLE}'
+    try:
+        with timed_connection('upsert_bars', transaction=True) as conn:
+            ensure_store(conn, pg_schema)
+            df = convert_prices(df, stored_price_type(conn, target))
+            ensure_partitions(conn, df['ts_event'].min(), df['ts_event'].max(), pg_schema)
+            conn.execute(text(f'CREATE TEMP TABLE store_stage ON COMMIT DROP AS SELECT {columns} FROM {target} WITH NO DATA'))
+
+            with span('db_write', symbols=df['symbol'].nunique(), mode='copy') as s:
+                buffer = io.StringIO()
+                df.to_csv(buffer, index=False, header=False)
+                s.add(rows=len(df), bytes=buffer.tell())
+                buffer.seek(0)
+                copy_from_buffer(conn, f'COPY store_stage ({columns}) FROM STDIN WITH (FORMAT csv)', buffer)
+
+            with span('merge', symbols=df['symbol'].nunique()) as s:
+                result = conn.execute(text(
+                    f'INSERT INTO {target} ({columns}) SELECT {columns} FROM store_stage '
+                    f'ON CONFLICT (symbol, schema, ts_event) DO UPDATE SET {updates}'
+                ))
+                s.add(rows=result.rowcount)
+            _update_coverage(conn, 'store_stage', pg_schema)
+        logger.info(f"{len(df)} {schema} rows for {df['symbol'].nunique()} symbol(s) upserted into {target}.")
+        return result.rowcount
+    except Exception as e:
+        log_error(logger, f'Error upserting {schema} bars into {target}', e)
+        # The caller must not mark the range covered
+        raise
+
+def _as_utc(value):
+    # Date strings are taken as UTC midnight, like the per-ticker range reads
+    value = pd.Timestamp(value)
+    return value.tz_localize('UTC') if value.tzinfo is None else value
+
+def end_bound(end_date):
+    """
+    Returns the exclusive ts_event upper bound of a range ending at end_date: timezone-aware timestamps are taken as
+    they are (see resolution.session_bounds), dates and date strings are whole UTC days, the end day included.
+    """
+    end = pd.Timestamp(end_date)
+    return end if end.tzinfo is not None else end.normalize().tz_localize('UTC') + pd.Timedelta(days=1)
+
+def _range_filter(symbols, schema, start_date, end_date, bind=':{}'):
+    # bind formats the placeholders, ':{}' for SQLAlchemy text() and '%({})s' for the DBAPI COPY path
+    filters, params = [f"schema = {bind.format('schema')}"], {'schema': schema}
+    if symbols is not None:
+        filters.append(f"symbol = ANY({bind.format('symbols')})")
+        params['symbols'] = [symbols] if isinstance(symbols, str) else list(symbols)
+    if start_date is not None:
+        filters.append(f"ts_event >= {bind.format('start')}")
+        params['start'] = _as_utc(start_date).to_pydatetime()
+    if end_date is not None:
+        filters.append(f"ts_event < {bind.format('end')}")
+        params['end'] = end_bound(end_date).to_pydatetime()
+    return ' AND '.join(filters), params
+
+def frame_from_columns(columns, engine=None):
+    """
+    Builds a DataFrame from pg_engine.decode_copy_binary columns, making ts_event UTC-aware without parsing it.
+    Returns:
+        pd.DataFrame, or pl.DataFrame with engine='polars'.
+    """
+    from lean_writer import get_engine
+    if get_engine(engine) == 'polars':
+        import polars as pl
+        return pl.DataFrame(columns).with_columns(pl.col('ts_event').dt.replace_time_zone('UTC'))
+    df = pd.DataFrame(columns, copy=False)
+    df['ts_event'] = df['ts_event'].dt.tz_localize('UTC')
+    return df
+
+def _symbol_list(conn, symbols, schema, pg_schema):
+    # Every symbol with coverage in the schema when symbols is None
+    if symbols is not None:
+        return [symbols] if isinstance(symbols, str) else list(symbols)
+    if not _exists(conn, f'"{pg_schema}".{COVERAGE_TABLE}'):
+        return []
+    query = text(f'SELECT symbol FROM "{pg_schema}".{COVERAGE_TABLE} WHERE schema = :schema ORDER BY symbol')
+    return [row[0] for row in conn.execute(query, {'schema': schema})]
+
+def read_bars(symbols, schema='ohlcv-1d', start_date=None, end_date=None, columns=None, pg_schema=None, engine=None):
+    """
+    Reads bars of one or many symbols in one indexed query, pruned to the months of the range.
+    Args:
+        symbols (str or list): Symbol(s) to read, None for every symbol.
+        schema (str): Data Bento schema. Defaults to 'ohlcv-1d'.
+        start_date (datetime-like, optional): First ts_event, inclusive.
+        end_date (datetime-like, optional): Exclusive end when timezone-aware, else the last UTC date read, see end_bound.
+        columns (list, optional): Bar columns to read. Defaults to BAR_COLUMNS.
+        pg_schema (str, optional): Schema holding the store. Defaults to the pg_store_schema environment variable.
+        engine (str, optional): 'pandas' or 'polars', see lean_writer.get_engine.
+    Returns:
+        pd.DataFrame (or pl.DataFrame with engine='polars'): symbol, ts_event and the columns, ordered by symbol and ts_event.
+    """
+    pg_schema = pg_schema or get_store_schema()
+    types = {col: COPY_TYPES[col] for col in ['symbol', 'ts_event'] + list(columns or BAR_COLUMNS)}
+    where, params = _range_filter(None, schema, start_date, end_date, bind='%({})s')
+    with span('db_read', schema=schema, query='store', mode='copy_binary') as s, timed_connection('read_bars') as conn:
+        # Fixed-point prices are copied as they are stored
+        types = price_copy_types(types, stored_price_type(conn, f'"{pg_schema}".{STORE_TABLE}'))
+        # Symbols are joined with their position in the list, so every copied column is fixed-width
+        select = ', '.join(['k.code::int4', 'b.ts_event'] + [
+            copy_column(col, pg_type, 'b.') for col, pg_type in list(types.items())[2:]])
+        query = (f'COPY (SELECT {select} FROM "{pg_schema}".{STORE_TABLE} AS b '
+                 f'JOIN unnest(%(symbols)s::text[]) WITH ORDINALITY AS k(symbol, code) ON k.symbol = b.symbol '
+                 f'WHERE {where} ORDER BY b.symbol, b.ts_event) TO STDOUT (FORMAT binary)')
+        names = _symbol_list(conn, symbols, schema, pg_schema)
+        data = copy_to_bytes(conn, query, dict(params, symbols=names))
+        decoded = decode_copy_binary(data, types)
+        s.add(rows=len(decoded['ts_event']), bytes=len(data))
+    decoded['symbol'] = np.asarray(names, dtype=object)[decoded['symbol'] - 1]
+    return frame_from_columns(decoded, engine)
+
+def iter_bars(symbols, schema='ohlcv-1d', start_date=None, end_date=None, columns=None, pg_schema=None, engine=None,
+              chunk_rows=None):
+    """
+    Streams bars like read_bars as DataFrames of at most chunk_rows rows, so memory stays bounded however long the
+    range. Each chunk is one keyset-paginated query on the primary key ((symbol, ts_event) after the last row read).
+    Args:
+        chunk_rows (int, optional): Rows per chunk. Defaults to the pg_read_chunk_rows environment variable (500,000).
+        Others as read_bars.
+    Yields:
+        pd.DataFrame (or pl.DataFrame with engine='polars'): symbol, ts_event and the columns, ordered by symbol and ts_event.
+    """
+    pg_schema = pg_schema or get_store_schema()
+    types = {col: COPY_TYPES[col] for col in ['symbol', 'ts_event'] + list(columns or BAR_COLUMNS)}
+    where, params = _range_filter(None, schema, start_date, end_date, bind='%({})s')
+    with timed_connection('iter_bars') as conn:
+        # Fixed-point prices are copied as they are stored
+        types = price_copy_types(types, stored_price_type(conn, f'"{pg_schema}".{STORE_TABLE}'))
+        names = _symbol_list(conn, symbols, schema, pg_schema)
+    if not names:
+        return
+    select = ', '.join(['k.code::int4', 'b.ts_event'] + [
+        copy_column(col, pg_type, 'b.') for col, pg_type in list(types.items())[2:]])
+    params.update(symbols=names, limit=chunk_rows or READ_CHUNK_ROWS)
+    after = None
+    while True:
+        keyset = ' AND (b.symbol, b.ts_event) > (%(after_symbol)s, %(after)s)' if after is not None else ''
+        query = (f'COPY (SELECT {select} FROM "{pg_schema}".{STORE_TABLE} AS b '
+                 f'JOIN unnest(%(symbols)s::text[]) WITH ORDINALITY AS k(symbol, code) ON k.symbol = b.symbol '
+                 f'WHERE {where}{keyset} ORDER BY b.symbol, b.ts_event LIMIT %(limit)s) TO STDOUT (FORMAT binary)')
+        with span('db_read', schema=schema, query='store', mode='copy_binary') as s, \
+                timed_connection('iter_bars') as conn:
+            data = copy_to_bytes(conn, query, dict(params, after_symbol=after and after[0], after=after and after[1]))
+            decoded = decode_copy_binary(data, types)
+            s.add(rows=len(decoded['ts_event']), bytes=len(data))
+        rows = len(decoded['ts_event'])
+        if rows == 0:
+            return
+        decoded['symbol'] = np.asarray(names, dtype=object)[decoded['symbol'] - 1]
+        # ts_event is decoded as naive UTC, the next page starts after the last (symbol, ts_event) read
+        after = (decoded['symbol'][-1], pd.Timestamp(decoded['ts_event'][-1]).tz_localize('UTC').to_pydatetime())
+        yield frame_from_columns(decoded, engine)
+        if rows < params['limit']:
+            return
+
+def read_cross_section(date, schema='ohlcv-1d', symbols=None, columns=None, pg_schema=None):
+    """
+    Reads every symbol's bars on one UTC date (or a list of symbols) with one query on the (schema, ts_event) index.
+    Returns:
+        pd.DataFrame: symbol, ts_event and the columns, ordered by symbol and ts_event.
+    """
+    start = _as_utc(pd.Timestamp(date).normalize())
+    end = start + pd.Timedelta(days=1)
+    return read_bars(symbols, schema, start, end, columns, pg_schema)
+
+def get_coverage(symbols, schema='ohlcv-1d', pg_schema=None):
+    """
+    Returns the coverage rows of the symbols, one primary-key lookup each in a single query.
+    Returns:
+        dict: symbol -> {'first_ts', 'last_ts', 'dates'}; symbols without data are left out.
+    """
+    pg_schema = pg_schema or get_store_schema()
+    symbols = [symbols] if isinstance(symbols, str) else list(symbols)
+    query = text(f'SELECT symbol, first_ts, last_ts, dates FROM "{pg_schema}".{COVERAGE_TABLE} '
+                 f'WHERE schema = :schema AND symbol = ANY(:symbols)')
+    with timed_connection('store_coverage') as conn:
+        if not _exists(conn, f'"{pg_schema}".{COVERAGE_TABLE}'):
+            return {}
+        rows = conn.execute(query, {'schema': schema, 'symbols': symbols}).mappings().all()
+    return {row['symbol']: {key: row[key] for key in ('first_ts', 'last_ts', 'dates')} for row in rows}
+
+def get_existing_dates(symbol, schema='ohlcv-1d', pg_schema=None):
+    """
+    Returns the UTC dates stored for the symbol from its coverage row, or None when it has no data.
+    """
+    coverage = get_coverage(symbol, schema, pg_schema).get(symbol)
+    if coverage is None:
+        return None
+    return pd.DatetimeIndex(coverage['dates']).tz_localize('UTC')
+
+def summary_query(source, where, split=False):
+    """
+    Builds the fingerprint query of the rows of source matching where: row count, last ts_event and a content hash
+    (the sum of a 64-bit hash of every row). With split the same three follow for the rows with ts_event <= :split,
+    computed in the same scan.
+    """
+    hashed = f'SELECT ts_event, hashtextextended(t::text, 0) AS h FROM {source} AS t WHERE {where}'
+    filters = [''] + ([' FILTER (WHERE ts_event <= :split)'] if split else [])
+    aggregates = ', '.join(f'count(*){f}, max(ts_event){f}, coalesce(sum(h){f}, 0)' for f in filters)
+    return text(f'SELECT {aggregates} FROM ({hashed}) AS s')
+
+def summarize(symbol, schema, start_date, end_date, pg_schema=None, split=None):
+    """
+    Row count, last ts_event and a content hash of the symbol's rows from start_date to end_date (see end_bound), from one
+    aggregate query.
+    The hash is the sum of a 64-bit hash of every row, like databento_sql.get_source_fingerprint.
+    Returns:
+        tuple: (rows, max_ts_event, content_hash), followed by the same for the rows up to split when it is given.
+    """
+    pg_schema = pg_schema or get_store_schema()
+    where, params = _range_filter(symbol, schema, start_date, end_date)
+    query = summary_query(f'"{pg_schema}".{STORE_TABLE}', where, split is not None)
+    if split is not None:
+        params['split'] = _as_utc(split).to_pydatetime()
+    with span('db_read', ticker=symbol, query='fingerprint'), timed_connection('store_fingerprint') as conn:
+        return tuple(conn.execute(query, params).one())
+
+def list_ticker_tables(source_schema='databento_ohlcv'):
+    """
+    Lists the per-ticker tables of a schema, e.g. to migrate them.
+    """
+    query = text('SELECT tablename FROM pg_tables WHERE schemaname = :schema AND tablename <> :coverage ORDER BY tablename')
+    with timed_connection('list_ticker_tables') as conn:
+        return [row[0] for row in conn.execute(query, {'schema': source_schema, 'coverage': 'symbol_coverage'})]
+
+def _converted_prices(source_type, target_type):
+    # Bar column expressions converting prices like databento_fetch.convert_prices
+    if source_type == target_type:
+        return ', '.join(BAR_COLUMNS)
+    prices = [f'round({col} * {FIXED_PRICE_SCALE})::bigint' if target_type == 'fixed'
+              else f'{col}::float8 / {FIXED_PRICE_SCALE}'
+              for col in PRICE_COLUMNS]
+    return ', '.join(prices + ['volume'])
+
+def migrate_ticker_tables(source_schema='databento_ohlcv', schema='ohlcv-1d', tickers=None, pg_schema=None, drop=False):
+    """
+    Copies per-ticker tables (databento_sql.py's original layout) into the store, one transaction per ticker.
+    Rows are copied inside PostgreSQL with INSERT ... SELECT; rows already in the store are kept, so an interrupted
+    migration can be run again.
+    Args:
+        source_schema (str): Schema holding one table per ticker. Defaults to 'databento_ohlcv'.
+        schema (str): Data Bento schema of those tables. Defaults to 'ohlcv-1d'.
+        tickers (list, optional): Tables to migrate. Defaults to every table of source_schema.
+        pg_schema (str, optional): Schema holding the store. Defaults to the pg_store_schema environment variable.
+        drop (bool): Drop each ticker table once its rows are in the store. Defaults to False.
+    Returns:
+        dict: ticker -> rows copied.
+    """
+    pg_schema = pg_schema or get_store_schema()
+    tickers = tickers or list_ticker_tables(source_schema)
+    columns = ', '.join(BAR_COLUMNS)
+    target = f'"{pg_schema}".{STORE_TABLE}'
+    copied = {}
+    for ticker in tickers:
+        source = f'"{source_schema}"."{ticker}"'
+        try:
+            with span('migrate', ticker=ticker) as s, timed_connection('migrate_ticker_tables', transaction=True) as conn:
+                ensure_store(conn, pg_schema)
+                first, last = conn.execute(text(f'SELECT min(ts_event), max(ts_event) FROM {source}')).one()
+                if first is not None:
+                    ensure_partitions(conn, first, last, pg_schema)
+                    values = _converted_prices(stored_price_type(conn, source), stored_price_type(conn, target))
+                    result = conn.execute(text(
+                        f'INSERT INTO {target} (symbol, schema, ts_event, {columns}) '
+                        f'SELECT :symbol, :schema, ts_event, {values} FROM {source} '
+                        f'ON CONFLICT (symbol, schema, ts_event) DO NOTHING'
+                    ), {'symbol': ticker, 'schema': schema})
+                    copied[ticker] = result.rowcount
+                    _update_coverage(conn, f'(SELECT CAST(:symbol AS text) AS symbol, CAST(:schema AS text) AS schema, '
+                                           f'ts_event FROM {source}) AS migrated', pg_schema,
+                                     {'symbol': ticker, 'schema': schema})
+                else:
+                    copied[ticker] = 0
+                if drop:
+                    conn.execute(text(f'DROP TABLE {source}'))
+                    if _exists(conn, f'"{source_schema}".symbol_coverage'):
+                        conn.execute(text(f'DELETE FROM "{source_schema}".symbol_coverage WHERE symbol = :symbol'),
+                                     {'symbol': ticker})
+                s.add(rows=copied[ticker])
+            logger.info(f'{ticker}: {copied[ticker]} rows migrated from {source} to {pg_schema}.{STORE_TABLE}')
+        except Exception as e:
+            log_error(logger, f'Error migrating {source}', e)
+    return copied
+
+if __name__ == '__main__':
+    import sys
+    # Log level/format and the metrics file come from the lean_log_* and lean_metrics_* environment variables
+    configure()
+    migrate_ticker_tables(*sys.argv[1:3])
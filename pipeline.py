@@ -0,0 +1,190 @@
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from dataclasses import dataclass, field
+from functools import partial
+import multiprocessing
+import threading
+import queue
+import time
+import os
+from instrumentation import span, configure, get_metrics, merge_metrics, reset_metrics
+
+'''
+Concurrent multi-ticker pipeline runner.
+Each ticker goes through three stages that overlap across tickers:
+    fetch   - thread pool, network bound, limited to a number of concurrent and per-second Data Bento requests
+    store   - bounded writer stage (a few threads behind a bounded queue), e.g. the PostgreSQL upsert
+    convert - process pool, CPU bound, the LEAN conversion
+Stages are connected by bounded queues, so a slow writer or converter stalls the stage before it
+instead of buffering every ticker's data in memory.
+run_pipeline returns a TickerStatus per ticker recording the stage that failed and the exception,
+rather than printing and moving on.
+
+Limits come from arguments or environment variables:
+    databento_max_concurrency (default 4), databento_requests_per_second (default 10)
+'''
+
+@dataclass
+class TickerStatus:
+    ticker: str
+    ok: bool = False
+    # Last stage reached: 'fetch', 'store', 'convert' or 'done'
+    stage: str = 'fetch'
+    error: Exception = None
+    # Seconds spent in each stage
+    timings: dict = field(default_factory=dict)
+
+class RateLimiter:
+    """
+    Thread-safe limiter allowing at most rate calls per second, spaced evenly.
+    """
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+def run_pipeline(tickers, fetch, store, convert, fetch_workers=None, requests_per_second=None, store_workers=1,
+                 store_queue_size=None, convert_workers=None):
+    """
+    Runs fetch -> store -> convert for every ticker with the stages overlapping.
+    Args:
+        tickers (list): The stock ticker symbols.
+        fetch (callable): fetch(ticker) -> fetched data, run in threads under the request limits.
+        store (callable): store(ticker, fetched), run by the writer threads.
+        convert (callable): convert(ticker), run in a process pool, must be picklable (a module-level function or partial).
+        fetch_workers (int, optional): Concurrent fetches. Defaults to databento_max_concurrency or 4.
+        requests_per_second (float, optional): Fetches started per second. Defaults to databento_requests_per_second or 10.
+        store_workers (int): Writer threads. Defaults to 1.
+        store_queue_size (int, optional): Fetched tickers waiting for a writer before fetches block. Defaults to 2 * store_workers.
+        convert_workers (int, optional): Converter processes. Defaults to the CPU count. 1 converts in the writer threads.
+    Returns:
+        dict: ticker -> TickerStatus, in the order of tickers.
+    """
+    fetch_workers = fetch_workers or int(os.getenv('databento_max_concurrency', 4))
+    requests_per_second = requests_per_second or float(os.getenv('databento_requests_per_second', 10))
+    convert_workers = convert_workers or os.cpu_count() or 1
+    store_queue = queue.Queue(maxsize=store_queue_size or 2 * store_workers)
+    # At most this many tickers are converting or waiting to convert, after that the writers block
+    convert_slots = threading.BoundedSemaphore(2 * convert_workers)
+    limiter = RateLimiter(requests_per_second)
+
+    tickers = list(dict.fromkeys(tickers))
+    statuses = {ticker: TickerStatus(ticker) for ticker in tickers}
+
+    def fail(status, stage, error):
+        status.stage = stage
+        status.error = error
+
+    def fetch_one(ticker):
+        status = statuses[ticker]
+        limiter.wait()
+        start = time.perf_counter()
+        try:
+            with span('pipeline_fetch', ticker=ticker):
+                fetched = fetch(ticker)
+        except Exception as e:
+            fail(status, 'fetch', e)
+            return
+        finally:
+            status.timings['fetch'] = time.perf_counter() - start
+        # Blocks while the writers are behind
+        store_queue.put((ticker, fetched))
+
+    def converted(status, start, future):
+        status.timings['convert'] = time.perf_counter() - start
+        error = future.exception()
+        if error is None:
+            merge_metrics(future.result())
+            status.ok = True
+            status.stage = 'done'
+        else:
+            fail(status, 'convert', error)
+        convert_slots.release()
+
+    def write_loop(converter):
+        while True:
+            item = store_queue.get()
+            if item is None:
+                return
+            ticker, fetched = item
+            status = statuses[ticker]
+            status.stage = 'store'
+            start = time.perf_counter()
+            try:
+                with span('pipeline_store', ticker=ticker):
+                    store(ticker, fetched)
+            except Exception as e:
+                fail(status, 'store', e)
+                continue
+            finally:
+                status.timings['store'] = time.perf_counter() - start
+                del fetched
+
+            status.stage = 'convert'
+            start = time.perf_counter()
+            if converter is None:
+                try:
+                    with span('pipeline_convert', ticker=ticker):
+                        convert(ticker)
+                    status.ok = True
+                    status.stage = 'done'
+                except Exception as e:
+                    fail(status, 'convert', e)
+                status.timings['convert'] = time.perf_counter() - start
+                continue
+            # Blocks while the converters are behind
+            convert_slots.acquire()
+            try:
+                future = converter.submit(_convert_in_worker, convert, ticker)
+            except Exception as e:
+                convert_slots.release()
+                fail(status, 'convert', e)
+                continue
+            future.add_done_callback(lambda f, status=status, start=start: converted(status, start, f))
+
+    # Converters are spawned rather than forked: the parent already runs fetch and writer threads holding locks and
+    # connection pools that a forked child would inherit mid-use. A spawned process starts without the parent's
+    # logging setup, so each one configures its own (without a metrics export, the parent merges their metrics)
+    converter = ProcessPoolExecutor(max_workers=convert_workers, mp_context=multiprocessing.get_context('spawn'),
+                                    initializer=partial(configure, export=False)) if convert_workers > 1 else None
+    try:
+        writers = [threading.Thread(target=write_loop, args=(converter,), daemon=True) for _ in range(store_workers)]
+        for writer in writers:
+            writer.start()
+        with ThreadPoolExecutor(max_workers=fetch_workers) as fetchers:
+            list(fetchers.map(fetch_one, tickers))
+        for _ in writers:
+            store_queue.put(None)
+        for writer in writers:
+            writer.join()
+    finally:
+        if converter is not None:
+            converter.shutdown(wait=True)
+    return statuses
+
+def _convert_in_worker(convert, ticker):
+    # Spans recorded in the converter process are sent back and merged into the parent's metrics
+    reset_metrics()
+    with span('pipeline_convert', ticker=ticker):
+        convert(ticker)
+    return get_metrics()
+
+def print_statuses(statuses):
+    """
+    Prints one line per ticker and a summary of the failures.
+    """
+    failed = [status for status in statuses.values() if not status.ok]
+    for status in statuses.values():
+        timings = ', '.join(f'{stage} {seconds:.2f}s' for stage, seconds in status.timings.items())
+        if status.ok:
+            print(f'{status.ticker}: ok ({timings})')
+        else:
+            print(f'{status.ticker}: failed in {status.stage}: {status.error!r} ({timings})')
+    print(f'{len(statuses) - len(failed)} of {len(statuses)} tickers succeeded')
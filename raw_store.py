@@ -0,0 +1,314 @@
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pathlib import Path
+import threading
+import time
+import os
+from instrumentation import span
+from databento_fetch import PRICE_COLUMNS, FIXED_PRICE_SCALE, convert_prices, get_price_type
+
+'''
+Columnar raw-data store for vendor downloads, replacing databento/downloads/{ticker}_data.csv.
+Data is partitioned by symbol, schema and year as Parquet files with row-group statistics:
+    databento/raw/{ticker}/{schema}/{year}/{write_time_ns}-{pid}.parquet
+New data is always written as new files, history is never rewritten. Readers apply the files in
+write order (the name order; write times never repeat within a process and the pid tells processes apart) and
+keep the last record per ts_event, so a later download supersedes an earlier one.
+Date filters are pushed down to the Parquet reader, so only matching years and row groups are read.
+Prices are stored as decoded, float dollars or int64 fixed-point, and read in the representation set by
+databento_price_type (databento_fetch.get_price_type), so files written under either setting can be mixed.
+'''
+
+RAW_STORE_ROOT = 'databento/raw'
+ROW_GROUP_SIZE = 100_000
+
+def _schema_dir(ticker, schema, root):
+    return Path(root) / ticker / schema
+
+def _utc(ts):
+    # Naive timestamps are taken as UTC
+    ts = pd.Timestamp(ts)
+    return ts.tz_localize('UTC') if ts.tzinfo is None else ts.tz_convert('UTC')
+
+def _local_date(ts, timezone):
+    ts = pd.Timestamp(ts)
+    if ts.tzinfo is not None:
+        ts = ts.tz_convert(timezone).tz_localize(None)
+    return ts.normalize()
+
+def _bounds(start_date, end_date, timezone='UTC'):
+    # UTC [start, end) bounds for whole dates given in timezone
+    start = end = None
+    if start_date is not None:
+        start = _utc(_local_date(start_date, timezone).tz_localize(timezone))
+    if end_date is not None:
+        end = _utc((_local_date(end_date, timezone) + pd.Timedelta(days=1)).tz_localize(timezone))
+    return start, end
+
+def list_files(ticker, schema='ohlcv-1d', root=RAW_STORE_ROOT, start_date=None, end_date=None, timezone='UTC'):
+    """
+    Lists a symbol's Parquet files in write order, skipping years outside the date range.
+    Returns:
+        list: Paths of the matching files.
+    """
+    schema_dir = _schema_dir(ticker, schema, root)
+    if not schema_dir.exists():
+        return []
+    start, end = _bounds(start_date, end_date, timezone)
+    first_year = start.year if start is not None else None
+    last_year = end.year if end is not None else None
+
+    files = []
+    for year_dir in sorted(schema_dir.iterdir(), key=lambda p: p.name):
+        year = int(year_dir.name)
+        if (first_year is not None and year < first_year) or (last_year is not None and year > last_year):
+            continue
+        files.extend(sorted(year_dir.glob('*.parquet'), key=lambda p: p.name))
+    return files
+
+_last_write_ns = 0
+_write_lock = threading.Lock()
+
+def _file_name():
+    # time.time_ns() can return the same value twice on coarse clocks (Windows), so names stay strictly increasing
+    # within a process; the pid keeps concurrent writers apart
+    global _last_write_ns
+    with _write_lock:
+        _last_write_ns = max(time.time_ns(), _last_write_ns + 1)
+        return f'{_last_write_ns}-{os.getpid()}.parquet'
+
+def write_raw(df, ticker, schema='ohlcv-1d', root=RAW_STORE_ROOT):
+    """
+    Writes new records as one new Parquet file per year touched.
+    Args:
+        df (pd.DataFrame): Records with ts_event as index or column, as returned by DBNStore.to_df().
+        ticker (str): The stock ticker symbol.
+        schema (str): Data Bento schema. Defaults to 'ohlcv-1d'.
+        root (str): Root of the raw store. Defaults to 'databento/raw'.
+    Returns:
+        list: Paths of the files written.
+    """
+    if df.index.name == 'ts_event':
+        df = df.reset_index()
+    if df.empty:
+        return []
+    df = df.assign(ts_event=pd.to_datetime(df['ts_event'], utc=True)).sort_values('ts_event')
+
+    written = []
+    with span('raw_write', ticker=ticker, schema=schema) as s:
+        for year, part in df.groupby(df['ts_event'].dt.year):
+            year_dir = _schema_dir(ticker, schema, root) / str(year)
+            year_dir.mkdir(parents=True, exist_ok=True)
+            path = year_dir / _file_name()
+            # Write to a temp name first so readers never see a partial file
+            tmp_path = path.with_suffix('.parquet.tmp')
+            table = pa.Table.from_pandas(part, preserve_index=False)
+            pq.write_table(table, tmp_path, row_group_size=ROW_GROUP_SIZE, compression='zstd', write_statistics=True)
+            os.replace(tmp_path, path)
+            written.append(path)
+            s.add(rows=len(part), files=1, bytes=path.stat().st_size)
+    return written
+
+def _filters(start_date, end_date, timezone='UTC'):
+    # Pushed down to the Parquet reader so row groups outside the range are skipped using their statistics
+    start, end = _bounds(start_date, end_date, timezone)
+    filters = []
+    if start is not None:
+        filters.append(('ts_event', '>=', start))
+    if end is not None:
+        filters.append(('ts_event', '<', end))
+    return filters or None
+
+def _read_files(files, start_date, end_date, columns, timezone='UTC'):
+    if columns is not None and 'ts_event' not in columns:
+        columns = ['ts_event'] + list(columns)
+    filters = _filters(start_date, end_date, timezone)
+    with span('raw_read') as s:
+        frames = [pq.read_table(f, columns=columns, filters=filters).to_pandas() for f in files]
+        s.add(files=len(frames), rows=sum(len(frame) for frame in frames))
+    if not frames:
+        return None
+    # Files written with another databento_price_type are converted
+    frames = [convert_prices(frame) for frame in frames]
+    with span('merge') as s:
+        df = pd.concat(frames, ignore_index=True)
+        # Later files win when the same bar was downloaded twice
+        df = df.drop_duplicates(subset='ts_event', keep='last').sort_values('ts_event')
+        s.add(rows=len(df))
+    return df.set_index('ts_event')
+
+def read_raw(ticker, schema='ohlcv-1d', start_date=None, end_date=None, columns=None, root=RAW_STORE_ROOT, timezone='UTC'):
+    """
+    Reads a symbol's records, optionally within a date range and for a subset of columns.
+    Args:
+        ticker (str): The stock ticker symbol.
+        schema (str): Data Bento schema. Defaults to 'ohlcv-1d'.
+        start_date (datetime-like, optional): First date to read.
+        end_date (datetime-like, optional): Last date to read, inclusive.
+        columns (list, optional): Columns to read besides ts_event.
+        root (str): Root of the raw store. Defaults to 'databento/raw'.
+        timezone (str): Time zone the dates are given in, e.g. 'America/New_York' for exchange days. Defaults to 'UTC'.
+    Returns:
+        pd.DataFrame: Records indexed by ts_event, or None if nothing is stored.
+    """
+    files = list_files(ticker, schema, root, start_date, end_date, timezone)
+    return _read_files(files, start_date, end_date, columns, timezone)
+
+def iter_raw_years(ticker, schema='ohlcv-1d', start_date=None, end_date=None, columns=None, root=RAW_STORE_ROOT,
+                   timezone='UTC'):
+    """
+    Yields a symbol's records one year at a time, in time order, so converters hold at most a year in memory.
+    Arguments are the same as read_raw.
+    Yields:
+        pd.DataFrame: Records of one year indexed by ts_event.
+    """
+    by_year = {}
+    for f in list_files(ticker, schema, root, start_date, end_date, timezone):
+        by_year.setdefault(f.parent.name, []).append(f)
+    for year in sorted(by_year, key=int):
+        df = _read_files(by_year[year], start_date, end_date, columns, timezone)
+        if df is not None and not df.empty:
+            yield df
+
+def scan_raw(ticker, schema='ohlcv-1d', start_date=None, end_date=None, columns=None, root=RAW_STORE_ROOT, timezone='UTC'):
+    """
+    Lazy Polars equivalent of read_raw: one scan_parquet plan with the date filter pushed down and the
+    same last-write-wins deduplication, evaluated multi-threaded when collected or sunk.
+    Arguments are the same as read_raw; requires Polars.
+    Returns:
+        pl.LazyFrame: Records with a ts_event column, sorted by ts_event, or None if nothing is stored.
+    """
+    import polars as pl
+    files = list_files(ticker, schema, root, start_date, end_date, timezone)
+    if not files:
+        return None
+    if columns is not None and 'ts_event' not in columns:
+        columns = ['ts_event'] + list(columns)
+    # Files are concatenated in write order, so keep='last' keeps the latest download of a bar
+    scans = [pl.scan_parquet(f) for f in files]
+    # Files written with another databento_price_type are converted like databento_fetch.convert_prices
+    # (divided in NumPy, Polars' float division can differ from it in the last bit)
+    fixed = get_price_type() == 'fixed'
+    scans = [scan.with_columns(
+        (pl.col(col) * FIXED_PRICE_SCALE).round().cast(pl.Int64) if fixed else
+        pl.col(col).map_batches(lambda s: pl.Series(s.name, s.to_numpy() / FIXED_PRICE_SCALE), return_dtype=pl.Float64)
+        for col in PRICE_COLUMNS if col in file_schema and file_schema[col].is_integer() != fixed)
+        for scan, file_schema in ((scan, scan.collect_schema()) for scan in scans)]
+    plan = pl.concat(scans, how='diagonal_relaxed')
+    if columns is not None:
+        plan = plan.select(columns)
+    start, end = _bounds(start_date, end_date, timezone)
+    if start is not None:
+        plan = plan.filter(pl.col('ts_event') >= start.to_pydatetime())
+    if end is not None:
+        plan = plan.filter(pl.col('ts_event') < end.to_pydatetime())
+    return plan.unique(subset='ts_event', keep='last', maintain_order=True).sort('ts_event')
+
+def get_existing_dates(ticker, schema='ohlcv-1d', root=RAW_STORE_ROOT):
+    """
+    Reads only the ts_event column to list the stored dates.
+    Returns:
+        pd.DatetimeIndex: Sorted tz-naive dates, or None if nothing is stored.
+    """
+    files = list_files(ticker, schema, root)
+    if not files:
+        return None
+    ts = pd.concat([pq.read_table(f, columns=['ts_event']).to_pandas()['ts_event'] for f in files])
+    return pd.DatetimeIndex(ts.dt.tz_convert('UTC').dt.tz_localize(None).dt.normalize().unique()).sort_values()
+
+def list_symbols(schema='ohlcv-1d', root=RAW_STORE_ROOT):
+    """
+    Lists the symbols with a folder for the schema, sorted.
+    """
+    root = Path(root)
+    if not root.exists():
+        return []
+    return sorted(path.name for path in root.iterdir() if (path / schema).is_dir())
+
+def file_time_bounds(path):
+    """
+    Returns a file's first and last ts_event from its Parquet row-group statistics, without reading any data.
+    Returns:
+        tuple: (min, max) pd.Timestamp in UTC, or None when the file has no statistics.
+    """
+    metadata = pq.ParquetFile(path).metadata
+    column = metadata.schema.to_arrow_schema().get_field_index('ts_event')
+    lows, highs = [], []
+    for i in range(metadata.num_row_groups):
+        stats = metadata.row_group(i).column(column).statistics
+        if stats is not None and stats.has_min_max:
+            lows.append(pd.Timestamp(stats.min))
+            highs.append(pd.Timestamp(stats.max))
+    if not lows:
+        return None
+    return _utc(min(lows)), _utc(max(highs))
+
+def get_time_bounds(ticker, schema='ohlcv-1d', root=RAW_STORE_ROOT):
+    """
+    Returns the first and last ts_event from the Parquet row-group statistics, without reading any data.
+    Returns:
+        tuple: (min, max) pd.Timestamp in UTC, or None if nothing is stored.
+    """
+    bounds = [b for b in map(file_time_bounds, list_files(ticker, schema, root)) if b is not None]
+    if not bounds:
+        return None
+    return min(low for low, _ in bounds), max(high for _, high in bounds)
+
+def summarize_files(ticker, schema='ohlcv-1d', root=RAW_STORE_ROOT, start_date=None, end_date=None, timezone='UTC'):
+    """
+    Describes the files a read of the date range would open, from the Parquet footers only.
+    Since files are never rewritten, the file names and sizes identify the stored content.
+    Returns:
+        dict: 'files' (list of (relative path, size)), 'rows' (total rows in them, duplicates included),
+            'max_ts_event' (pd.Timestamp in UTC, or None) and 'first_ts_event' (relative path -> the file's first
+            ts_event in UTC, or None).
+    """
+    files, rows, highs, firsts = [], 0, [], {}
+    for f in list_files(ticker, schema, root, start_date, end_date, timezone):
+        metadata = pq.ParquetFile(f).metadata
+        name = f'{f.parent.name}/{f.name}'
+        files.append((name, f.stat().st_size))
+        rows += metadata.num_rows
+        column = metadata.schema.to_arrow_schema().get_field_index('ts_event')
+        lows = []
+        for i in range(metadata.num_row_groups):
+            stats = metadata.row_group(i).column(column).statistics
+            if stats is not None and stats.has_min_max:
+                lows.append(pd.Timestamp(stats.min))
+                highs.append(pd.Timestamp(stats.max))
+        firsts[name] = _utc(min(lows)) if lows else None
+    return {'files': files, 'rows': rows, 'max_ts_event': _utc(max(highs)) if highs else None, 'first_ts_event': firsts}
+
+def compact(ticker, schema='ohlcv-1d', year=None, root=RAW_STORE_ROOT):
+    """
+    Rewrites a year's (or every year's) files into one deduplicated file, e.g. after many daily top-ups.
+    """
+    by_year = {}
+    for f in list_files(ticker, schema, root):
+        by_year.setdefault(f.parent.name, []).append(f)
+    for name, files in by_year.items():
+        if (year is not None and int(name) != int(year)) or len(files) < 2:
+            continue
+        df = _read_files(files, None, None, None)
+        write_raw(df, ticker, schema, root)
+        for f in files:
+            f.unlink()
+
+def import_csv(csv_file, ticker, schema='ohlcv-1d', root=RAW_STORE_ROOT):
+    """
+    Imports an existing CSV download (databento/downloads/{ticker}_data.csv layout) into the store.
+    """
+    df = pd.read_csv(csv_file, index_col=0)
+    df.index = pd.to_datetime(df.index, utc=True)
+    df.index.name = 'ts_event'
+    return write_raw(df, ticker, schema, root)
+
+def export_csv(ticker, csv_file, schema='ohlcv-1d', start_date=None, end_date=None, root=RAW_STORE_ROOT):
+    """
+    Exports a symbol's records to a CSV in the databento/downloads/{ticker}_data.csv layout.
+    """
+    df = read_raw(ticker, schema, start_date, end_date, root=root)
+    if df is not None:
+        df.to_csv(csv_file)
+    return df
@@ -0,0 +1,225 @@
+from concurrent.futures import ThreadPoolExecutor
+import databento as db
+import pandas as pd
+import logging
+import json
+import math
+import os
+from databento_fetch import DATABENTO_DATASET, get_client, get_range_cached, dbn_cache_path
+from symbology import resolve_instrument_ids
+from instrumentation import span
+
+'''
+Cost- and size-aware planning of large Data Bento requests.
+A single timeseries.get_range over years of minute bars or trades is slow to stream, times out and is held whole in
+memory. get_range_planned instead asks the metadata endpoints (free) how many records and dollars the request is,
+then splits the range into day-aligned chunks of at most max_records records:
+
+    metadata.get_cost(whole range)          -> refuse up front when over max_cost
+    metadata.get_record_count(whole range)  -> ceil(records / max_records) even chunks
+    metadata.get_record_count(each chunk)   -> chunks still too large are split again (uneven activity)
+
+The chunks are fetched concurrently through get_range_cached, each one to its own .dbn.zst file, next to a
+{start}_{end}.plan.json file holding the chunk boundaries. A failed run leaves the finished chunk files behind,
+so calling again with the same request reuses the plan and only fetches the chunks that are missing.
+Requests that fit in one chunk go straight to get_range_cached as before.
+Symbols are first resolved through the local symbology cache (symbology.resolve_instrument_ids) and those without an
+instrument_id over the range are dropped, so delisted or mistyped tickers are never estimated, planned or paid for.
+
+Limits come from arguments or environment variables:
+    databento_max_records (default 10,000,000 records per chunk), databento_max_cost (dollars, default no limit),
+    databento_max_concurrency (default 4 concurrent chunks), databento_plan_root (chunk files when
+    databento_dbn_cache is unset, default databento/plans; removed once the request completes)
+'''
+
+logger = logging.getLogger(__name__)
+
+MAX_RECORDS_PER_CHUNK = 10_000_000
+PLAN_ROOT = 'databento/plans'
+
+def _day(ts):
+    # Requests are made in whole days, like get_range_cached
+    return pd.Timestamp(pd.Timestamp(ts).strftime('%Y-%m-%d'))
+
+def estimate(symbols, start_date, end_date, schema='ohlcv-1d', dataset=DATABENTO_DATASET, client=None):
+    """
+    Asks Data Bento how large and how expensive a request is, without fetching it.
+    Returns:
+        tuple: (record count, cost in US dollars).
+    """
+    client = client or get_client()
+    request = dict(dataset=dataset, symbols=symbols, schema=schema,
+                   start=start_date.strftime('%Y-%m-%d'), end=end_date.strftime('%Y-%m-%d'))
+    with span('plan', schema=schema, start=request['start'], end=request['end']) as s:
+        records = client.metadata.get_record_count(**request)
+        cost = client.metadata.get_cost(**request)
+        s.add(requests=2)
+    return int(records), float(cost)
+
+def plan_chunks(symbols, start_date, end_date, schema='ohlcv-1d', dataset=DATABENTO_DATASET, client=None,
+                max_records=MAX_RECORDS_PER_CHUNK, records=None):
+    """
+    Splits [start_date, end_date) into day-aligned chunks of at most max_records records.
+    A single day larger than max_records stays one chunk.
+    Args:
+        symbols (str or list): Ticker symbol(s).
+        start_date (datetime): The start date of the request.
+        end_date (datetime): The end date of the request (exclusive).
+        schema (str): Data Bento schema. Defaults to 'ohlcv-1d'.
+        dataset (str): Data Bento dataset. Defaults to 'XNAS.ITCH'.
+        client (optional): Client to use instead of the shared one.
+        max_records (int): Records per chunk. Defaults to 10,000,000.
+        records (int, optional): Record count of the whole range if already known.
+    Returns:
+        list: (start, end, records) per chunk, in time order.
+    """
+    client = client or get_client()
+    start_date, end_date = _day(start_date), _day(end_date)
+
+    def count(start, end):
+        with span('plan', schema=schema, start=str(start.date()), end=str(end.date())) as s:
+            s.add(requests=1)
+            return int(client.metadata.get_record_count(dataset=dataset, symbols=symbols, schema=schema,
+                                                        start=start.strftime('%Y-%m-%d'), end=end.strftime('%Y-%m-%d')))
+
+    def split(start, end, records):
+        days = (end - start).days
+        if records <= max_records or days <= 1:
+            return [(start, end, records)]
+        # Even split by time first, then each piece is checked on its own since activity is not uniform
+        pieces = min(math.ceil(records / max_records), days)
+        bounds = [start + pd.Timedelta(days=round(days * i / pieces)) for i in range(pieces + 1)]
+        chunks = []
+        for piece_start, piece_end in zip(bounds[:-1], bounds[1:]):
+            chunks += split(piece_start, piece_end, count(piece_start, piece_end))
+        return chunks
+
+    return split(start_date, end_date, count(start_date, end_date) if records is None else records)
+
+def plan_path(symbols, start_date, end_date, schema='ohlcv-1d', dataset=DATABENTO_DATASET, root=PLAN_ROOT):
+    """
+    Returns where the plan of a request is kept, next to its chunk files.
+    """
+    path = dbn_cache_path(symbols, start_date, end_date, schema, dataset, root)
+    return path.with_name(path.name.replace('.dbn.zst', '.plan.json'))
+
+def _save_plan(path, plan):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(plan, f, indent=1)
+    os.replace(tmp_path, path)
+
+def listed_symbols(symbols, start_date, end_date, dataset=DATABENTO_DATASET, client=None):
+    """
+    Drops the symbols without a Data Bento instrument_id in [start_date, end_date). Only tickers whose range was never
+    resolved cost a symbology request; the symbols are kept as they are when the symbology API cannot be reached.
+    Returns:
+        str or list: The listed symbols, a single ticker stays a string. An empty list when none is listed.
+    """
+    tickers = [symbols] if isinstance(symbols, str) else list(symbols)
+    try:
+        resolved = resolve_instrument_ids(tickers, start_date, end_date, dataset, client)
+    except Exception as e:
+        logger.warning(f'Symbology resolve failed, requesting all {len(tickers)} symbol(s): {e}')
+        return symbols
+    listed = [ticker for ticker in tickers if resolved.get(ticker)]
+    if len(listed) < len(tickers):
+        logger.info(f'{len(tickers) - len(listed)} of {len(tickers)} symbol(s) have no instrument_id from '
+                    f'{start_date.date()} to {end_date.date()}, not requested')
+    if isinstance(symbols, str):
+        return symbols if listed else []
+    return listed
+
+def get_range_planned(symbols, start_date, end_date, schema='ohlcv-1d', dataset=DATABENTO_DATASET, client=None,
+                      cache_root=None, max_records=None, max_cost=None, max_workers=None, refresh=False):
+    """
+    Fetches a range of any size as size-bounded chunks, concurrently and resumably (see the module docstring).
+    Args:
+        symbols (str or list): Ticker symbol(s).
+        start_date (datetime): The start date of the data to retrieve.
+        end_date (datetime): The end date of the data to retrieve (exclusive).
+        schema (str): Data Bento schema. Defaults to 'ohlcv-1d'.
+        dataset (str): Data Bento dataset. Defaults to 'XNAS.ITCH'.
+        client (optional): Client to use instead of the shared one.
+        cache_root (str, optional): Keep the chunk responses here. Defaults to the databento_dbn_cache environment variable.
+        max_records (int, optional): Records per chunk. Defaults to databento_max_records or 10,000,000.
+        max_cost (float, optional): Refuse requests estimated above this many dollars. Defaults to databento_max_cost.
+        max_workers (int, optional): Chunks fetched at once. Defaults to databento_max_concurrency or 4.
+        refresh (bool): Plan and fetch again even if the request is already in the cache (see get_range_cached).
+    Returns:
+        iterable: One db.DBNStore per chunk, in time order, empty when no symbol is listed over the range. Without a DBN cache it is a generator reading the chunk
+            files one at a time from disk and removing each once the next one is asked for, so a consumer decoding
+            the stores in turn holds one chunk at most.
+    Raises:
+        ValueError: The estimated cost is above max_cost.
+    """
+    client = client or get_client()
+    start_date, end_date = _day(start_date), _day(end_date)
+    max_records = max_records or int(os.getenv('databento_max_records', MAX_RECORDS_PER_CHUNK))
+    max_cost = max_cost if max_cost is not None else os.getenv('databento_max_cost')
+    max_workers = max_workers or int(os.getenv('databento_max_concurrency', 4))
+    cache_root = cache_root or os.getenv('databento_dbn_cache')
+    root = cache_root or os.getenv('databento_plan_root', PLAN_ROOT)
+    symbols = listed_symbols(symbols, start_date, end_date, dataset, client)
+    if not symbols:
+        return []
+
+    if cache_root and not refresh and dbn_cache_path(symbols, start_date, end_date, schema, dataset, cache_root).exists():
+        # Fetched earlier as a single request, replayed without asking for an estimate
+        return [get_range_cached(symbols, start_date, end_date, schema, dataset, client, cache_root)]
+
+    path = plan_path(symbols, start_date, end_date, schema, dataset, root)
+    if path.exists() and not refresh:
+        with open(path) as f:
+            plan = json.load(f)
+        logger.debug(f'Using the {len(plan["chunks"])} chunk plan in {path}')
+    else:
+        records, cost = estimate(symbols, start_date, end_date, schema, dataset, client)
+        if max_cost is not None and cost > float(max_cost):
+            raise ValueError(f'Request for {schema} from {start_date.date()} to {end_date.date()} is estimated at '
+                             f'${cost:,.2f} ({records:,} records), above the limit of ${float(max_cost):,.2f}')
+        if records <= max_records:
+            # Fits in one request, nothing to plan or resume
+            return [get_range_cached(symbols, start_date, end_date, schema, dataset, client, cache_root, refresh)]
+        chunks = plan_chunks(symbols, start_date, end_date, schema, dataset, client, max_records, records)
+        if cache_root and refresh:
+            # A single response cached earlier would otherwise be replayed instead of the new chunks
+            dbn_cache_path(symbols, start_date, end_date, schema, dataset, cache_root).unlink(missing_ok=True)
+        plan = {'records': records, 'cost': cost, 'max_records': max_records,
+                'chunks': [{'start': str(start.date()), 'end': str(end.date()), 'records': n} for start, end, n in chunks]}
+        _save_plan(path, plan)
+        logger.info(f'{schema} from {start_date.date()} to {end_date.date()}: {records:,} records, ${cost:,.2f}, '
+                    f'{len(chunks)} chunks of at most {max_records:,} records')
+
+    chunks = [(pd.Timestamp(chunk['start']), pd.Timestamp(chunk['end'])) for chunk in plan['chunks']]
+    done = 0 if refresh else sum(dbn_cache_path(symbols, start, end, schema, dataset, root).exists() for start, end in chunks)
+    if done:
+        logger.info(f'{path.name}: {done} of {len(chunks)} chunks already fetched')
+
+    def fetch(chunk):
+        # Chunk files are what makes the request resumable, so they are always written to disk
+        return get_range_cached(symbols, chunk[0], chunk[1], schema, dataset, client, root, refresh)
+
+    with span('vendor_fetch_planned', schema=schema, chunks=len(chunks)) as s, \
+            ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(fetch, chunk) for chunk in chunks]
+        errors = [future.exception() for future in futures]
+        s.add(files=len(chunks) - done)
+    failed = [error for error in errors if error is not None]
+    if failed:
+        logger.error(f'{len(failed)} of {len(chunks)} chunks failed, call again with the same request to resume')
+        raise failed[0]
+    if not cache_root:
+        # Without a DBN cache the chunk files only serve resuming, they are read one at a time and then dropped
+        files = [dbn_cache_path(symbols, start, end, schema, dataset, root) for start, end in chunks]
+        return _iter_chunk_stores(files, path)
+    return [future.result() for future in futures]
+
+def _iter_chunk_stores(files, plan_file):
+    # Opens one chunk file at a time and removes it once the caller moves on to the next one, the plan after the
+    # last; a caller stopping early leaves the remaining files for a resumed run
+    for f in files:
+        yield db.DBNStore.from_file(f)
+        f.unlink()
+    plan_file.unlink()
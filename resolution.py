@@ -0,0 +1,175 @@
+import pandas as pd
+import numpy as np
+import os
+from lean_writer import LEAN_TIMEZONE, PRICE_COLUMNS, NS_PER_DAY, NS_PER_MINUTE, to_exchange_ns
+from instrumentation import span
+
+'''
+Resolution engine: which Data Bento schema a LEAN resolution is built from, and local aggregation of finer bars.
+
+    LEAN resolution   Data Bento schema
+    minute            ohlcv-1m
+    hourly            ohlcv-1h
+    daily             ohlcv-1d
+
+By default every resolution is fetched with its own schema. With a finer source resolution (source='minute', or the
+lean_source_resolution environment variable) coarser resolutions are aggregated locally from the stored finer bars,
+so minute, hourly and daily LEAN data come from one minute download instead of three paid requests.
+
+Aggregation is session-aware. With session='rth' (default, or the lean_session environment variable) only bars
+opening in regular trading hours (09:30 to 16:00 New York time) are used; session='all' keeps extended hours.
+Aggregated bars follow Data Bento's conventions, so they are written exactly like fetched ones:
+    hourly - labelled with the start of the clock hour, e.g. the 09:30-10:00 bars form the 09:00 bar
+    daily  - labelled 00:00 UTC of the exchange date, like ohlcv-1d
+'''
+
+RESOLUTION_SCHEMAS = {'minute': 'ohlcv-1m', 'hourly': 'ohlcv-1h', 'daily': 'ohlcv-1d'}
+RESOLUTION_NS = {'minute': NS_PER_MINUTE, 'hourly': 60 * NS_PER_MINUTE, 'daily': NS_PER_DAY}
+# Session bounds as minutes after midnight, exchange time
+SESSIONS = {'rth': (9 * 60 + 30, 16 * 60), 'all': (0, 24 * 60)}
+BAR_FIELDS = PRICE_COLUMNS + ['volume']
+
+def schema_for(resolution):
+    """
+    Returns the Data Bento schema of a LEAN resolution ('minute', 'hourly' or 'daily').
+    """
+    if resolution not in RESOLUTION_SCHEMAS:
+        raise ValueError(f"Unknown resolution {resolution!r}, expected one of {list(RESOLUTION_SCHEMAS)}")
+    return RESOLUTION_SCHEMAS[resolution]
+
+def session_bounds(start_date, end_date, schema):
+    """
+    Returns the UTC ts_event bounds [start, end) of the trading dates start_date through end_date (inclusive).
+    Daily bars are stamped 00:00 UTC of their exchange date, so ohlcv-1d days are UTC days; finer bars belong to the
+    exchange-time day they fall in, so the last day's evening and extended-hours bars are kept.
+    Returns:
+        tuple: (start, end) tz-aware UTC pd.Timestamps, end exclusive.
+    """
+    timezone = 'UTC' if schema == 'ohlcv-1d' else LEAN_TIMEZONE
+    start = pd.Timestamp(pd.Timestamp(start_date).date())
+    end = pd.Timestamp(pd.Timestamp(end_date).date()) + pd.Timedelta(days=1)
+    return start.tz_localize(timezone).tz_convert('UTC'), end.tz_localize(timezone).tz_convert('UTC')
+
+def source_resolution(frequency, source=None):
+    """
+    Returns the resolution the frequency is built from: source, the lean_source_resolution environment variable,
+    or the frequency itself. A source coarser than the frequency is not used (daily bars cannot make minute bars).
+    """
+    schema_for(frequency)
+    source = source or os.getenv('lean_source_resolution') or frequency
+    schema_for(source)
+    return source if RESOLUTION_NS[source] <= RESOLUTION_NS[frequency] else frequency
+
+def source_schema(frequency, source=None):
+    """
+    Returns the Data Bento schema to fetch and store for the frequency, see source_resolution.
+    """
+    return schema_for(source_resolution(frequency, source))
+
+def get_session(session=None):
+    """
+    Returns the aggregation session, 'rth' or 'all'. Defaults to the lean_session environment variable or 'rth'.
+    """
+    session = session or os.getenv('lean_session', 'rth')
+    if session not in SESSIONS:
+        raise ValueError(f"Unknown session {session!r}, expected one of {list(SESSIONS)}")
+    return session
+
+def _labels(utc_ns, local_ns, frequency):
+    # Hourly labels are whole UTC hours (New York's offsets are whole hours), daily labels the exchange date at 00:00 UTC
+    if frequency == 'daily':
+        return local_ns // NS_PER_DAY * NS_PER_DAY
+    step = RESOLUTION_NS[frequency]
+    return utc_ns // step * step
+
+def resample_bars(df, frequency, session=None, timezone=LEAN_TIMEZONE, datetime_column='ts_event'):
+    """
+    Aggregates time-ordered bars to a coarser resolution with NumPy reductions, no per-group Python work.
+    Args:
+        df (pd.DataFrame): Bars sorted by datetime_column (a column or the index), one row per timestamp.
+        frequency (str): Target resolution, 'hourly' or 'daily'.
+        session (str, optional): 'rth' or 'all'. Defaults to the lean_session environment variable or 'rth'.
+        timezone (str): Exchange time zone. Defaults to New York.
+        datetime_column (str): The name of the bar timestamp column. Defaults to 'ts_event'.
+    Returns:
+        pd.DataFrame: ts_event (UTC), open, high, low, close and volume per aggregated bar.
+    """
+    if df.index.name == datetime_column:
+        df = df.reset_index()
+    utc_ns = pd.DatetimeIndex(pd.to_datetime(df[datetime_column], utc=True)).as_unit('ns').asi8
+    local_ns = to_exchange_ns(df[datetime_column], timezone)
+    first, last = SESSIONS[get_session(session)]
+    minute_of_day = (local_ns % NS_PER_DAY) // NS_PER_MINUTE
+    keep = (minute_of_day >= first) & (minute_of_day < last)
+
+    labels = _labels(utc_ns[keep], local_ns[keep], frequency)
+    columns = {col: df[col].to_numpy()[keep] for col in BAR_FIELDS}
+    if len(labels) == 0:
+        return pd.DataFrame({datetime_column: pd.DatetimeIndex([], tz='UTC'), **{col: values[:0] for col, values in columns.items()}})
+
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(labels)) + 1))
+    ends = np.concatenate((starts[1:], [len(labels)])) - 1
+    return pd.DataFrame({
+        datetime_column: pd.to_datetime(labels[starts], utc=True),
+        'open': columns['open'][starts],
+        'high': np.maximum.reduceat(columns['high'], starts),
+        'low': np.minimum.reduceat(columns['low'], starts),
+        'close': columns['close'][ends],
+        'volume': np.add.reduceat(columns['volume'], starts),
+    })
+
+def iter_resampled(frames, frequency, session=None, timezone=LEAN_TIMEZONE, datetime_column='ts_event'):
+    """
+    Streams resample_bars over an iterable of time-ordered chunks (e.g. raw_store.iter_raw_years).
+    The last exchange date of each chunk is held back until the next chunk, so no bar is split over chunks.
+    Yields:
+        pd.DataFrame: Aggregated bars, in time order.
+    """
+    if isinstance(frames, pd.DataFrame):
+        frames = [frames]
+    pending = None
+    for chunk in frames:
+        if chunk.index.name == datetime_column:
+            chunk = chunk.reset_index()
+        if chunk.empty:
+            continue
+        if pending is not None:
+            chunk = pd.concat([pending, chunk], ignore_index=True)
+        days = to_exchange_ns(chunk[datetime_column], timezone) // NS_PER_DAY
+        split = int(np.searchsorted(days, days[-1]))
+        pending = chunk.iloc[split:]
+        if split:
+            with span('resample', frequency=frequency) as s:
+                bars = resample_bars(chunk.iloc[:split], frequency, session, timezone, datetime_column)
+                s.add(rows=split)
+            yield bars
+    if pending is not None:
+        with span('resample', frequency=frequency) as s:
+            bars = resample_bars(pending, frequency, session, timezone, datetime_column)
+            s.add(rows=len(pending))
+        yield bars
+
+def resample_polars(data, frequency, session=None, timezone=LEAN_TIMEZONE, datetime_column='ts_event'):
+    """
+    Polars version of resample_bars, producing the same bars from a lazy plan.
+    Args:
+        data: Bars in any form accepted by lean_writer.to_polars, e.g. raw_store.scan_raw(...).
+    Returns:
+        pl.LazyFrame: ts_event (UTC), open, high, low, close and volume per aggregated bar.
+    """
+    import polars as pl
+    from lean_writer import to_polars
+    first, last = SESSIONS[get_session(session)]
+    ts = pl.col(datetime_column)
+    local = ts.dt.convert_time_zone(timezone)
+    minute_of_day = local.dt.hour().cast(pl.Int32) * 60 + local.dt.minute().cast(pl.Int32)
+    if frequency == 'daily':
+        label = local.dt.date().cast(pl.Datetime('ns')).dt.replace_time_zone('UTC')
+    else:
+        label = ts.dt.truncate(f'{RESOLUTION_NS[frequency] // NS_PER_MINUTE}m')
+    return (to_polars(data, datetime_column)
+            .filter((minute_of_day >= first) & (minute_of_day < last))
+            .group_by(label.alias(datetime_column), maintain_order=True)
+            .agg(pl.col('open').first(), pl.col('high').max(), pl.col('low').min(), pl.col('close').last(),
+                 pl.col('volume').sum())
+            .sort(datetime_column))
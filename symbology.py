@@ -0,0 +1,342 @@
+from bisect import bisect_right
+from datetime import date, datetime, timedelta
+from pathlib import Path
+import pandas as pd
+import threading
+import sqlite3
+import os
+
+'''
+Local, date-effective symbology cache: ticker -> vendor identifier (Data Bento instrument_id, CRSP permno,
+Compustat gvkey) for the dates the mapping was valid.
+
+Mappings live in SQLite (symbology_cache environment variable, default databento/symbology.sqlite):
+    mappings(vendor, id_type, ticker, start_date, end_date, symbol_id)   - end_date exclusive, ISO dates
+    resolved(vendor, id_type, ticker, start_date, end_date)              - ranges already asked for, found or not
+Lookups go through an in-memory index (sorted start dates per ticker, bisect), loaded once per vendor and id type.
+resolve() only calls the vendor for tickers whose requested range has not been resolved before, so a refresh
+is incremental and repeated runs never go back to WRDS or Data Bento for known tickers.
+
+Vendors: 'databento:{dataset}' (instrument_id), 'wrds' (permno, gvkey). Loaders:
+    databento_loader(dataset, client)  - timeseries symbology.resolve, up to 2,000 symbols per request
+    wrds_permno_loader(db_engine)      - crsp.stocknames
+    wrds_gvkey_loader(db_engine)       - crsp.stocknames linked through crsp.ccmxpf_lnkhist
+The Data Bento fetch path (request_planner.get_range_planned) resolves every request's tickers through the cache first,
+so it is opened by default there. DBN responses already carry their symbol mappings; record_dbn_mappings adds them for
+free after each fetch once the cache is in use (symbology_cache set, or the cache already opened by a resolve).
+'''
+
+SYMBOLOGY_CACHE = os.getenv('symbology_cache', 'databento/symbology.sqlite')
+# Open-ended mappings (still valid) end on this date
+OPEN_END = '9999-12-31'
+MAX_SYMBOLS_PER_RESOLVE = 2000
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS mappings (
+    vendor TEXT NOT NULL, id_type TEXT NOT NULL, ticker TEXT NOT NULL,
+    start_date TEXT NOT NULL, end_date TEXT NOT NULL, symbol_id TEXT NOT NULL,
+    PRIMARY KEY (vendor, id_type, ticker, start_date, symbol_id)
+);
+CREATE TABLE IF NOT EXISTS resolved (
+    vendor TEXT NOT NULL, id_type TEXT NOT NULL, ticker TEXT NOT NULL,
+    start_date TEXT NOT NULL, end_date TEXT NOT NULL,
+    PRIMARY KEY (vendor, id_type, ticker, start_date, end_date)
+);
+'''
+
+def to_iso(value):
+    """
+    Returns a date as 'YYYY-MM-DD'. ISO strings are passed through untouched, so lookups stay cheap.
+    """
+    if isinstance(value, str) and len(value) == 10:
+        return value
+    if isinstance(value, (date, datetime)):
+        return value.strftime('%Y-%m-%d')
+    return pd.Timestamp(value).strftime('%Y-%m-%d')
+
+def _next_day(value):
+    # Inclusive vendor end dates become exclusive ends
+    if value is None or pd.isna(value):
+        return OPEN_END
+    day = date.fromisoformat(to_iso(value))
+    return OPEN_END if day >= date.fromisoformat(OPEN_END) - timedelta(days=1) else (day + timedelta(days=1)).isoformat()
+
+def _merge(intervals):
+    # Overlapping or touching [start, end) intervals are combined
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+class SymbologyCache:
+    """
+    Date-effective ticker mappings per vendor and id type, see the module docstring.
+    Safe to share between threads; each process opens its own SQLite connection.
+    """
+    def __init__(self, path=SYMBOLOGY_CACHE):
+        self.path = str(path)
+        self._lock = threading.RLock()
+        self._conn = None
+        self._pid = None
+        # (vendor, id_type) -> {ticker: (starts, ends, symbol_ids)} sorted by start
+        self._index = {}
+        # (vendor, id_type) -> {ticker: merged resolved intervals}
+        self._resolved = {}
+
+    def _connection(self):
+        if self._conn is None or self._pid != os.getpid():
+            if self.path != ':memory:':
+                Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._conn.executescript(_SCHEMA)
+            self._pid = os.getpid()
+            self._index.clear()
+            self._resolved.clear()
+        return self._conn
+
+    def _load(self, vendor, id_type):
+        key = (vendor, id_type)
+        index = self._index.get(key)
+        if index is not None:
+            return index
+        with self._lock:
+            rows = self._connection().execute(
+                'SELECT ticker, start_date, end_date, symbol_id FROM mappings WHERE vendor = ? AND id_type = ? '
+                'ORDER BY ticker, start_date', key).fetchall()
+            index = {}
+            for ticker, start, end, symbol_id in rows:
+                starts, ends, ids = index.setdefault(ticker, ([], [], []))
+                starts.append(start)
+                ends.append(end)
+                ids.append(symbol_id)
+            resolved = {}
+            for ticker, start, end in self._connection().execute(
+                    'SELECT ticker, start_date, end_date FROM resolved WHERE vendor = ? AND id_type = ?', key):
+                resolved.setdefault(ticker, []).append((start, end))
+            self._resolved[key] = {ticker: _merge(intervals) for ticker, intervals in resolved.items()}
+            self._index[key] = index
+        return index
+
+    def add(self, vendor, id_type, mappings):
+        """
+        Stores mappings, replacing identical ones.
+        Args:
+            vendor (str): e.g. 'wrds' or 'databento:XNAS.ITCH'.
+            id_type (str): e.g. 'permno', 'gvkey' or 'instrument_id'.
+            mappings (iterable): (ticker, start_date, end_date (exclusive), symbol_id) tuples.
+        """
+        rows = [(vendor, id_type, ticker, to_iso(start), to_iso(end), str(symbol_id))
+                for ticker, start, end, symbol_id in mappings]
+        if not rows:
+            return
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.executemany('INSERT OR REPLACE INTO mappings VALUES (?, ?, ?, ?, ?, ?)', rows)
+            # Rebuilt on the next lookup
+            self._index.pop((vendor, id_type), None)
+
+    def mark_resolved(self, vendor, id_type, tickers, start_date, end_date):
+        """
+        Records that the tickers were resolved over [start_date, end_date), whether or not a mapping was found.
+        """
+        start, end = to_iso(start_date), to_iso(end_date)
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.executemany('INSERT OR REPLACE INTO resolved VALUES (?, ?, ?, ?, ?)',
+                                 [(vendor, id_type, ticker, start, end) for ticker in tickers])
+            self._index.pop((vendor, id_type), None)
+
+    def missing(self, vendor, id_type, tickers, start_date, end_date):
+        """
+        Returns the tickers whose [start_date, end_date) range has not been resolved yet.
+        """
+        start, end = to_iso(start_date), to_iso(end_date)
+        self._load(vendor, id_type)
+        resolved = self._resolved.get((vendor, id_type), {})
+        return [ticker for ticker in tickers
+                if not any(low <= start and end <= high for low, high in resolved.get(ticker, ()))]
+
+    def lookup(self, vendor, id_type, ticker, on_date):
+        """
+        Returns the ticker's identifier on a date, or None when there is no mapping in the cache.
+        """
+        entry = self._load(vendor, id_type).get(ticker)
+        if entry is None:
+            return None
+        starts, ends, ids = entry
+        on_date = to_iso(on_date)
+        i = bisect_right(starts, on_date) - 1
+        # The latest mapping starting on or before the date, if it is still valid then
+        if i >= 0 and on_date < ends[i]:
+            return ids[i]
+        return None
+
+    def lookup_many(self, vendor, id_type, tickers, on_date):
+        """
+        Returns {ticker: identifier} for the tickers mapped on the date.
+        """
+        on_date = to_iso(on_date)
+        found = {}
+        for ticker in tickers:
+            symbol_id = self.lookup(vendor, id_type, ticker, on_date)
+            if symbol_id is not None:
+                found[ticker] = symbol_id
+        return found
+
+    def intervals(self, vendor, id_type, ticker, start_date=None, end_date=None):
+        """
+        Returns the ticker's (start_date, end_date, symbol_id) mappings overlapping [start_date, end_date).
+        """
+        entry = self._load(vendor, id_type).get(ticker)
+        if entry is None:
+            return []
+        start = to_iso(start_date) if start_date is not None else ''
+        end = to_iso(end_date) if end_date is not None else OPEN_END
+        return [(s, e, symbol_id) for s, e, symbol_id in zip(*entry) if s < end and e > start]
+
+    def resolve(self, vendor, id_type, tickers, start_date, end_date, loader, refresh=False):
+        """
+        Makes sure the tickers are resolved over [start_date, end_date), calling loader only for those that are not.
+        Args:
+            vendor (str): Vendor key, see add.
+            id_type (str): Identifier type, see add.
+            tickers (list): Ticker symbols.
+            start_date (datetime-like): First date.
+            end_date (datetime-like): End date, exclusive.
+            loader (callable): loader(tickers, start_date, end_date) -> iterable of (ticker, start, end, symbol_id).
+            refresh (bool): Resolve every ticker again. Defaults to False.
+        Returns:
+            dict: ticker -> list of (start_date, end_date, symbol_id) overlapping the range.
+        """
+        tickers = list(dict.fromkeys(tickers))
+        todo = tickers if refresh else self.missing(vendor, id_type, tickers, start_date, end_date)
+        if todo:
+            self.add(vendor, id_type, loader(todo, start_date, end_date))
+            self.mark_resolved(vendor, id_type, todo, start_date, end_date)
+        return {ticker: self.intervals(vendor, id_type, ticker, start_date, end_date) for ticker in tickers}
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None and self._pid == os.getpid():
+                self._conn.close()
+            self._conn = None
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_cache():
+    """
+    Returns the process-wide cache at SYMBOLOGY_CACHE, creating it on first use.
+    """
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = SymbologyCache()
+    return _cache
+
+def set_cache(cache):
+    """
+    Replaces the shared cache, e.g. with SymbologyCache(':memory:'). None resets to lazy creation.
+    """
+    global _cache
+    _cache = cache
+
+def databento_vendor(dataset):
+    return f'databento:{dataset}'
+
+def databento_loader(dataset='XNAS.ITCH', client=None):
+    """
+    Returns a loader resolving raw symbols to instrument_ids with the Data Bento symbology API.
+    """
+    def load(tickers, start_date, end_date):
+        from databento_fetch import get_client
+        api = (client or get_client()).symbology
+        for i in range(0, len(tickers), MAX_SYMBOLS_PER_RESOLVE):
+            response = api.resolve(dataset=dataset, symbols=tickers[i:i + MAX_SYMBOLS_PER_RESOLVE],
+                                   stype_in='raw_symbol', stype_out='instrument_id',
+                                   start_date=to_iso(start_date), end_date=to_iso(end_date))
+            for ticker, intervals in response.get('result', {}).items():
+                for interval in intervals:
+                    yield ticker, interval['d0'], interval['d1'], interval['s']
+    return load
+
+def wrds_permno_loader(db_engine=None):
+    """
+    Returns a loader mapping tickers to CRSP permnos from crsp.stocknames.
+    """
+    def load(tickers, start_date, end_date):
+        from sqlalchemy import text
+        from wrds_crsp import get_wrds_engine
+        query = text('SELECT ticker, namedt, nameenddt, permno FROM crsp.stocknames '
+                     'WHERE ticker = ANY(:tickers) AND namedt < :end AND nameenddt >= :start')
+        with (db_engine or get_wrds_engine()).connect() as conn:
+            rows = conn.execute(query, {'tickers': list(tickers), 'start': to_iso(start_date), 'end': to_iso(end_date)})
+            return [(ticker, start, _next_day(end), int(permno)) for ticker, start, end, permno in rows]
+    return load
+
+def wrds_gvkey_loader(db_engine=None):
+    """
+    Returns a loader mapping tickers to Compustat gvkeys through the CRSP/Compustat link history
+    (primary links only), limited to the dates both the ticker and the link were valid.
+    """
+    def load(tickers, start_date, end_date):
+        from sqlalchemy import text
+        from wrds_crsp import get_wrds_engine
+        query = text('''
+            SELECT n.ticker, GREATEST(n.namedt, l.linkdt) AS start_date,
+                   LEAST(n.nameenddt, COALESCE(l.linkenddt, DATE '9999-12-31')) AS end_date, l.gvkey
+            FROM crsp.stocknames AS n
+            JOIN crsp.ccmxpf_lnkhist AS l
+              ON l.lpermno = n.permno AND l.linktype IN ('LU', 'LC') AND l.linkprim IN ('P', 'C')
+             AND l.linkdt <= n.nameenddt AND COALESCE(l.linkenddt, DATE '9999-12-31') >= n.namedt
+            WHERE n.ticker = ANY(:tickers) AND n.namedt < :end AND n.nameenddt >= :start
+        ''')
+        with (db_engine or get_wrds_engine()).connect() as conn:
+            rows = conn.execute(query, {'tickers': list(tickers), 'start': to_iso(start_date), 'end': to_iso(end_date)})
+            return [(ticker, start, _next_day(end), gvkey) for ticker, start, end, gvkey in rows]
+    return load
+
+def record_dbn_mappings(store, cache=None):
+    """
+    Adds the symbol mappings carried in a DBN response's metadata to the cache and marks its symbols resolved
+    over the request's date range. Without a cache argument nothing is written unless the symbology_cache environment
+    variable is set or the shared cache was already opened.
+    """
+    if cache is None and _cache is None and not os.getenv('symbology_cache'):
+        return
+    symbology = store.symbology
+    if symbology.get('stype_in') != 'raw_symbol' or symbology.get('stype_out') != 'instrument_id':
+        return
+    cache = cache or get_cache()
+    vendor = databento_vendor(store.dataset)
+    cache.add(vendor, 'instrument_id', [(ticker, interval['start_date'], interval['end_date'], interval['symbol'])
+                                        for ticker, intervals in symbology['mappings'].items()
+                                        for interval in intervals])
+    cache.mark_resolved(vendor, 'instrument_id', symbology['symbols'], symbology['start_date'], symbology['end_date'])
+
+def resolve_instrument_ids(tickers, start_date, end_date, dataset='XNAS.ITCH', client=None, cache=None, refresh=False):
+    """
+    Data Bento instrument_ids for the tickers over [start_date, end_date), from the cache when already resolved.
+    """
+    return (cache or get_cache()).resolve(databento_vendor(dataset), 'instrument_id', tickers, start_date, end_date,
+                                          databento_loader(dataset, client), refresh)
+
+def resolve_permnos(tickers, start_date, end_date, db_engine=None, cache=None, refresh=False):
+    """
+    CRSP permnos for the tickers over [start_date, end_date), from the cache when already resolved.
+    """
+    return (cache or get_cache()).resolve('wrds', 'permno', tickers, start_date, end_date,
+                                          wrds_permno_loader(db_engine), refresh)
+
+def resolve_gvkeys(tickers, start_date, end_date, db_engine=None, cache=None, refresh=False):
+    """
+    Compustat gvkeys for the tickers over [start_date, end_date), from the cache when already resolved.
+    """
+    return (cache or get_cache()).resolve('wrds', 'gvkey', tickers, start_date, end_date,
+                                          wrds_gvkey_loader(db_engine), refresh)
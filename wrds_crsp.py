@@ -0,0 +1,258 @@
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import pandas as pd
+import numpy as np
+import pyarrow as pa
+import logging
+import time
+import os
+from sqlalchemy import create_engine, text
+from datetime import date
+from raw_store import RAW_STORE_ROOT, write_raw, iter_raw_years, scan_raw
+from lean_writer import LEAN_EQUITY_ROOT, write_lean_bars, write_lean_bars_polars, get_engine
+from symbology import resolve_permnos
+from instrumentation import span, record, configure, get_metrics, merge_metrics, reset_metrics
+
+'''
+Bulk CRSP daily extraction from WRDS into LEAN daily files.
+Instead of one query per ticker, every requested symbol (or the whole universe) is pulled with one bounded
+query per date chunk. Each query runs on a server-side cursor and rows arrive in fixed-size batches that are
+turned into Arrow tables, so memory stays at one batch whatever the universe size:
+
+    crsp.dsf JOIN ticker -> permno names (valid on the date) -> batches ordered by ticker, date
+        -> split per symbol into the raw store, databento/raw/{ticker}/crsp-dsf/{year}/*.parquet
+        -> one LEAN daily zip per ticker, data/equity/usa/daily/{ticker}.zip
+
+Requested tickers are mapped to permnos through the local symbology cache (symbology.resolve_permnos), so
+crsp.stocknames is only queried for tickers whose date range was never resolved and the mappings are sent with the
+query; a whole-universe export joins crsp.stocknames on the server.
+
+Prices are CRSP's raw (unadjusted) prices; a negative prc (bid/ask average, no trade) is taken as its absolute value
+and a missing open/high/low falls back to the close.
+
+The connection comes from the wrds_url environment variable (any SQLAlchemy PostgreSQL URL), or is built for
+WRDS' PostgreSQL server from wrds_username and wrds_password (or ~/.pgpass, as set up by the wrds package).
+'''
+
+logger = logging.getLogger(__name__)
+
+WRDS_HOST = 'wrds-pgdata.wharton.upenn.edu:9737'
+CRSP_SCHEMA = 'crsp-dsf'
+BATCH_ROWS = 100_000
+CHUNK_YEARS = 1
+
+CRSP_DAILY_QUERY = '''
+    SELECT n.ticker, d.permno, d.date,
+           COALESCE(ABS(d.openprc), ABS(d.prc))::float8 AS open,
+           COALESCE(ABS(d.askhi), ABS(d.prc))::float8 AS high,
+           COALESCE(ABS(d.bidlo), ABS(d.prc))::float8 AS low,
+           ABS(d.prc)::float8 AS close,
+           COALESCE(d.vol, 0)::bigint AS volume
+    FROM crsp.dsf AS d
+    JOIN {names}
+      ON n.permno = d.permno AND d.date >= n.namedt AND d.date < n.nameenddt
+    WHERE d.date >= :start AND d.date < :end AND d.prc IS NOT NULL AND n.ticker IS NOT NULL
+    {filters}
+    ORDER BY n.ticker, d.date
+'''
+
+def get_wrds_engine(url=None):
+    """
+    Creates a SQLAlchemy engine for WRDS, see the module docstring for the environment variables.
+    """
+    url = url or os.getenv('wrds_url')
+    if url is None:
+        username = os.getenv('wrds_username')
+        password = os.getenv('wrds_password')
+        credentials = f'{username}:{password}' if password else username
+        url = f'postgresql://{credentials}@{WRDS_HOST}/wrds?sslmode=require'
+    return create_engine(url, pool_size=1, max_overflow=0)
+
+def date_chunks(start_date, end_date, years=CHUNK_YEARS):
+    """
+    Splits [start_date, end_date] into calendar-year aligned [start, end) chunks of the given number of years.
+    Returns:
+        list: (start, end) pd.Timestamp pairs.
+    """
+    start = pd.Timestamp(start_date).normalize()
+    stop = pd.Timestamp(end_date).normalize() + pd.Timedelta(days=1)
+    chunks = []
+    while start < stop:
+        end = min(pd.Timestamp(year=start.year + years, month=1, day=1), stop)
+        chunks.append((start, end))
+        start = end
+    return chunks
+
+# Ticker names with an exclusive end date, from the server or from cached (ticker, start, end, permno) mappings
+STOCKNAMES = '(SELECT ticker, permno, namedt, nameenddt + 1 AS nameenddt FROM crsp.stocknames) AS n'
+CACHED_NAMES = ('unnest(CAST(:name_tickers AS text[]), CAST(:name_permnos AS int[]), CAST(:name_starts AS date[]), '
+                'CAST(:name_ends AS date[])) AS n(ticker, permno, namedt, nameenddt)')
+
+def _query(tickers=None, permnos=None, mappings=None):
+    # Symbols are bound as array parameters, never pasted into the SQL
+    filters, params = [], {}
+    if mappings is not None:
+        rows = [(ticker, int(permno), date.fromisoformat(start), date.fromisoformat(end))
+                for ticker, intervals in mappings.items() for start, end, permno in intervals]
+        columns = list(zip(*rows)) if rows else [()] * 4
+        params.update({name: list(values) for name, values in
+                       zip(['name_tickers', 'name_permnos', 'name_starts', 'name_ends'], columns)})
+    elif tickers is not None:
+        filters.append('AND n.ticker = ANY(:tickers)')
+        params['tickers'] = list(tickers)
+    if permnos is not None:
+        filters.append('AND d.permno = ANY(:permnos)')
+        params['permnos'] = [int(permno) for permno in permnos]
+    query = CRSP_DAILY_QUERY.format(names=CACHED_NAMES if mappings is not None else STOCKNAMES,
+                                    filters='\n    '.join(filters))
+    return text(query), params
+
+def stream_crsp_daily(start_date, end_date, tickers=None, permnos=None, db_engine=None, batch_rows=BATCH_ROWS,
+                      chunk_years=CHUNK_YEARS, cache=None):
+    """
+    Streams CRSP daily bars in Arrow batches, one server-side cursor query per date chunk.
+    Args:
+        start_date (datetime-like): First date.
+        end_date (datetime-like): Last date, inclusive.
+        tickers (list, optional): Tickers, matched on the dates they were valid. None with permnos None means all.
+        permnos (list, optional): CRSP permnos to restrict to.
+        db_engine (sqlalchemy.Engine, optional): WRDS engine. Defaults to get_wrds_engine().
+        batch_rows (int): Rows fetched from the cursor per batch. Defaults to 100,000.
+        chunk_years (int): Years per query. Defaults to 1.
+        cache (symbology.SymbologyCache, optional): Cache the tickers' permnos are resolved with. Defaults to the shared one.
+    Yields:
+        tuple: (chunk index, pa.Table) with ticker, permno, date, open, high, low, close, volume, ordered by ticker
+            and date within a chunk.
+    """
+    db_engine = db_engine or get_wrds_engine()
+    mappings = None
+    if tickers is not None:
+        # Ticker -> permno intervals from the symbology cache, crsp.stocknames is only asked for unresolved tickers
+        end = pd.Timestamp(end_date).normalize() + pd.Timedelta(days=1)
+        mappings = resolve_permnos(tickers, start_date, end, db_engine, cache)
+        if not any(mappings.values()):
+            logger.warning(f'No CRSP permno found for {len(tickers)} ticker(s) between {start_date} and {end_date}')
+            return
+    query, params = _query(tickers, permnos, mappings)
+    for i, (start, end) in enumerate(date_chunks(start_date, end_date, chunk_years)):
+        logger.info(f'Querying CRSP daily bars from {start.date()} to {end.date()} (exclusive)')
+        with db_engine.connect() as conn:
+            with span('vendor_fetch', source='wrds', start=str(start.date())) as s:
+                # stream_results keeps the rows on the server (a named cursor), yield_per sets the batch size
+                result = conn.execution_options(stream_results=True, yield_per=batch_rows).execute(
+                    query, {**params, 'start': start.date(), 'end': end.date()})
+                s.add(requests=1)
+            columns = list(result.keys())
+            batches = result.partitions()
+            while True:
+                fetch_start = time.perf_counter()
+                rows = next(batches, None)
+                if rows is None:
+                    break
+                table = pa.table({name: pa.array(values) for name, values in zip(columns, zip(*rows))})
+                record('vendor_fetch', time.perf_counter() - fetch_start, rows=table.num_rows, bytes=table.nbytes)
+                yield i, table
+
+def iter_symbol_frames(batches):
+    """
+    Regroups ticker-ordered batches into one DataFrame per ticker and chunk.
+    A ticker split over a batch boundary is held back until its last row has arrived.
+    Args:
+        batches (iterable): (chunk index, pa.Table) as yielded by stream_crsp_daily.
+    Yields:
+        tuple: (ticker, pd.DataFrame with ts_event (UTC midnight of the date) and the bar columns).
+    """
+    pending, pending_chunk = None, None
+    for chunk, table in batches:
+        df = table.to_pandas()
+        if df.empty:
+            continue
+        df['ts_event'] = pd.to_datetime(df.pop('date')).dt.tz_localize('UTC')
+        if pending is not None:
+            if chunk == pending_chunk:
+                df = pd.concat([pending, df], ignore_index=True)
+            else:
+                # A new date chunk starts over from the first ticker
+                yield pending['ticker'].iat[0], pending
+        tickers = df['ticker'].to_numpy()
+        # Split points where the ticker changes; the last ticker may continue in the next batch
+        bounds = np.flatnonzero(tickers[1:] != tickers[:-1]) + 1
+        starts = np.concatenate(([0], bounds))
+        ends = np.concatenate((bounds, [len(df)]))
+        for start, end in zip(starts[:-1], ends[:-1]):
+            yield tickers[start], df.iloc[start:end]
+        pending, pending_chunk = df.iloc[starts[-1]:], chunk
+    if pending is not None:
+        yield pending['ticker'].iat[0], pending
+
+def extract_crsp_daily(start_date, end_date, tickers=None, permnos=None, store_root=RAW_STORE_ROOT, db_engine=None,
+                       batch_rows=BATCH_ROWS, chunk_years=CHUNK_YEARS):
+    """
+    Pulls CRSP daily bars into the raw store, one Parquet file per ticker and date chunk.
+    Arguments are the same as stream_crsp_daily.
+    Returns:
+        list: The tickers written, in first-seen order.
+    """
+    written = {}
+    batches = stream_crsp_daily(start_date, end_date, tickers, permnos, db_engine, batch_rows, chunk_years)
+    for ticker, df in iter_symbol_frames(batches):
+        write_raw(df.drop(columns='ticker'), ticker, CRSP_SCHEMA, store_root)
+        written[ticker] = True
+    logger.info(f'{len(written)} tickers extracted from CRSP into {store_root}')
+    return list(written)
+
+def convert_crsp_daily(ticker, store_root=RAW_STORE_ROOT, output_root=LEAN_EQUITY_ROOT, engine=None):
+    """
+    Writes a ticker's stored CRSP bars to its LEAN daily zip. Dates are written as 'YYYYMMDD 00:00'.
+    """
+    columns = ['open', 'high', 'low', 'close', 'volume']
+    if get_engine(engine) == 'polars':
+        source = scan_raw(ticker, CRSP_SCHEMA, columns=columns, root=store_root)
+        return write_lean_bars_polars(source, ticker, 'daily', timezone='UTC', output_root=output_root)
+    source = iter_raw_years(ticker, CRSP_SCHEMA, columns=columns, root=store_root)
+    return write_lean_bars(source, ticker, 'daily', timezone='UTC', output_root=output_root)
+
+def _convert_in_worker(convert, ticker):
+    # Spans recorded in the worker process are sent back with the result and merged by the parent
+    reset_metrics()
+    zip_file = convert(ticker)
+    return zip_file, get_metrics()
+
+def export_crsp_daily(start_date, end_date, tickers=None, permnos=None, store_root=RAW_STORE_ROOT,
+                      output_root=LEAN_EQUITY_ROOT, db_engine=None, engine=None, max_workers=None,
+                      batch_rows=BATCH_ROWS, chunk_years=CHUNK_YEARS):
+    """
+    Extracts CRSP daily bars for the tickers (or the whole universe) and writes a LEAN daily zip per ticker.
+    Args:
+        start_date (datetime-like): First date.
+        end_date (datetime-like): Last date, inclusive.
+        tickers (list, optional): Tickers to export. None with permnos None exports every CRSP ticker.
+        permnos (list, optional): CRSP permnos to restrict to.
+        store_root (str): Root of the raw store. Defaults to 'databento/raw'.
+        output_root (str): Root of the LEAN equity data folder. Defaults to 'data/equity/usa'.
+        db_engine (sqlalchemy.Engine, optional): WRDS engine. Defaults to get_wrds_engine().
+        engine (str, optional): LEAN conversion engine, 'pandas' or 'polars'. Defaults to the lean_engine environment variable.
+        max_workers (int, optional): Processes converting tickers. 1 converts serially. Defaults to os.cpu_count().
+        batch_rows (int): Rows fetched from the cursor per batch. Defaults to 100,000.
+        chunk_years (int): Years per query. Defaults to 1.
+    Returns:
+        list: Paths of the LEAN zips written.
+    """
+    extracted = extract_crsp_daily(start_date, end_date, tickers, permnos, store_root, db_engine, batch_rows, chunk_years)
+    convert = partial(convert_crsp_daily, store_root=store_root, output_root=output_root, engine=engine)
+    with span('lean_write', source='crsp', tickers=len(extracted)):
+        if max_workers == 1:
+            zip_files = [convert(ticker) for ticker in extracted]
+        else:
+            zip_files = []
+            with ProcessPoolExecutor(max_workers=max_workers or os.cpu_count() or 1) as executor:
+                for zip_file, metrics in executor.map(partial(_convert_in_worker, convert), extracted, chunksize=64):
+                    zip_files.append(zip_file)
+                    merge_metrics(metrics)
+    logger.info(f'{len(zip_files)} LEAN daily files written to {output_root}/daily')
+    return zip_files
+
+if __name__ == '__main__':
+    # Log level/format and the metrics file come from the lean_log_* and lean_metrics_* environment variables
+    configure()
+    export_crsp_daily('2023-01-01', '2023-12-31', tickers=['AAPL', 'MSFT'])